@@ -23,17 +23,23 @@
 
 import threading
 import asyncio
+import time
 import itertools
-from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional
+from collections import defaultdict, OrderedDict
+from collections.abc import MutableMapping, Mapping
+from typing import TYPE_CHECKING, Dict, Optional, Iterable, Tuple, List
 
 from . import bitcoin
 from .bitcoin import COINBASE_MATURITY, TYPE_ADDRESS, TYPE_PUBKEY
-from .util import PrintError, profiler, bfh, TxMinedInfo
+from .util import PrintError, profiler, bfh, TxMinedInfo, ReadWriteLock
 from .transaction import Transaction, TxOutput
 from .synchronizer import Synchronizer
 from .verifier import SPV
 from .blockchain import hash_header
+from .storage import DEFAULT_WRITE_INTERVAL
+from .bookkeeping import (TxInputs, TxOutputs, UtxoIndex, SpendGraph, HistoryIndex, VerifiedTxIndex,
+                          AddressList, address_set, intern,
+                          serialize_spent_outpoints, deserialize_spent_outpoints)
 from .i18n import _
 
 if TYPE_CHECKING:
@@ -45,15 +51,129 @@ TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
 
+# number of Transaction objects kept by LazyTransactionStore
+TX_CACHE_SIZE = 1000
+
 class AddTransactionException(Exception):
     pass
 
 
+def parents_first(txs: Dict[str, Transaction]) -> List[str]:
+    """The txids of txs, each one after those of txs it spends from."""
+    def parents(txid):
+        return [txin['prevout_hash'] for txin in txs[txid].inputs() if txin['type'] != 'coinbase']
+    order = []
+    visited = set()
+    for root in txs:
+        if root in visited:
+            continue
+        visited.add(root)
+        # depth-first, without recursion
+        stack = [(root, iter(parents(root)))]
+        while stack:
+            txid, it = stack[-1]
+            for parent in it:
+                if parent in txs and parent not in visited:
+                    visited.add(parent)
+                    stack.append((parent, iter(parents(parent))))
+                    break
+            else:
+                stack.pop()
+                order.append(txid)
+    return order
+
+
 class UnrelatedTransactionException(AddTransactionException):
     def __str__(self):
         return _("Transaction is unrelated to this wallet.")
 
 
+class LazyTransactionStore(MutableMapping):
+    """txid -> Transaction, for the transactions of a wallet.
+
+    The raw transactions loaded from storage are kept as they are, and
+    Transaction objects are only created when accessed. The most recently
+    used ones are cached, so repeated lookups return the same object.
+    Transactions added by the wallet are kept as objects until the
+    storage has them (see set_raw_source).
+    """
+
+    def __init__(self, raw_source: Mapping = None, cache_size: int = TX_CACHE_SIZE):
+        self._raw = raw_source if raw_source is not None else {}  # txid -> raw tx, read-only
+        self._txids = set(self._raw)
+        self._added = {}  # txid -> Transaction, not in self._raw
+        self._cache = OrderedDict()  # txid -> Transaction, from self._raw
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __getitem__(self, txid) -> Transaction:
+        with self._lock:
+            tx = self._added.get(txid)
+            if tx is not None:
+                return tx
+            tx = self._cache.get(txid)
+            if tx is not None:
+                self._cache.move_to_end(txid)
+                return tx
+            if txid not in self._txids:
+                raise KeyError(txid)
+            tx = Transaction(self._raw[txid])
+            self._cache[txid] = tx
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+            return tx
+
+    def __setitem__(self, txid, tx: Transaction):
+        with self._lock:
+            self._txids.add(txid)
+            self._added[txid] = tx
+            self._cache.pop(txid, None)
+
+    def __delitem__(self, txid):
+        with self._lock:
+            self._txids.remove(txid)
+            self._added.pop(txid, None)
+            self._cache.pop(txid, None)
+
+    def __contains__(self, txid):
+        return txid in self._txids
+
+    def __iter__(self):
+        return iter(list(self._txids))
+
+    def __len__(self):
+        return len(self._txids)
+
+    def get_raw(self, txid) -> str:
+        """Returns the serialized transaction, without creating a
+        Transaction object for it."""
+        with self._lock:
+            tx = self._added.get(txid)
+            if tx is not None:
+                return str(tx)
+            if txid not in self._txids:
+                raise KeyError(txid)
+            return self._raw[txid]
+
+    def get_unsaved_raw(self) -> Dict[str, str]:
+        """Returns txid -> raw tx for the transactions that are not in
+        the raw source yet."""
+        with self._lock:
+            return {txid: str(tx) for txid, tx in self._added.items()}
+
+    def set_raw_source(self, raw_source: Mapping):
+        """Called after the transactions were saved, with the raw
+        transactions as now found in storage."""
+        with self._lock:
+            self._raw = raw_source
+            for txid, tx in list(self._added.items()):
+                if txid in raw_source:
+                    del self._added[txid]
+                    self._cache[txid] = tx
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+
 class AddressSynchronizer(PrintError):
     """
     inherited by wallet
@@ -65,32 +185,41 @@ class AddressSynchronizer(PrintError):
         # verifier (SPV) and synchronizer are started in start_network
         self.synchronizer = None  # type: Synchronizer
         self.verifier = None  # type: SPV
-        # locks: if you need to take multiple ones, acquire them in the order they are defined here!
-        self.lock = threading.RLock()
-        self.transaction_lock = threading.RLock()
+        # The wallet state is guarded by one ReadWriteLock:
+        #  - queries (balances, history, utxos, tx heights) take its read
+        #    side, self.read_lock, and run concurrently with each other;
+        #  - changes take its write side, self.lock. A server response
+        #    is applied under a single write lock, so that queries see it
+        #    entirely or not at all.
+        # self.transaction_lock is the same lock as self.lock.
+        # The caches that queries fill in (balances, history index, address
+        # statuses) are guarded by self._cache_lock, taken after the read lock.
+        self._state_lock = ReadWriteLock()
+        self.read_lock = self._state_lock.reader
+        self.lock = self.transaction_lock = self._state_lock.writer
+        self._cache_lock = threading.RLock()
         # address -> list(txid, height)
-        self.history = storage.get('addr_history',{})
-        # Verified transactions.  txid -> TxMinedInfo.  Access with self.lock.
-        verified_tx = storage.get('verified_tx3', {})
-        self.verified_tx = {}  # type: Dict[str, TxMinedInfo]
-        for txid, (height, timestamp, txpos, header_hash) in verified_tx.items():
-            self.verified_tx[txid] = TxMinedInfo(height=height,
-                                                 conf=None,
-                                                 timestamp=timestamp,
-                                                 txpos=txpos,
-                                                 header_hash=header_hash)
-        # Transactions pending verification.  txid -> tx_height. Access with self.lock.
+        self.history = {addr: list(hist) for addr, hist in storage.get_readonly('addr_history', {}).items()}
+        # address -> status of its history, as announced by the server.
+        # Only present if it matches the stored history.
+        self.address_status = dict(storage.get_readonly('addr_status', {}))  # type: Dict[str, str]
+        # Verified transactions.  txid -> TxMinedInfo.
+        self.verified_tx = VerifiedTxIndex(storage.get_readonly('verified_tx3', {}).items())
+        # Transactions pending verification.  txid -> tx_height.
         self.unverified_tx = defaultdict(int)
         # true when synchronized
         self.up_to_date = False
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
+        # cached views of the addresses, see get_addresses
+        self._addresses_version = 0
+        self._address_lists = {}  # type: Dict[str, AddressList]
 
         self.load_and_cleanup()
 
-    def with_transaction_lock(func):
+    def with_read_lock(func):
         def func_wrapper(self, *args, **kwargs):
-            with self.transaction_lock:
+            with self.read_lock:
                 return func(self, *args, **kwargs)
         return func_wrapper
 
@@ -105,13 +234,25 @@ class AddressSynchronizer(PrintError):
         return address in self.history
 
     def get_addresses(self):
-        return sorted(self.history.keys())
+        return self._get_address_list('all', lambda: sorted(self.history.keys()))
+
+    def _get_address_list(self, name: str, get_addresses) -> AddressList:
+        """The cached AddressList called name, built with get_addresses()
+        if the addresses changed since it was built."""
+        version = self._addresses_version
+        addresses = self._address_lists.get(name)
+        if addresses is None or addresses.version != version:
+            addresses = AddressList(get_addresses(), version)
+            self._address_lists[name] = addresses
+        return addresses
+
+    def _invalidate_addresses(self):
+        """To be called after an address is added to or removed from the wallet."""
+        self._addresses_version += 1
 
     def get_address_history(self, addr):
         h = []
-        # we need self.transaction_lock but get_tx_height will take self.lock
-        # so we need to take that too here, to enforce order of locks
-        with self.lock, self.transaction_lock:
+        with self.read_lock:
             related_txns = self._history_local.get(addr, set())
             for tx_hash in related_txns:
                 tx_height = self.get_tx_height(tx_hash).height
@@ -126,13 +267,9 @@ class AddressSynchronizer(PrintError):
         addr = txi.get('address')
         if addr and addr != "(pubkey)":
             return addr
-        prevout_hash = txi.get('prevout_hash')
-        prevout_n = txi.get('prevout_n')
-        dd = self.txo.get(prevout_hash, {})
-        for addr, l in dd.items():
-            for n, v, is_cb in l:
-                if n == prevout_n:
-                    return addr
+        output = self.utxos.get_output((txi.get('prevout_hash'), txi.get('prevout_n')))
+        if output is not None:
+            return output[0]
         return None
 
     def get_txout_address(self, txo: TxOutput):
@@ -156,6 +293,8 @@ class AddressSynchronizer(PrintError):
         if self.network is not None:
             self.synchronizer = Synchronizer(self)
             self.verifier = SPV(self.network, self)
+            # from now on, writes requested by the network code are debounced
+            self.storage.start_writer(self.network.config.get('wallet_write_interval', DEFAULT_WRITE_INTERVAL))
 
     def stop_threads(self, write_to_disk=True):
         if self.network:
@@ -170,11 +309,14 @@ class AddressSynchronizer(PrintError):
             self.save_transactions()
             self.save_verified_tx()
             self.storage.write()
+        # the writer writes what was scheduled before it stops
+        self.storage.stop_writer()
 
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
             self.set_up_to_date(False)
+        self._invalidate_addresses()
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -185,13 +327,13 @@ class AddressSynchronizer(PrintError):
         reported as a conflict.
         """
         conflicting_txns = set()
-        with self.transaction_lock:
+        with self.read_lock:
             for txin in tx.inputs():
                 if txin['type'] == 'coinbase':
                     continue
                 prevout_hash = txin['prevout_hash']
                 prevout_n = txin['prevout_n']
-                spending_tx_hash = self.spent_outpoints[prevout_hash].get(prevout_n)
+                spending_tx_hash = self.spend_graph.get_spender(prevout_hash, prevout_n)
                 if spending_tx_hash is None:
                     continue
                 # this outpoint has already been spent, by spending_tx
@@ -209,9 +351,7 @@ class AddressSynchronizer(PrintError):
         assert tx, tx
         assert tx.is_complete()
         # assert tx_hash == tx.txid()  # disabled as expensive; test done by Synchronizer.
-        # we need self.transaction_lock but get_tx_height will take self.lock
-        # so we need to take that too here, to enforce order of locks
-        with self.lock, self.transaction_lock:
+        with self.lock:
             # NOTE: returning if tx in self.transactions might seem like a good idea
             # BUT we track is_mine inputs in a txn, and during subsequent calls
             # of add_transaction tx, we might learn of more-and-more inputs of
@@ -248,53 +388,39 @@ class AddressSynchronizer(PrintError):
                     # this is a local tx that conflicts with non-local txns; drop.
                     return False
                 # keep this txn and remove all conflicting
-                to_remove = set()
-                to_remove |= conflicting_txns
-                for conflicting_tx_hash in conflicting_txns:
-                    to_remove |= self.get_depending_transactions(conflicting_tx_hash)
+                to_remove = conflicting_txns | self.spend_graph.get_descendants(conflicting_txns)
                 for tx_hash2 in to_remove:
                     self.remove_transaction(tx_hash2)
+            tx_hash = intern(tx_hash)
             # add inputs
-            def add_value_from_prev_output():
-                dd = self.txo.get(prevout_hash, {})
-                # note: this nested loop takes linear time in num is_mine outputs of prev_tx
-                for addr, outputs in dd.items():
-                    # note: instead of [(n, v, is_cb), ...]; we could store: {n -> (v, is_cb)}
-                    for n, v, is_cb in outputs:
-                        if n == prevout_n:
-                            if addr and self.is_mine(addr):
-                                if d.get(addr) is None:
-                                    d[addr] = set()
-                                d[addr].add((ser, v))
-                            return
-            self.txi[tx_hash] = d = {}
+            inputs = []
             for txi in tx.inputs():
                 if txi['type'] == 'coinbase':
                     continue
-                prevout_hash = txi['prevout_hash']
+                prevout_hash = intern(txi['prevout_hash'])
                 prevout_n = txi['prevout_n']
-                ser = prevout_hash + ':%d' % prevout_n
-                self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
-                add_value_from_prev_output()
+                self.spend_graph.add_spend(tx_hash, prevout_hash, prevout_n)
+                output = self.utxos.get_output((prevout_hash, prevout_n))
+                if output is not None:
+                    addr, v, is_cb = output
+                    if addr and self.is_mine(addr):
+                        inputs.append((addr, prevout_hash, prevout_n, v))
+            self._set_tx_inputs(tx_hash, TxInputs(inputs))
             # add outputs
-            self.txo[tx_hash] = d = {}
+            outputs = []
             for n, txo in enumerate(tx.outputs()):
                 v = txo[2]
-                ser = tx_hash + ':%d'%n
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
-                    if d.get(addr) is None:
-                        d[addr] = []
-                    d[addr].append((n, v, is_coinbase))
+                    outputs.append((addr, n, v, is_coinbase))
                     # give v to txi that spends me
-                    next_tx = self.spent_outpoints[tx_hash].get(n)
+                    next_tx = self.spend_graph.get_spender(tx_hash, n)
                     if next_tx is not None:
-                        dd = self.txi.get(next_tx, {})
-                        if dd.get(addr) is None:
-                            dd[addr] = set()
-                        if (ser, v) not in dd[addr]:
-                            dd[addr].add((ser, v))
+                        next_inputs = self.txi.get(next_tx)
+                        if next_inputs is not None:
+                            self._set_tx_inputs(next_tx, next_inputs.with_input(addr, tx_hash, n, v))
                         self._add_tx_to_local_history(next_tx)
+            self._set_tx_outputs(tx_hash, TxOutputs(outputs))
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
@@ -302,51 +428,75 @@ class AddressSynchronizer(PrintError):
             return True
 
     def remove_transaction(self, tx_hash):
-        def remove_from_spent_outpoints():
-            # undo spends in spent_outpoints
-            if tx is not None:  # if we have the tx, this branch is faster
-                for txin in tx.inputs():
-                    if txin['type'] == 'coinbase':
-                        continue
-                    prevout_hash = txin['prevout_hash']
-                    prevout_n = txin['prevout_n']
-                    self.spent_outpoints[prevout_hash].pop(prevout_n, None)
-                    if not self.spent_outpoints[prevout_hash]:
-                        self.spent_outpoints.pop(prevout_hash)
-            else:  # expensive but always works
-                for prevout_hash, d in list(self.spent_outpoints.items()):
-                    for prevout_n, spending_txid in d.items():
-                        if spending_txid == tx_hash:
-                            self.spent_outpoints[prevout_hash].pop(prevout_n, None)
-                            if not self.spent_outpoints[prevout_hash]:
-                                self.spent_outpoints.pop(prevout_hash)
-            # Remove this tx itself; if nothing spends from it.
-            # It is not so clear what to do if other txns spend from it, but it will be
-            # removed when those other txns are removed.
-            if not self.spent_outpoints[tx_hash]:
-                self.spent_outpoints.pop(tx_hash)
-
-        with self.transaction_lock:
+        with self.lock:
             self.print_error("removing tx from history", tx_hash)
-            tx = self.transactions.pop(tx_hash, None)
-            remove_from_spent_outpoints()
+            self.transactions.pop(tx_hash, None)
+            # undo the spends of this tx. If other txns spend from it, they
+            # stay in the spend graph; they will be removed when those
+            # other txns are removed.
+            self.spend_graph.remove_spends(tx_hash)
+            self._dirty_history.add(tx_hash)
+            self._invalidate_tx_descendants(tx_hash)
             self._remove_tx_from_local_history(tx_hash)
-            self.txi.pop(tx_hash, None)
-            self.txo.pop(tx_hash, None)
+            inputs = self.txi.pop(tx_hash, None)
+            if inputs is not None:
+                self.utxos.remove_inputs(inputs)
+            outputs = self.txo.pop(tx_hash, None)
+            if outputs is not None:
+                self.utxos.remove_outputs(tx_hash, outputs)
+
+    def _set_tx_inputs(self, tx_hash, inputs: TxInputs):
+        old_inputs = self.txi.get(tx_hash)
+        if old_inputs is inputs:
+            return
+        if old_inputs is not None:
+            self.utxos.remove_inputs(old_inputs)
+        self.txi[tx_hash] = inputs
+        self.utxos.add_inputs(inputs)
+        self._dirty_history.add(tx_hash)
+        self._invalidate_tx_descendants(tx_hash)
+
+    def _set_tx_outputs(self, tx_hash, outputs: TxOutputs):
+        old_outputs = self.txo.get(tx_hash)
+        if old_outputs is not None:
+            self.utxos.remove_outputs(tx_hash, old_outputs)
+        self.txo[tx_hash] = outputs
+        self.utxos.add_outputs(tx_hash, outputs)
+        self._dirty_history.add(tx_hash)
 
     def get_depending_transactions(self, tx_hash):
         """Returns all (grand-)children of tx_hash in this wallet."""
-        children = set()
-        for other_hash in self.spent_outpoints[tx_hash].values():
-            children.add(other_hash)
-            children |= self.get_depending_transactions(other_hash)
-        return children
+        with self.read_lock:
+            return self.spend_graph.get_descendants([tx_hash])
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
-        self.add_unverified_tx(tx_hash, tx_height)
-        self.add_transaction(tx_hash, tx, allow_unrelated=True)
+        with self.lock:
+            self.add_unverified_tx(tx_hash, tx_height)
+            self.add_transaction(tx_hash, tx, allow_unrelated=True)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def add_transactions(self, batch: Iterable[Tuple[str, Transaction, int]]) -> List[Transaction]:
+        """Adds the transactions received from the server, as (tx_hash, tx,
+        tx_height), under one write lock. Within the batch, a transaction is
+        added after those it spends from, so that the values of its inputs
+        are known. Returns the transactions that were added."""
+        txs = OrderedDict()
+        heights = {}
+        for tx_hash, tx, tx_height in batch:
+            txs[tx_hash] = tx
+            heights[tx_hash] = tx_height
+        added = []
+        with self.lock:
+            for tx_hash in parents_first(txs):
+                self.add_unverified_tx(tx_hash, heights[tx_hash])
+                if self.add_transaction(tx_hash, txs[tx_hash], allow_unrelated=True):
+                    added.append(txs[tx_hash])
+        return added
+
+    def receive_history_callback(self, addr, hist, tx_fees, status=None):
+        """Stores the history of addr received from the server.
+        status, if given, is the server's status for that history."""
+        # deserialize the transactions before taking the write lock
+        txs = [(tx_hash, tx_height, self.transactions.get(tx_hash)) for tx_hash, tx_height in hist]
         with self.lock:
             old_hist = self.get_address_history(addr)
             for tx_hash, height in old_hist:
@@ -354,58 +504,68 @@ class AddressSynchronizer(PrintError):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.verified_tx.pop(tx_hash, None)
+                    self._invalidate_tx(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.history[addr] = hist
+            if status is not None:
+                self.address_status[addr] = status
+            else:
+                self.address_status.pop(addr, None)
 
-        for tx_hash, tx_height in hist:
-            # add it in case it was previously unconfirmed
-            self.add_unverified_tx(tx_hash, tx_height)
-            # if addr is new, we have to recompute txi and txo
-            tx = self.transactions.get(tx_hash)
-            if tx is None:
-                continue
-            self.add_transaction(tx_hash, tx, allow_unrelated=True)
+            for tx_hash, tx_height, tx in txs:
+                # add it in case it was previously unconfirmed
+                self.add_unverified_tx(tx_hash, tx_height)
+                # if addr is new, we have to recompute txi and txo
+                # (unless it was removed as conflicting meanwhile)
+                if tx is None or tx_hash not in self.transactions:
+                    continue
+                self.add_transaction(tx_hash, tx, allow_unrelated=True)
 
-        # Store fees
-        self.tx_fees.update(tx_fees)
+            # Store fees
+            self.tx_fees.update(tx_fees)
 
     @profiler
     def load_transactions(self):
         # load txi, txo, tx_fees
         # bookkeeping data of is_mine inputs of transactions
-        self.txi = self.storage.get('txi', {})  # txid -> address -> (prev_outpoint, value)
-        for txid, d in list(self.txi.items()):
-            for addr, lst in d.items():
-                self.txi[txid][addr] = set([tuple(x) for x in lst])
+        # note: these are read without copying, and converted into our own containers
+        txi = self.storage.get_readonly('txi', {})
+        self.txi = {intern(txid): TxInputs.deserialize(s) for txid, s in txi.items()}  # type: Dict[str, TxInputs]
         # bookkeeping data of is_mine outputs of transactions
-        self.txo = self.storage.get('txo', {})  # txid -> address -> (output_index, value, is_coinbase)
-        self.tx_fees = self.storage.get('tx_fees', {})
-        tx_list = self.storage.get('transactions', {})
-        # load transactions
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
+        txo = self.storage.get_readonly('txo', {})
+        self.txo = {intern(txid): TxOutputs.deserialize(s) for txid, s in txo.items()}  # type: Dict[str, TxOutputs]
+        self.tx_fees = dict(self.storage.get_readonly('tx_fees', {}))
+        # load transactions; Transaction objects are created when needed
+        self.transactions = LazyTransactionStore(self.storage.get_readonly('transactions', {}))
+        for tx_hash in self.transactions:
             if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None:
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                del self.transactions[tx_hash]
         # load spent_outpoints
-        _spent_outpoints = self.storage.get('spent_outpoints', {})
-        self.spent_outpoints = defaultdict(dict)
-        for prevout_hash, d in _spent_outpoints.items():
-            for prevout_n_str, spending_txid in d.items():
-                prevout_n = int(prevout_n_str)
+        # prevout_hash -> prevout_n -> spending_txid
+        spent_outpoints = deserialize_spent_outpoints(self.storage.get_readonly('spent_outpoints', {}))
+        for prevout_hash, d in list(spent_outpoints.items()):
+            for prevout_n, spending_txid in list(d.items()):
                 if spending_txid not in self.transactions:
-                    continue  # only care about txns we have
-                self.spent_outpoints[prevout_hash][prevout_n] = spending_txid
+                    del d[prevout_n]  # only care about txns we have
+        self.spend_graph = SpendGraph(spent_outpoints)
+        # unspent is_mine outputs, kept up to date by add_transaction and remove_transaction
+        self.utxos = UtxoIndex()
+        for txid, outputs in self.txo.items():
+            self.utxos.add_outputs(txid, outputs)
+        for inputs in self.txi.values():
+            self.utxos.add_inputs(inputs)
 
     @profiler
     def load_local_history(self):
         self._history_local = {}  # address -> set(txid)
         self._address_history_changed_events = defaultdict(asyncio.Event)  # address -> Event
+        self._clear_balance_cache()
+        self._clear_history_index()
         for txid in itertools.chain(self.txi, self.txo):
             self._add_tx_to_local_history(txid)
+            self._dirty_history.add(txid)
 
     @profiler
     def check_history(self):
@@ -414,7 +574,10 @@ class AddressSynchronizer(PrintError):
         hist_addrs_not_mine = list(filter(lambda k: not self.is_mine(k), self.history.keys()))
         for addr in hist_addrs_not_mine:
             self.history.pop(addr)
+            self.address_status.pop(addr, None)
             save = True
+        if hist_addrs_not_mine:
+            self._invalidate_addresses()
         for addr in hist_addrs_mine:
             hist = self.history[addr]
             for tx_hash, tx_height in hist:
@@ -436,44 +599,46 @@ class AddressSynchronizer(PrintError):
 
     @profiler
     def save_transactions(self, write=False):
-        with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
+        with self.read_lock:
+            # only the transactions added since the last save are serialized
+            self.storage.put_raw_transactions(set(self.transactions), self.transactions.get_unsaved_raw())
+            self.transactions.set_raw_source(self.storage.get_readonly('transactions', {}))
+            self.storage.put('txi', {txid: x.serialize() for txid, x in self.txi.items()})
+            self.storage.put('txo', {txid: x.serialize() for txid, x in self.txo.items()})
             self.storage.put('tx_fees', self.tx_fees)
             self.storage.put('addr_history', self.history)
-            self.storage.put('spent_outpoints', self.spent_outpoints)
+            # the synchronizer adds statuses under the read lock
+            with self._cache_lock:
+                self.storage.put('addr_status', dict(self.address_status))
+            self.storage.put('spent_outpoints', serialize_spent_outpoints(self.spend_graph.to_dict()))
             if write:
-                self.storage.write()
+                self.storage.schedule_write()
 
     def save_verified_tx(self, write=False):
-        with self.lock:
-            verified_tx_to_save = {}
-            for txid, tx_info in self.verified_tx.items():
-                verified_tx_to_save[txid] = (tx_info.height, tx_info.timestamp,
-                                             tx_info.txpos, tx_info.header_hash)
-            self.storage.put('verified_tx3', verified_tx_to_save)
+        with self.read_lock:
+            self.storage.put('verified_tx3', self.verified_tx.to_dict())
             if write:
-                self.storage.write()
+                self.storage.schedule_write()
 
     def clear_history(self):
         with self.lock:
-            with self.transaction_lock:
-                self.txi = {}
-                self.txo = {}
-                self.tx_fees = {}
-                self.spent_outpoints = defaultdict(dict)
-                self.history = {}
-                self.verified_tx = {}
-                self.transactions = {}  # type: Dict[str, Transaction]
-                self.save_transactions()
+            self.txi = {}
+            self.txo = {}
+            self.utxos = UtxoIndex()
+            self._clear_balance_cache()
+            self._clear_history_index()
+            self.tx_fees = {}
+            self.spend_graph = SpendGraph()
+            self.history = {}
+            self.address_status = {}
+            self._invalidate_addresses()
+            self.verified_tx = VerifiedTxIndex()
+            self.transactions = LazyTransactionStore()
+            self.save_transactions()
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
-        with self.lock:
+        with self.read_lock:
             if tx_hash in self.verified_tx:
                 info = self.verified_tx[tx_hash]
                 return info.height, info.txpos
@@ -495,12 +660,94 @@ class AddressSynchronizer(PrintError):
                 self.threadlocal_cache.local_height = orig_val
         return f
 
+    def _clear_history_index(self):
+        # history of the whole wallet; the transactions in _dirty_history
+        # are updated in the index when it is read
+        self._history_index = HistoryIndex()
+        self._dirty_history = set()
+
+    def _get_history_entry(self, tx_hash):
+        """Returns (txpos, delta, timestamp) of tx_hash for the history
+        index, or None if it is not in the history of the wallet."""
+        is_related = False
+        delta = 0
+        for addr, prevout_hash, prevout_n, v in self.txi.get(tx_hash, ()):
+            if self.is_mine(addr):
+                is_related = True
+                delta -= v
+        for addr, n, v, is_cb in self.txo.get(tx_hash, ()):
+            if self.is_mine(addr):
+                is_related = True
+                delta += v
+        if not is_related:
+            return None
+        info = self.verified_tx.get(tx_hash)
+        return self.get_txpos(tx_hash), delta, info.timestamp if info else None
+
+    def _update_history_index(self):
+        dirty, self._dirty_history = self._dirty_history, set()
+        index = self._history_index
+        if len(dirty) > len(index) // 4:
+            # cheaper to sort everything at once
+            entries = ((txid, self._get_history_entry(txid)) for txid in set(self.txi) | set(self.txo))
+            index.rebuild((txid, *entry) for txid, entry in entries if entry is not None)
+            return
+        for txid in dirty:
+            entry = self._get_history_entry(txid)
+            if entry is None:
+                index.remove(txid)
+            else:
+                index.add(txid, *entry)
+
+    def _check_history_index(self):
+        self._update_history_index()
+        if self._history_index.total() != sum(self.get_balance()):
+            # fixme: this may happen if history is incomplete
+            self.print_error("Error: history not synchronized")
+            return False
+        return True
+
+    def _get_history_rows(self, items):
+        # items: (txid, delta, balance) from the history index
+        with self.read_lock, self._cache_lock:
+            if not self._check_history_index():
+                return []
+            return [(txid, self.get_tx_height(txid), delta, balance)
+                    for txid, delta, balance in items(self._history_index)]
+
+    def is_whole_wallet(self, domain):
+        return domain is None or self.history.keys() <= address_set(domain)
+
+    @with_local_height_cached
+    def get_history_slice(self, start=0, stop=None):
+        """The wallet history from position start to stop, as in get_history."""
+        return self._get_history_rows(lambda index: index.items(start, stop))
+
+    @with_local_height_cached
+    def get_history_between(self, from_timestamp=None, to_timestamp=None):
+        """The wallet history, as in get_history, restricted to the
+        transactions with from_timestamp <= timestamp < to_timestamp.
+        Unconfirmed transactions count as happening now."""
+        now = time.time()
+        return self._get_history_rows(lambda index: index.items_between(from_timestamp, to_timestamp, now))
+
     @with_local_height_cached
     def get_history(self, domain=None):
-        # get domain
-        if domain is None:
-            domain = self.history.keys()
-        domain = set(domain)
+        if self.is_whole_wallet(domain):
+            # served from the history index
+            return self.get_history_slice()
+        return self._get_history_from_addresses(domain)
+
+    def get_balance_at_timestamp(self, timestamp):
+        """The balance of the wallet before its first transaction
+        later than timestamp. Unconfirmed transactions count as later."""
+        with self.read_lock, self._cache_lock:
+            if not self._check_history_index():
+                return 0
+            return self._history_index.balance_at_timestamp(timestamp)
+
+    def _get_history_from_addresses(self, domain):
+        domain = address_set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -538,16 +785,16 @@ class AddressSynchronizer(PrintError):
         return h2
 
     def _add_tx_to_local_history(self, txid):
-        with self.transaction_lock:
-            for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
+        with self.lock:
+            for addr in self._get_tx_addresses(txid):
                 cur_hist = self._history_local.get(addr, set())
                 cur_hist.add(txid)
                 self._history_local[addr] = cur_hist
                 self._mark_address_history_changed(addr)
 
     def _remove_tx_from_local_history(self, txid):
-        with self.transaction_lock:
-            for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
+        with self.lock:
+            for addr in self._get_tx_addresses(txid):
                 cur_hist = self._history_local.get(addr, set())
                 try:
                     cur_hist.remove(txid)
@@ -555,8 +802,16 @@ class AddressSynchronizer(PrintError):
                     pass
                 else:
                     self._history_local[addr] = cur_hist
+                self._invalidate_addr_balance(addr)
+
+    def _get_tx_addresses(self, txid):
+        inputs = self.txi.get(txid)
+        outputs = self.txo.get(txid)
+        return itertools.chain(inputs.addresses() if inputs else (),
+                               outputs.addresses() if outputs else ())
 
     def _mark_address_history_changed(self, addr: str) -> None:
+        self._invalidate_addr_balance(addr)
         # history for this address changed, wake up coroutines:
         self._address_history_changed_events[addr].set()
         # clear event immediately so that coroutines can wait() for the next change:
@@ -576,11 +831,14 @@ class AddressSynchronizer(PrintError):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.verified_tx.pop(tx_hash)
+                    self._invalidate_tx(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self._invalidate_tx(tx_hash)
                 self.unverified_tx[tx_hash] = tx_height
 
     def remove_unverified_tx(self, tx_hash, tx_height):
@@ -588,41 +846,48 @@ class AddressSynchronizer(PrintError):
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._invalidate_tx(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info
+            self._invalidate_tx(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
     def get_unverified_txs(self):
         '''Returns a map from tx hash to transaction height'''
-        with self.lock:
+        with self.read_lock:
             return dict(self.unverified_tx)  # copy
 
     def undo_verifications(self, blockchain, height):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
         with self.lock:
-            for tx_hash, info in list(self.verified_tx.items()):
+            # only the transactions above the fork point are looked at
+            header_hashes = {}
+            for tx_hash, info in self.verified_tx.items_from_height(height):
                 tx_height = info.height
-                if tx_height >= height:
+                if tx_height not in header_hashes:
                     header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
-                        self.verified_tx.pop(tx_hash, None)
-                        # NOTE: we should add these txns to self.unverified_tx,
-                        # but with what height?
-                        # If on the new fork after the reorg, the txn is at the
-                        # same height, we will not get a status update for the
-                        # address. If the txn is not mined or at a diff height,
-                        # we should get a status update. Unless we put tx into
-                        # unverified_tx, it will turn into local. So we put it
-                        # into unverified_tx with the old height, and if we get
-                        # a status update, that will overwrite it.
-                        self.unverified_tx[tx_hash] = tx_height
-                        txs.add(tx_hash)
+                    header_hashes[tx_height] = hash_header(header) if header else None
+                header_hash = header_hashes[tx_height]
+                if header_hash is None or header_hash != info.header_hash:
+                    self.verified_tx.pop(tx_hash, None)
+                    # NOTE: we should add these txns to self.unverified_tx,
+                    # but with what height?
+                    # If on the new fork after the reorg, the txn is at the
+                    # same height, we will not get a status update for the
+                    # address. If the txn is not mined or at a diff height,
+                    # we should get a status update. Unless we put tx into
+                    # unverified_tx, it will turn into local. So we put it
+                    # into unverified_tx with the old height, and if we get
+                    # a status update, that will overwrite it.
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._invalidate_tx(tx_hash)
+                    txs.add(tx_hash)
         return txs
 
     def get_local_height(self):
@@ -633,7 +898,7 @@ class AddressSynchronizer(PrintError):
         return self.network.get_local_height() if self.network else self.storage.get('stored_height', 0)
 
     def get_tx_height(self, tx_hash: str) -> TxMinedInfo:
-        with self.lock:
+        with self.read_lock:
             if tx_hash in self.verified_tx:
                 info = self.verified_tx[tx_hash]
                 conf = max(self.get_local_height() - info.height + 1, 0)
@@ -658,32 +923,37 @@ class AddressSynchronizer(PrintError):
                 self.save_verified_tx(write=True)
 
     def is_up_to_date(self):
-        with self.lock: return self.up_to_date
+        with self.read_lock: return self.up_to_date
+
+    def get_sync_progress(self) -> Tuple[int, int]:
+        """Returns the number of history and transaction requests
+        done, and the total, while synchronizing."""
+        if self.synchronizer is None:
+            return 0, 0
+        return self.synchronizer.get_progress()
 
-    @with_transaction_lock
+    @with_read_lock
     def get_tx_delta(self, tx_hash, address):
         """effect of tx on address"""
         delta = 0
         # substract the value of coins sent from address
-        d = self.txi.get(tx_hash, {}).get(address, [])
-        for n, v in d:
-            delta -= v
+        for addr, prevout_hash, prevout_n, v in self.txi.get(tx_hash, ()):
+            if addr == address:
+                delta -= v
         # add the value of the coins received at address
-        d = self.txo.get(tx_hash, {}).get(address, [])
-        for n, v, cb in d:
-            delta += v
+        for addr, n, v, is_cb in self.txo.get(tx_hash, ()):
+            if addr == address:
+                delta += v
         return delta
 
-    @with_transaction_lock
+    @with_read_lock
     def get_tx_value(self, txid):
         """effect of tx on the entire domain"""
         delta = 0
-        for addr, d in self.txi.get(txid, {}).items():
-            for n, v in d:
-                delta -= v
-        for addr, d in self.txo.get(txid, {}).items():
-            for n, v, cb in d:
-                delta += v
+        for addr, prevout_hash, prevout_n, v in self.txi.get(txid, ()):
+            delta -= v
+        for addr, n, v, is_cb in self.txo.get(txid, ()):
+            delta += v
         return delta
 
     def get_wallet_delta(self, tx: Transaction):
@@ -698,11 +968,9 @@ class AddressSynchronizer(PrintError):
             if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
-                d = self.txo.get(txin['prevout_hash'], {}).get(addr, [])
-                for n, v, cb in d:
-                    if n == txin['prevout_n']:
-                        value = v
-                        break
+                output = self.utxos.get_output((txin['prevout_hash'], txin['prevout_n']))
+                if output is not None and output[0] == addr:
+                    value = output[1]
                 else:
                     value = None
                 if value is None:
@@ -743,7 +1011,7 @@ class AddressSynchronizer(PrintError):
             return None
         if hasattr(tx, '_cached_fee'):
             return tx._cached_fee
-        with self.lock, self.transaction_lock:
+        with self.read_lock:
             is_relevant, is_mine, v, fee = self.get_wallet_delta(tx)
             if fee is None:
                 txid = tx.txid()
@@ -754,53 +1022,63 @@ class AddressSynchronizer(PrintError):
         return fee
 
     def get_addr_io(self, address):
-        with self.lock, self.transaction_lock:
+        with self.read_lock:
             h = self.get_address_history(address)
             received = {}
             sent = {}
             for tx_hash, height in h:
-                l = self.txo.get(tx_hash, {}).get(address, [])
-                for n, v, is_cb in l:
-                    received[tx_hash + ':%d'%n] = (height, v, is_cb)
+                for addr, n, v, is_cb in self.txo.get(tx_hash, ()):
+                    if addr == address:
+                        received[tx_hash + ':%d'%n] = (height, v, is_cb)
             for tx_hash, height in h:
-                l = self.txi.get(tx_hash, {}).get(address, [])
-                for txi, v in l:
-                    sent[txi] = height
+                for addr, prevout_hash, prevout_n, v in self.txi.get(tx_hash, ()):
+                    if addr == address:
+                        sent[prevout_hash + ':%d'%prevout_n] = height
         return received, sent
 
+    def _make_utxo(self, address, prevout_hash, prevout_n, value, is_cb):
+        return {
+            'address':address,
+            'value':value,
+            'prevout_n':prevout_n,
+            'prevout_hash':prevout_hash,
+            'height':self.get_tx_height(prevout_hash).height,
+            'coinbase':is_cb
+        }
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
         out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
+        with self.read_lock:
+            for (prevout_hash, prevout_n), (value, is_cb) in self.utxos.get_addr_utxos(address).items():
+                out[prevout_hash + ':%d'%prevout_n] = self._make_utxo(address, prevout_hash, prevout_n, value, is_cb)
         return out
 
+    def check_utxo_index(self):
+        """Compares the utxo index with the unspent outputs computed from
+        the history of each address. Returns the addresses where they differ."""
+        bad = []
+        with self.read_lock:
+            for address in set(self.history) | (address_set(self.get_addresses()) & self.utxos.addresses()):
+                received, sent = self.get_addr_io(address)
+                expected = {txo: (v, is_cb) for txo, (height, v, is_cb) in received.items() if txo not in sent}
+                indexed = {prevout_hash + ':%d'%prevout_n: v
+                           for (prevout_hash, prevout_n), v in self.utxos.get_addr_utxos(address).items()}
+                if expected != indexed:
+                    bad.append(address)
+        return sorted(bad)
+
     # return the total amount ever received by an address
     def get_addr_received(self, address):
         received, sent = self.get_addr_io(address)
         return sum([v for height, v, is_cb in received.values()])
 
-    @with_local_height_cached
-    def get_addr_balance(self, address):
-        """Return the balance of a bitcoin address:
-        confirmed and matured, unconfirmed, unmatured
-        """
+    def _compute_addr_balance(self, address):
         received, sent = self.get_addr_io(address)
         c = u = x = 0
+        has_coinbase = False
         local_height = self.get_local_height()
         for txo, (tx_height, v, is_cb) in received.items():
+            has_coinbase |= is_cb
             if is_cb and tx_height + COINBASE_MATURITY > local_height:
                 x += v
             elif tx_height > 0:
@@ -812,33 +1090,114 @@ class AddressSynchronizer(PrintError):
                     c -= v
                 else:
                     u -= v
+        # the maturity of coinbase outputs depends on the local height
+        if has_coinbase:
+            self._coinbase_addresses.add(address)
+        else:
+            self._coinbase_addresses.discard(address)
         return c, u, x
 
+    def _clear_balance_cache(self):
+        # address -> (c, u, x); valid for addresses not in _dirty_balances
+        self._balances = {}
+        self._dirty_balances = set()
+        # address -> what its cached balance adds to _total_balance;
+        # nothing unless it was is_mine when the balance was computed
+        self._total_contributions = {}
+        self._total_balance = (0, 0, 0)
+        self._balances_local_height = None
+        self._coinbase_addresses = set()
+
+    def _invalidate_addr_balance(self, addr):
+        self._dirty_balances.add(addr)
+
+    def _invalidate_tx(self, tx_hash):
+        # the height of tx_hash changed
+        with self.lock:
+            for addr in self._get_tx_addresses(tx_hash):
+                self._invalidate_addr_balance(addr)
+            self._dirty_history.add(tx_hash)
+            self._invalidate_tx_descendants(tx_hash)
+
+    def _invalidate_tx_descendants(self, tx_hash):
+        # the inputs or the height of tx_hash changed, or it was removed:
+        # subclasses drop what they derived from the ancestry of its
+        # descendants
+        pass
+
+    def _invalidate_address(self, addr):
+        # the is_mine status of addr changed
+        with self.lock:
+            self._invalidate_addr_balance(addr)
+            self._dirty_history.update(self._history_local.get(addr, ()))
+
+    def _check_balances_local_height(self):
+        local_height = self.get_local_height()
+        if local_height != self._balances_local_height:
+            self._dirty_balances |= self._coinbase_addresses
+            self._balances_local_height = local_height
+
+    def _update_addr_balance(self, address):
+        self._dirty_balances.discard(address)
+        self._balances.pop(address, None)
+        new = self._compute_addr_balance(address)
+        if any(new):
+            self._balances[address] = new
+        # the address may have stopped being is_mine since its last
+        # contribution: remove that one whatever is_mine says now
+        old_contribution = self._total_contributions.pop(address, (0, 0, 0))
+        new_contribution = new if self.is_mine(address) else (0, 0, 0)
+        if any(new_contribution):
+            self._total_contributions[address] = new_contribution
+        self._total_balance = tuple(t - o + n for t, o, n in
+                                    zip(self._total_balance, old_contribution, new_contribution))
+        return new
+
+    @with_local_height_cached
+    def get_addr_balance(self, address):
+        """Return the balance of a bitcoin address:
+        confirmed and matured, unconfirmed, unmatured
+        """
+        with self.read_lock, self._cache_lock:
+            self._check_balances_local_height()
+            if address in self._dirty_balances:
+                return self._update_addr_balance(address)
+            return self._balances.get(address, (0, 0, 0))
+
     @with_local_height_cached
     def get_utxos(self, domain=None, excluded=None, mature=False, confirmed_only=False, nonlocal_only=False):
         coins = []
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        if excluded:
-            domain = set(domain) - excluded
-        for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos.values():
-                if confirmed_only and x['height'] <= 0:
-                    continue
-                if nonlocal_only and x['height'] == TX_HEIGHT_LOCAL:
-                    continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
-                    continue
-                coins.append(x)
-                continue
+        with self.read_lock:
+            # only look at the addresses that have coins. The index may
+            # still have coins of addresses that were deleted from the wallet.
+            if domain is None:
+                domain = address_set(self.get_addresses()) & self.utxos.addresses()
+            else:
+                domain = address_set(domain) & self.utxos.addresses()
+            if excluded:
+                domain -= excluded
+            for addr in domain:
+                for (prevout_hash, prevout_n), (value, is_cb) in self.utxos.get_addr_utxos(addr).items():
+                    x = self._make_utxo(addr, prevout_hash, prevout_n, value, is_cb)
+                    if confirmed_only and x['height'] <= 0:
+                        continue
+                    if nonlocal_only and x['height'] == TX_HEIGHT_LOCAL:
+                        continue
+                    if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                        continue
+                    coins.append(x)
         return coins
 
+    @with_local_height_cached
     def get_balance(self, domain=None):
         if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
+            # running total, only the balances that changed are recomputed
+            with self.read_lock, self._cache_lock:
+                self._check_balances_local_height()
+                for addr in list(self._dirty_balances):
+                    self._update_addr_balance(addr)
+                return self._total_balance
+        domain = address_set(domain)
         cc = uu = xx = 0
         for addr in domain:
             c, u, x = self.get_addr_balance(addr)
@@ -857,3 +1216,8 @@ class AddressSynchronizer(PrintError):
 
     def synchronize(self):
         pass
+
+    def is_gap_address(self, address):
+        """Whether a new history of address may require synchronize
+        to generate new addresses."""
+        return False
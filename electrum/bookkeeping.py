@@ -0,0 +1,830 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2018 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Compact containers for the bookkeeping of a wallet about its
+# transactions: the is_mine inputs (txi) and outputs (txo) of each
+# transaction, and which transaction spends which outpoint.
+#
+# A wallet has one TxInputs and one TxOutputs per transaction, so they
+# are kept small: the records are packed into a bytes object, and the
+# addresses and txids are interned, i.e. shared with the rest of the
+# wallet. The objects are immutable.
+#
+# In storage, each of them is a single string: the space separated
+# addresses, a colon, and the packed records in hex.
+#
+# UtxoIndex and HistoryIndex are derived from them, and SpendGraph holds
+# spent_outpoints; the wallet updates them as transactions are added and
+# removed. CostBasis derives the fiat acquisition cost of the coins.
+# VerifiedTxIndex holds the SPV-verified transactions, by height.
+# AddressList is the cached, read-only view of the wallet addresses.
+
+import bisect
+import math
+import struct
+import sys
+from array import array
+from collections import defaultdict
+from decimal import Decimal
+from typing import Iterable, Iterator, Tuple, Optional, Dict, Set, List, Callable, AbstractSet
+
+from .bitcoin import COIN
+from .util import bfh, bh2u, TxMinedInfo
+
+
+intern = sys.intern
+
+
+class _PackedRecords:
+    __slots__ = ('_addresses', '_packed')
+    _record = None  # type: struct.Struct
+
+    def __init__(self, records: Iterable[tuple] = ()):
+        addresses = []
+        index = {}
+        packed = []
+        for addr, *fields in records:
+            i = index.get(addr)
+            if i is None:
+                i = index[addr] = len(addresses)
+                addresses.append(intern(addr))
+            packed.append(self._pack(i, *fields))
+        self._addresses = tuple(addresses)
+        self._packed = b''.join(packed)
+
+    def _pack(self, i, *fields) -> bytes:
+        return self._record.pack(i, *fields)
+
+    def __len__(self):
+        return len(self._packed) // self._record.size
+
+    def __bool__(self):
+        return bool(self._packed)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and sorted(self) == sorted(other)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, list(self))
+
+    def addresses(self) -> Tuple[str, ...]:
+        return self._addresses
+
+    def serialize(self) -> str:
+        return ' '.join(self._addresses) + ':' + bh2u(self._packed)
+
+    @classmethod
+    def deserialize(cls, s: str):
+        addresses, packed = s.split(':')
+        self = cls.__new__(cls)
+        self._addresses = tuple(intern(a) for a in addresses.split(' ')) if addresses else ()
+        self._packed = bfh(packed)
+        return self
+
+
+class TxOutputs(_PackedRecords):
+    """The is_mine outputs of a transaction,
+    as (address, output_index, value, is_coinbase) records."""
+    __slots__ = ()
+    _record = struct.Struct('<HIq?')
+
+    def __iter__(self) -> Iterator[Tuple[str, int, int, bool]]:
+        addresses = self._addresses
+        for i, n, v, is_cb in self._record.iter_unpack(self._packed):
+            yield addresses[i], n, v, is_cb
+
+    def get_output(self, n: int) -> Optional[Tuple[str, int, bool]]:
+        """Returns (address, value, is_coinbase) of output n, if it is ours."""
+        for addr, n2, v, is_cb in self:
+            if n2 == n:
+                return addr, v, is_cb
+        return None
+
+    @classmethod
+    def from_legacy(cls, d: dict) -> 'TxOutputs':
+        # d: address -> [(output_index, value, is_coinbase)]
+        return cls((addr, n, v, is_cb) for addr, l in d.items() for n, v, is_cb in l)
+
+
+class TxInputs(_PackedRecords):
+    """The is_mine inputs of a transaction,
+    as (address, prevout_hash, prevout_n, value) records."""
+    __slots__ = ()
+    _record = struct.Struct('<H32sIq')
+
+    def _pack(self, i, prevout_hash, prevout_n, value):
+        return self._record.pack(i, bfh(prevout_hash), prevout_n, value)
+
+    def __iter__(self) -> Iterator[Tuple[str, str, int, int]]:
+        addresses = self._addresses
+        for i, prevout_hash, prevout_n, v in self._record.iter_unpack(self._packed):
+            yield addresses[i], bh2u(prevout_hash), prevout_n, v
+
+    def with_input(self, addr: str, prevout_hash: str, prevout_n: int, value: int) -> 'TxInputs':
+        """Returns a TxInputs with the given record added, or self if
+        it is already there."""
+        record = (addr, prevout_hash, prevout_n, value)
+        records = list(self)
+        if record in records:
+            return self
+        return TxInputs(records + [record])
+
+    @classmethod
+    def from_legacy(cls, d: dict) -> 'TxInputs':
+        # d: address -> [("prevout_hash:prevout_n", value)]
+        records = []
+        for addr, l in d.items():
+            for ser, v in l:
+                prevout_hash, prevout_n = ser.split(':')
+                records.append((addr, prevout_hash, int(prevout_n), v))
+        return cls(records)
+
+
+def serialize_spent_outpoints(spent_outpoints: Dict[str, Dict[int, str]]) -> Dict[str, str]:
+    # prevout_hash -> "prevout_n:spending_txid prevout_n:spending_txid ..."
+    return {prevout_hash: ' '.join('%d:%s' % (n, txid) for n, txid in d.items())
+            for prevout_hash, d in spent_outpoints.items() if d}
+
+
+def deserialize_spent_outpoints(d: Dict[str, str]) -> Dict[str, Dict[int, str]]:
+    spent_outpoints = defaultdict(dict)
+    for prevout_hash, s in d.items():
+        spent = spent_outpoints[intern(prevout_hash)]
+        for item in s.split(' '):
+            n, txid = item.split(':')
+            spent[int(n)] = intern(txid)
+    return spent_outpoints
+
+
+class AddressList(tuple):
+    """An immutable list of addresses, as returned by get_addresses.
+
+    The wallet builds it once per version of its addresses, i.e. until
+    an address is added or removed. Membership is tested in a frozenset,
+    built on first use.
+    """
+
+    def __new__(cls, addresses: Iterable[str] = (), version: int = 0):
+        self = super().__new__(cls, addresses)
+        self.version = version
+        self._set = None
+        return self
+
+    @property
+    def set(self) -> AbstractSet[str]:
+        if self._set is None:
+            self._set = frozenset(self)
+        return self._set
+
+    def __contains__(self, addr) -> bool:
+        return addr in self.set
+
+
+def address_set(domain: Iterable[str]) -> AbstractSet[str]:
+    """domain as a set, without copying it if it already is one.
+    The returned set must not be modified."""
+    if isinstance(domain, AddressList):
+        return domain.set
+    if isinstance(domain, (set, frozenset)):
+        return domain
+    return set(domain)
+
+
+class UtxoIndex:
+    """The unspent is_mine outputs of a wallet, indexed by outpoint and
+    by address. It is kept up to date with the TxInputs and TxOutputs
+    of the transactions as they are added to and removed from the wallet.
+
+    An output is unspent if no is_mine input of the same address spends it.
+    Outpoints are (txid, output_index) tuples.
+
+    The index also knows all is_mine outputs, spent or not, so it is used
+    to look up the address and value of a prevout.
+    """
+
+    def __init__(self):
+        # (txid, n) -> (address, value, is_coinbase)
+        self._received = {}  # type: Dict[Tuple[str, int], Tuple[str, int, bool]]
+        # (address, prevout_hash, prevout_n) -> number of inputs spending it
+        self._spent = defaultdict(int)  # type: Dict[Tuple[str, str, int], int]
+        # address -> (txid, n) -> (value, is_coinbase), unspent outputs only
+        self._by_address = {}  # type: Dict[str, Dict[Tuple[str, int], Tuple[int, bool]]]
+
+    def _add_utxo(self, addr, outpoint, v, is_cb):
+        coins = self._by_address.get(addr)
+        if coins is None:
+            coins = self._by_address[addr] = {}
+        coins[outpoint] = (v, is_cb)
+
+    def _remove_utxo(self, addr, outpoint):
+        coins = self._by_address.get(addr)
+        if coins is None:
+            return
+        coins.pop(outpoint, None)
+        if not coins:
+            del self._by_address[addr]
+
+    def add_outputs(self, txid: str, outputs: TxOutputs) -> None:
+        for addr, n, v, is_cb in outputs:
+            outpoint = (txid, n)
+            self._received[outpoint] = (addr, v, is_cb)
+            if (addr, txid, n) not in self._spent:
+                self._add_utxo(addr, outpoint, v, is_cb)
+
+    def remove_outputs(self, txid: str, outputs: TxOutputs) -> None:
+        for addr, n, v, is_cb in outputs:
+            outpoint = (txid, n)
+            self._received.pop(outpoint, None)
+            self._remove_utxo(addr, outpoint)
+
+    def add_inputs(self, inputs: TxInputs) -> None:
+        for addr, prevout_hash, prevout_n, v in inputs:
+            self._spent[(addr, prevout_hash, prevout_n)] += 1
+            self._remove_utxo(addr, (prevout_hash, prevout_n))
+
+    def remove_inputs(self, inputs: TxInputs) -> None:
+        for addr, prevout_hash, prevout_n, v in inputs:
+            key = (addr, prevout_hash, prevout_n)
+            self._spent[key] -= 1
+            if self._spent[key] > 0:
+                continue
+            del self._spent[key]
+            outpoint = (intern(prevout_hash), prevout_n)
+            received = self._received.get(outpoint)
+            if received is not None and received[0] == addr:
+                self._add_utxo(addr, outpoint, received[1], received[2])
+
+    def get_output(self, outpoint: Tuple[str, int]) -> Optional[Tuple[str, int, bool]]:
+        """Returns (address, value, is_coinbase) if outpoint is an is_mine output."""
+        return self._received.get(outpoint)
+
+    def get(self, outpoint: Tuple[str, int]) -> Optional[Tuple[str, int, bool]]:
+        """Returns (address, value, is_coinbase) if outpoint is unspent."""
+        received = self._received.get(outpoint)
+        if received is None or outpoint not in self._by_address.get(received[0], ()):
+            return None
+        return received
+
+    def get_addr_utxos(self, addr: str) -> Dict[Tuple[str, int], Tuple[int, bool]]:
+        """Returns the unspent outputs of addr, as outpoint -> (value, is_coinbase).
+        The returned dict must not be modified."""
+        return self._by_address.get(addr, {})
+
+    def addresses(self) -> Iterable[str]:
+        """The addresses that have unspent outputs."""
+        return self._by_address.keys()
+
+    def __len__(self):
+        return sum(len(coins) for coins in self._by_address.values())
+
+
+class SpendGraph:
+    """Which transaction spends which outpoint.
+
+    This is a graph between the transactions of a wallet: the edges from
+    a parent to its children are the spent outputs of the parent, and for
+    each child, the outpoints it spends are kept too, so that a transaction
+    can be removed without looking at its inputs.
+    """
+
+    def __init__(self, spent_outpoints: Dict[str, Dict[int, str]] = None):
+        # prevout_hash -> prevout_n -> spending txid
+        self._spender = {}  # type: Dict[str, Dict[int, str]]
+        # txid -> [(prevout_hash, prevout_n)] it spends
+        self._spends = {}  # type: Dict[str, list]
+        for prevout_hash, d in (spent_outpoints or {}).items():
+            for prevout_n, txid in d.items():
+                self.add_spend(txid, prevout_hash, prevout_n)
+
+    def add_spend(self, txid: str, prevout_hash: str, prevout_n: int) -> None:
+        spent = self._spender.get(prevout_hash)
+        if spent is None:
+            spent = self._spender[prevout_hash] = {}
+        old_txid = spent.get(prevout_n)
+        if old_txid == txid:
+            return
+        if old_txid is not None:
+            self._spends[old_txid].remove((prevout_hash, prevout_n))
+        spent[prevout_n] = txid
+        self._spends.setdefault(txid, []).append((prevout_hash, prevout_n))
+
+    def remove_spends(self, txid: str) -> None:
+        """Forgets the outpoints spent by txid."""
+        for prevout_hash, prevout_n in self._spends.pop(txid, ()):
+            spent = self._spender[prevout_hash]
+            del spent[prevout_n]
+            if not spent:
+                del self._spender[prevout_hash]
+
+    def get_spender(self, prevout_hash: str, prevout_n: int) -> Optional[str]:
+        spent = self._spender.get(prevout_hash)
+        return spent.get(prevout_n) if spent else None
+
+    def get_children(self, txid: str) -> Set[str]:
+        return set(self._spender.get(txid, {}).values())
+
+    def get_descendants(self, txids: Iterable[str]) -> Set[str]:
+        """Returns all (grand-)children of the given transactions.
+        Each transaction is visited once, however many paths lead to it."""
+        descendants = set()
+        todo = list(txids)
+        while todo:
+            spent = self._spender.get(todo.pop())
+            if not spent:
+                continue
+            for child in spent.values():
+                if child not in descendants:
+                    descendants.add(child)
+                    todo.append(child)
+        return descendants
+
+    def to_dict(self) -> Dict[str, Dict[int, str]]:
+        return self._spender
+
+
+class VerifiedTxIndex:
+    """txid -> TxMinedInfo of the verified transactions, without conf.
+
+    The records are packed into arrays, one slot per transaction, and
+    indexed by height so that a reorg only looks at the transactions
+    above the fork point.
+    """
+
+    _HASH_SIZE = 32
+    _NO_HASH = bytes(_HASH_SIZE)
+
+    def __init__(self, items: Iterable[Tuple[str, Tuple[int, int, int, str]]] = ()):
+        self._slots = {}  # type: Dict[str, int]
+        self._txids = []  # type: List[Optional[str]]
+        self._free = []  # type: List[int]
+        self._heights = array('l')
+        # None is stored as -1
+        self._timestamps = array('q')
+        self._txpos = array('l')
+        # None is stored as zeros
+        self._header_hashes = bytearray()
+        # height << 32 | slot, sorted
+        self._keys = array('q')
+        for txid, (height, timestamp, txpos, header_hash) in items:
+            self._add(txid, height, timestamp, txpos, header_hash)
+
+    def _add(self, txid, height, timestamp, txpos, header_hash):
+        slot = self._slots.get(txid)
+        if slot is not None:
+            self._remove_key(slot)
+        elif self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._txids)
+            self._txids.append(None)
+            self._heights.append(0)
+            self._timestamps.append(0)
+            self._txpos.append(0)
+            self._header_hashes += self._NO_HASH
+        txid = intern(txid)
+        self._slots[txid] = slot
+        self._txids[slot] = txid
+        self._heights[slot] = height
+        self._timestamps[slot] = timestamp if timestamp is not None else -1
+        self._txpos[slot] = txpos if txpos is not None else -1
+        i = slot * self._HASH_SIZE
+        self._header_hashes[i:i + self._HASH_SIZE] = bfh(header_hash) if header_hash else self._NO_HASH
+        key = height << 32 | slot
+        keys = self._keys
+        if not keys or keys[-1] < key:
+            keys.append(key)
+        else:
+            keys.insert(bisect.bisect_left(keys, key), key)
+
+    def _remove_key(self, slot):
+        keys = self._keys
+        del keys[bisect.bisect_left(keys, self._heights[slot] << 32 | slot)]
+
+    def _header_hash(self, slot):
+        i = slot * self._HASH_SIZE
+        h = self._header_hashes[i:i + self._HASH_SIZE]
+        return bh2u(h) if h != self._NO_HASH else None
+
+    def _info(self, slot):
+        timestamp = self._timestamps[slot]
+        txpos = self._txpos[slot]
+        return TxMinedInfo(height=self._heights[slot], conf=None,
+                           timestamp=timestamp if timestamp != -1 else None,
+                           txpos=txpos if txpos != -1 else None,
+                           header_hash=self._header_hash(slot))
+
+    def __setitem__(self, txid: str, info: TxMinedInfo) -> None:
+        self._add(txid, info.height, info.timestamp, info.txpos, info.header_hash)
+
+    def __getitem__(self, txid: str) -> TxMinedInfo:
+        return self._info(self._slots[txid])
+
+    def get(self, txid: str, default=None) -> Optional[TxMinedInfo]:
+        slot = self._slots.get(txid)
+        return self._info(slot) if slot is not None else default
+
+    def get_height(self, txid: str) -> Optional[int]:
+        slot = self._slots.get(txid)
+        return self._heights[slot] if slot is not None else None
+
+    _NO_DEFAULT = object()
+
+    def pop(self, txid: str, default=_NO_DEFAULT) -> Optional[TxMinedInfo]:
+        slot = self._slots.pop(txid, None)
+        if slot is None:
+            if default is self._NO_DEFAULT:
+                raise KeyError(txid)
+            return default
+        info = self._info(slot)
+        self._remove_key(slot)
+        self._txids[slot] = None
+        self._free.append(slot)
+        return info
+
+    def __contains__(self, txid) -> bool:
+        return txid in self._slots
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._slots)
+
+    def items(self) -> Iterator[Tuple[str, TxMinedInfo]]:
+        for txid, slot in list(self._slots.items()):
+            yield txid, self._info(slot)
+
+    def items_from_height(self, height: int) -> List[Tuple[str, TxMinedInfo]]:
+        """The transactions at height or above, by height."""
+        keys = self._keys
+        start = bisect.bisect_left(keys, height << 32)
+        mask = (1 << 32) - 1
+        return [(self._txids[key & mask], self._info(key & mask)) for key in keys[start:]]
+
+    def to_dict(self) -> Dict[str, Tuple[int, int, int, str]]:
+        out = {}
+        for txid, slot in self._slots.items():
+            info = self._info(slot)
+            out[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
+        return out
+
+
+class _FenwickTree:
+    """Prefix sums over a list of numbers, with O(log n) updates."""
+
+    def __init__(self, values: Iterable[int] = ()):
+        self.rebuild(values)
+
+    def rebuild(self, values: Iterable[int]) -> None:
+        tree = [0] + list(values)
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def add(self, i: int, value: int) -> None:
+        tree = self._tree
+        i += 1
+        while i < len(tree):
+            tree[i] += value
+            i += i & -i
+
+    def prefix_sum(self, i: int) -> int:
+        """Sum of the values before index i."""
+        s = 0
+        tree = self._tree
+        while i > 0:
+            s += tree[i]
+            i -= i & -i
+        return s
+
+    def search(self, target: int) -> Tuple[int, int]:
+        """For non-negative values: returns the index i such that
+        prefix_sum(i) <= target < prefix_sum(i+1), and prefix_sum(i)."""
+        tree = self._tree
+        i = 0
+        s = 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            j = i + step
+            if j < len(tree) and s + tree[j] <= target:
+                i = j
+                s += tree[j]
+            step >>= 1
+        return i, s
+
+
+class HistoryIndex:
+    """The transactions of a wallet in history order, with their deltas,
+    and the balance after each of them.
+
+    Transactions are sorted by key (any sortable, e.g. height and position
+    in block). They are kept in blocks of bounded size; Fenwick trees over
+    the blocks give the number of transactions and the sum of the deltas
+    before each block. Adding, removing or moving a transaction costs
+    O(log n), and the balance at any position is computed without walking
+    the history.
+
+    For queries by time, arrays over the history positions are kept: the
+    running maximum and the minimum of the remaining timestamps, both
+    sorted, and the balances. They are recomputed from the first position
+    that changed, which is usually near the end of the history.
+    """
+
+    BLOCK_SIZE = 256
+
+    def __init__(self):
+        self.rebuild([])
+
+    def rebuild(self, items: Iterable[Tuple[str, object, int, Optional[int]]]) -> None:
+        """Replaces the contents with items: (txid, key, delta, timestamp)."""
+        self._entries = {}  # txid -> (key, delta, timestamp)
+        for txid, key, delta, timestamp in items:
+            self._entries[txid] = (key, delta, timestamp)
+        keys = sorted((key, txid) for txid, (key, delta, timestamp) in self._entries.items())
+        half = self.BLOCK_SIZE // 2
+        self._blocks = [keys[i:i + half] for i in range(0, len(keys), half)] or [[]]
+        self._reindex()
+        # time index, valid for the positions before _time_valid
+        self._txids = []  # type: List[str]
+        self._max_timestamps = []  # type: List[float]
+        self._min_timestamps = []  # type: List[float]
+        self._balances = []  # type: List[int]
+        self._no_timestamp = []  # type: List[int]
+        self._time_valid = 0
+
+    def _reindex(self) -> None:
+        self._maxes = [block[-1] if block else None for block in self._blocks]
+        self._counts = _FenwickTree(len(block) for block in self._blocks)
+        self._sums = _FenwickTree(sum(self._entries[txid][1] for key, txid in block)
+                                  for block in self._blocks)
+
+    def _find_block(self, item) -> int:
+        i = bisect.bisect_left(self._maxes, item) if self._maxes[-1] is not None else 0
+        return min(i, len(self._blocks) - 1)
+
+    def _changed_at(self, i: int, j: int) -> None:
+        # the entry at index j of block i was added or removed
+        self._time_valid = min(self._time_valid, self._counts.prefix_sum(i) + j)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, txid):
+        return txid in self._entries
+
+    def get(self, txid: str) -> Optional[Tuple[object, int, Optional[int]]]:
+        return self._entries.get(txid)
+
+    def total(self) -> int:
+        return self._sums.prefix_sum(len(self._blocks))
+
+    def add(self, txid: str, key, delta: int, timestamp: Optional[int]) -> None:
+        """Adds txid, or moves it if it is already there."""
+        if txid in self._entries:
+            if self._entries[txid] == (key, delta, timestamp):
+                return
+            self.remove(txid)
+        self._entries[txid] = (key, delta, timestamp)
+        item = (key, txid)
+        i = self._find_block(item)
+        block = self._blocks[i]
+        j = bisect.bisect_left(block, item)
+        block.insert(j, item)
+        self._maxes[i] = block[-1]
+        self._changed_at(i, j)
+        self._counts.add(i, 1)
+        self._sums.add(i, delta)
+        if len(block) > self.BLOCK_SIZE:
+            half = len(block) // 2
+            self._blocks[i:i + 1] = [block[:half], block[half:]]
+            self._reindex()
+
+    def remove(self, txid: str) -> None:
+        entry = self._entries.pop(txid, None)
+        if entry is None:
+            return
+        key, delta, timestamp = entry
+        item = (key, txid)
+        i = self._find_block(item)
+        block = self._blocks[i]
+        j = bisect.bisect_left(block, item)
+        del block[j]
+        self._changed_at(i, j)
+        self._counts.add(i, -1)
+        self._sums.add(i, -delta)
+        if not block and len(self._blocks) > 1:
+            del self._blocks[i]
+            self._reindex()
+        else:
+            self._maxes[i] = block[-1] if block else None
+
+    def items(self, start: int = 0, stop: int = None) -> Iterator[Tuple[str, int, int]]:
+        """Yields (txid, delta, balance) for the transactions at positions
+        start to stop, where balance is the balance after the transaction."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return
+        i, pos = self._counts.search(start)
+        balance = self._sums.prefix_sum(i)
+        block = self._blocks[i]
+        balance += sum(self._entries[txid][1] for key, txid in block[:start - pos])
+        j = start - pos
+        for n in range(start, stop):
+            while j >= len(block):
+                i += 1
+                block = self._blocks[i]
+                j = 0
+            txid = block[j][1]
+            balance += self._entries[txid][1]
+            yield txid, self._entries[txid][1], balance
+            j += 1
+
+    def _update_time_index(self) -> None:
+        p = self._time_valid
+        n = len(self)
+        if p == n and len(self._txids) == n:
+            return
+        del self._txids[p:]
+        del self._max_timestamps[p:]
+        del self._balances[p:]
+        self._no_timestamp = self._no_timestamp[:bisect.bisect_left(self._no_timestamp, p)]
+        max_t = self._max_timestamps[-1] if p else -math.inf
+        for pos, (txid, delta, balance) in enumerate(self.items(p), start=p):
+            t = self._entries[txid][2]
+            if t is None:
+                self._no_timestamp.append(pos)
+            else:
+                max_t = max(max_t, t)
+            self._txids.append(txid)
+            self._max_timestamps.append(max_t)
+            self._balances.append(balance)
+        # the minimum of the remaining timestamps, computed backwards,
+        # until it is the same as before
+        min_timestamps = self._min_timestamps[:p] + [None] * (n - p)
+        min_t = math.inf
+        for pos in range(n - 1, -1, -1):
+            t = self._entries[self._txids[pos]][2]
+            if t is not None:
+                min_t = min(min_t, t)
+            if pos < p and min_timestamps[pos] == min_t:
+                break
+            min_timestamps[pos] = min_t
+        self._min_timestamps = min_timestamps
+        self._time_valid = n
+
+    def balance_at_timestamp(self, timestamp: int) -> int:
+        """The balance before the first transaction later than timestamp.
+        Transactions without timestamp count as later."""
+        self._update_time_index()
+        if self._no_timestamp:
+            n = min(bisect.bisect_right(self._max_timestamps, timestamp), self._no_timestamp[0])
+        else:
+            n = bisect.bisect_right(self._max_timestamps, timestamp)
+        return self._balances[n - 1] if n else 0
+
+    def items_between(self, from_timestamp: int = None, to_timestamp: int = None,
+                      now: int = None) -> Iterator[Tuple[str, int, int]]:
+        """Yields (txid, delta, balance) for the transactions with
+        from_timestamp <= timestamp < to_timestamp, in history order.
+        Transactions without timestamp count as happening at now."""
+        def in_range(t):
+            return ((from_timestamp is None or t >= from_timestamp)
+                    and (to_timestamp is None or t < to_timestamp))
+        self._update_time_index()
+        # the transactions before start are all earlier than from_timestamp,
+        # the ones from stop on are all later than to_timestamp
+        start = 0 if from_timestamp is None else bisect.bisect_left(self._max_timestamps, from_timestamp)
+        stop = len(self) if to_timestamp is None else bisect.bisect_left(self._min_timestamps, to_timestamp)
+        positions = range(start, max(start, stop))
+        if now is not None and in_range(now):
+            extra = [pos for pos in self._no_timestamp if not start <= pos < stop]
+            if extra:
+                positions = sorted(set(positions) | set(extra))
+        balances = self._balances
+        for pos in positions:
+            txid = self._txids[pos]
+            t = self._entries[txid][2]
+            if t is None:
+                t = now
+            if t is not None and in_range(t):
+                yield txid, balances[pos] - (balances[pos - 1] if pos else 0), balances[pos]
+
+
+class CostBasis:
+    """Fiat acquisition cost of the coins of a wallet, in one currency.
+
+    A coin received from outside the wallet is acquired at the fiat value
+    the user set for its transaction, or else at the exchange rate of the
+    time. A transaction spending coins of the wallet passes the cost of
+    its inputs on to its outputs, pro rata of value.
+
+    The price per coin of each transaction is computed once, parents
+    first, and kept until the transaction or one of its ancestors changes,
+    or the exchange rate it was acquired at does.
+    """
+
+    def __init__(self, get_inputs: Callable[[str], Iterable[Tuple[str, str, int, int]]],
+                 get_fiat_value: Callable[[str], Optional[Decimal]],
+                 get_descendants: Callable[[Iterable[str]], Set[str]]):
+        # txid -> the txi records of the transaction
+        self._get_inputs = get_inputs
+        # txid -> fiat value set by the user, or None
+        self._get_fiat_value = get_fiat_value
+        self._get_descendants = get_descendants
+        # txid -> (price per coin, or the cost of any of its coins)
+        self._prices = {}  # type: Dict[str, Tuple[Optional[Decimal], Optional[Decimal]]]
+        # txid -> exchange rate, for the coins acquired at the exchange rate
+        self._rates = {}  # type: Dict[str, Decimal]
+        self._check_rates = False
+
+    def coin_cost(self, txid: str, value: Optional[int], get_rate: Callable[[str], Decimal]) -> Decimal:
+        """Acquisition cost of value satoshis of the outputs of txid.
+        get_rate(txid) is the exchange rate when txid was mined."""
+        if value is None:
+            return Decimal('NaN')
+        self._update(txid, get_rate)
+        return self._coin_cost(txid, value)
+
+    def average_price(self, txid: str, get_rate: Callable[[str], Decimal]) -> Decimal:
+        """Average acquisition price of the inputs of txid, per coin."""
+        self._update(txid, get_rate)
+        return self._prices[txid][0]
+
+    def invalidate(self, txids: Iterable[str]) -> None:
+        """The inputs, the fiat value or the time of txids changed."""
+        changed = [txid for txid in txids if txid in self._prices]
+        if not changed:
+            return
+        # nothing that was computed can depend on a transaction that was not
+        for txid in self._get_descendants(changed).union(changed):
+            self._prices.pop(txid, None)
+            self._rates.pop(txid, None)
+
+    def rates_changed(self) -> None:
+        """New exchange rates are available; the rates used so far are
+        compared to them on the next query."""
+        self._check_rates = True
+
+    def _coin_cost(self, txid, value):
+        price, cost = self._prices[txid]
+        if cost is not None:
+            return cost
+        return price * value / Decimal(COIN)
+
+    def _update(self, txid, get_rate):
+        if self._check_rates:
+            self._check_rates = False
+            self.invalidate([txid2 for txid2, rate in self._rates.items() if get_rate(txid2) != rate])
+        if txid in self._prices:
+            return
+        # compute the missing ancestors first, without recursion
+        todo = [txid]
+        while todo:
+            txid = todo[-1]
+            if txid in self._prices:
+                todo.pop()
+                continue
+            inputs = self._get_inputs(txid)
+            missing = [prevout_hash for addr, prevout_hash, prevout_n, v in inputs
+                       if prevout_hash not in self._prices]
+            if missing:
+                todo.extend(missing)
+                continue
+            todo.pop()
+            if inputs:
+                input_value = 0
+                total_price = 0
+                for addr, prevout_hash, prevout_n, v in inputs:
+                    input_value += v
+                    total_price += self._coin_cost(prevout_hash, v)
+                self._prices[txid] = total_price / (input_value/Decimal(COIN)), None
+            else:
+                fiat_value = self._get_fiat_value(txid)
+                if fiat_value is not None:
+                    self._prices[txid] = None, fiat_value
+                else:
+                    rate = get_rate(txid)
+                    self._rates[txid] = rate
+                    self._prices[txid] = rate, None
@@ -42,13 +42,13 @@ from . import bip32
 from .i18n import _
 from .transaction import Transaction, multisig_script, TxOutput
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
-from .synchronizer import Notifier
-from .storage import WalletStorage
+from .storage import WalletStorage, STORAGE_BACKEND_SQLITE
 from . import keystore
 from .wallet import Wallet, Imported_Wallet, Abstract_Wallet
 from .mnemonic import Mnemonic
 
 if TYPE_CHECKING:
+    from .daemon import Daemon
     from .network import Network
     from .simple_config import SimpleConfig
 
@@ -103,10 +103,11 @@ def command(s):
 class Commands:
 
     def __init__(self, config: 'SimpleConfig', wallet: Abstract_Wallet,
-                 network: Optional['Network'], callback=None):
+                 network: Optional['Network'], callback=None, *, daemon: 'Daemon' = None):
         self.config = config
         self.wallet = wallet
         self.network = network
+        self.daemon = daemon
         self._callback = callback
 
     def _run(self, method, args, password_getter):
@@ -135,9 +136,11 @@ class Commands:
         return ' '.join(sorted(known_commands.keys()))
 
     @command('')
-    def create(self, passphrase=None, password=None, encrypt_file=True, segwit=False):
+    def create(self, passphrase=None, password=None, encrypt_file=True, segwit=False, sqlite=False):
         """Create a new wallet"""
-        storage = WalletStorage(self.config.get_wallet_path())
+        if sqlite and password and encrypt_file:
+            raise Exception("Storage encryption is not supported with SQLite. Use --encrypt_file=false")
+        storage = WalletStorage(self.config.get_wallet_path(), backend=STORAGE_BACKEND_SQLITE if sqlite else None)
         if storage.file_exists():
             raise Exception("Remove the existing wallet first!")
 
@@ -155,12 +158,14 @@ class Commands:
         return {'seed': seed, 'path': wallet.storage.path, 'msg': msg}
 
     @command('')
-    def restore(self, text, passphrase=None, password=None, encrypt_file=True):
+    def restore(self, text, passphrase=None, password=None, encrypt_file=True, sqlite=False):
         """Restore a wallet from text. Text can be a seed phrase, a master
         public key, a master private key, a list of bitcoin addresses
         or bitcoin private keys. If you want to be prompted for your
         seed, type '?' or ':' (concealed) """
-        storage = WalletStorage(self.config.get_wallet_path())
+        if sqlite and password and encrypt_file:
+            raise Exception("Storage encryption is not supported with SQLite. Use --encrypt_file=false")
+        storage = WalletStorage(self.config.get_wallet_path(), backend=STORAGE_BACKEND_SQLITE if sqlite else None)
         if storage.file_exists():
             raise Exception("Remove the existing wallet first!")
 
@@ -210,6 +215,43 @@ class Commands:
         wallet.storage.write()
         return {'path': wallet.storage.path, 'msg': msg}
 
+    @command('')
+    def convert_to_sqlite(self):
+        """Convert the wallet file to an SQLite database. The wallet must not
+        be loaded, and storage encryption is not supported."""
+        path = self.config.get_wallet_path()
+        if (self.daemon and self.daemon.get_wallet(path)) or (self.wallet and self.wallet.storage.path == path):
+            # its next save would overwrite the converted file
+            raise Exception("Close the wallet first")
+        storage = WalletStorage(path)
+        if not storage.file_exists():
+            raise Exception("Wallet file not found")
+        if storage.is_encrypted():
+            raise Exception("Remove the storage password first")
+        storage = storage.convert_to_sqlite()
+        return {'path': storage.path}
+
+    @command('w')
+    def set_journal(self, enabled):
+        """Enable or disable journaled writes. With a journal, saving the
+        wallet appends the changes to a file next to it instead of
+        rewriting the whole wallet file. Not available with SQLite."""
+        self.wallet.storage.set_journal_enabled(enabled)
+        self.wallet.storage.write()
+        return {'journal': self.wallet.storage.use_journal}
+
+    @command('w')
+    def set_stream_encryption(self, enabled):
+        """Switch an encrypted wallet file to the streamed encryption format,
+        which is faster for large wallets, or back to the default format.
+        Wallet files in the streamed format cannot be opened by older
+        versions of Electrum."""
+        if enabled and not self.wallet.storage.is_encrypted():
+            raise Exception("The wallet file is not encrypted")
+        self.wallet.storage.set_stream_encryption(enabled)
+        self.wallet.storage.write()
+        return {'stream_encryption': enabled}
+
     @command('wp')
     def password(self, password=None, new_password=None):
         """Change wallet password. """
@@ -730,12 +772,20 @@ class Commands:
 
     @command('n')
     def notify(self, address: str, URL: str):
-        """Watch an address. Every time the address changes, a http POST is sent to the URL."""
-        if not hasattr(self, "_notifier"):
-            self._notifier = Notifier(self.network)
-        self.network.run_from_another_thread(self._notifier.start_watching_queue.put((address, URL)))
+        """Watch an address. Every time the address changes, a http POST is sent to the URL.
+        The address is watched again when the daemon is restarted."""
+        notifier = self.network.get_notifier()
+        self.network.run_from_another_thread(notifier.watch(address, URL))
         return True
 
+    @command('n')
+    def notifier_stats(self):
+        """Statistics of the notifications sent for the 'notify' command.
+        Latencies are in seconds, from the status change to the delivery."""
+        if self.network.notifier is None:
+            return None
+        return self.network.run_from_another_thread(self.network.notifier.get_stats())
+
     @command('wn')
     def is_synchronized(self):
         """ return wallet synchronization status """
@@ -792,6 +842,7 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in BTC).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'enabled': 'true or false',
 }
 
 command_options = {
@@ -812,6 +863,7 @@ command_options = {
     'change_addr': ("-c", "Change address. Default is a spare address, or the source address if it's not in the wallet"),
     'nbits':       (None, "Number of bits of entropy"),
     'segwit':      (None, "Create segwit seed"),
+    'sqlite':      (None, "Store the wallet in an SQLite database (no storage encryption)"),
     'language':    ("-L", "Default language for wordlist"),
     'passphrase':  (None, "Seed extension"),
     'privkey':     (None, "Private key. Set to '?' to get a prompt."),
@@ -854,6 +906,7 @@ arg_types = {
     'fee_method': str,
     'fee_level': json_loads,
     'encrypt_file': eval_bool,
+    'enabled': eval_bool,
 }
 
 config_variables = {
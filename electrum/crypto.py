@@ -91,6 +91,77 @@ def aes_decrypt_with_iv(key: bytes, iv: bytes, data: bytes) -> bytes:
         raise InvalidPassword()
 
 
+class AESCBCEncrypter:
+    """Incremental AES-CBC encryption, with PKCS7 padding added
+    in finalize(). Encrypting in pieces gives the same ciphertext
+    as aes_encrypt_with_iv() on the concatenation.
+    """
+
+    def __init__(self, key: bytes, iv: bytes):
+        assert_bytes(key, iv)
+        if AES:
+            self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        else:
+            aes_cbc = pyaes.AESModeOfOperationCBC(key, iv=iv)
+            self._cipher = pyaes.Encrypter(aes_cbc, padding=pyaes.PADDING_NONE)
+        self._buffer = b''
+
+    def _encrypt(self, data: bytes) -> bytes:
+        if AES:
+            return self._cipher.encrypt(data)
+        return self._cipher.feed(data)
+
+    def update(self, data: bytes) -> bytes:
+        assert_bytes(data)
+        data = self._buffer + data
+        n = len(data) - len(data) % 16
+        self._buffer = data[n:]
+        return self._encrypt(data[:n])
+
+    def finalize(self) -> bytes:
+        e = self._encrypt(append_PKCS7_padding(self._buffer))
+        if not AES:
+            e += self._cipher.feed()  # empty feed() flushes buffer
+        return e
+
+
+class AESCBCDecrypter:
+    """Incremental counterpart of aes_decrypt_with_iv().
+    The last block is held back until finalize(), which strips the padding.
+    """
+
+    def __init__(self, key: bytes, iv: bytes):
+        assert_bytes(key, iv)
+        if AES:
+            self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        else:
+            aes_cbc = pyaes.AESModeOfOperationCBC(key, iv=iv)
+            self._cipher = pyaes.Decrypter(aes_cbc, padding=pyaes.PADDING_NONE)
+        self._buffer = b''
+
+    def _decrypt(self, data: bytes) -> bytes:
+        if AES:
+            return self._cipher.decrypt(data)
+        return self._cipher.feed(data)
+
+    def update(self, data: bytes) -> bytes:
+        assert_bytes(data)
+        data = self._buffer + data
+        n = (len(data) - 1) // 16 * 16 if data else 0
+        self._buffer = data[n:]
+        return self._decrypt(data[:n])
+
+    def finalize(self) -> bytes:
+        data = self._decrypt(self._buffer)
+        if not AES:
+            data += self._cipher.feed()  # empty feed() flushes buffer
+        self._buffer = b''
+        try:
+            return strip_PKCS7_padding(data)
+        except InvalidPadding:
+            raise InvalidPassword()
+
+
 def EncodeAES_base64(secret: bytes, msg: bytes) -> bytes:
     """Returns base64 encoded ciphertext."""
     e = EncodeAES_bytes(secret, msg)
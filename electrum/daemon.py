@@ -43,6 +43,7 @@ from .storage import WalletStorage
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
+from .synchronizer import watch_list_path
 from .plugin import run_hook
 
 
@@ -137,6 +138,9 @@ class Daemon(DaemonThread):
         self.fx = FxThread(config, self.network)
         if self.network:
             self.network.start([self.fx.run])
+            # keep watching the addresses of the 'notify' command
+            if os.path.exists(watch_list_path(config)):
+                self.network.get_notifier()
         self.gui = None
         self.wallets = {}  # type: Dict[str, Abstract_Wallet]
         # Setup JSONRPC server
@@ -164,7 +168,7 @@ class Daemon(DaemonThread):
         server.register_function(self.ping, 'ping')
         server.register_function(self.run_gui, 'gui')
         server.register_function(self.run_daemon, 'daemon')
-        self.cmd_runner = Commands(self.config, None, self.network)
+        self.cmd_runner = Commands(self.config, None, self.network, daemon=self)
         for cmdname in known_commands:
             server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
         server.register_function(self.run_cmdline, 'run_cmdline')
@@ -292,7 +296,7 @@ class Daemon(DaemonThread):
         kwargs = {}
         for x in cmd.options:
             kwargs[x] = (config_options.get(x) if x in ['password', 'new_password'] else config.get(x))
-        cmd_runner = Commands(config, wallet, self.network)
+        cmd_runner = Commands(config, wallet, self.network, daemon=self)
         func = getattr(cmd_runner, cmd.name)
         try:
             result = func(*args, **kwargs)
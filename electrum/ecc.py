@@ -275,19 +275,24 @@ class ECPubkey(object):
         """
         assert_bytes(message)
 
-        randint = ecdsa.util.randrange(CURVE_ORDER)
-        ephemeral_exponent = number_to_string(randint, CURVE_ORDER)
-        ephemeral = ECPrivkey(ephemeral_exponent)
-        ecdh_key = (self * ephemeral.secret_scalar).get_public_key_bytes(compressed=True)
-        key = hashlib.sha512(ecdh_key).digest()
-        iv, key_e, key_m = key[0:16], key[16:32], key[32:]
+        ephemeral_pubkey, (iv, key_e, key_m) = self.ecies_ephemeral_keys()
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
-        ephemeral_pubkey = ephemeral.get_public_key_bytes(compressed=True)
         encrypted = magic + ephemeral_pubkey + ciphertext
         mac = hmac_oneshot(key_m, encrypted, hashlib.sha256)
 
         return base64.b64encode(encrypted + mac)
 
+    def ecies_ephemeral_keys(self) -> Tuple[bytes, Tuple[bytes, bytes, bytes]]:
+        """Returns a new ephemeral pubkey, and the (iv, key_e, key_m)
+        ECIES keys derived from it, for encrypting to this pubkey.
+        """
+        randint = ecdsa.util.randrange(CURVE_ORDER)
+        ephemeral_exponent = number_to_string(randint, CURVE_ORDER)
+        ephemeral = ECPrivkey(ephemeral_exponent)
+        ecdh_key = (self * ephemeral.secret_scalar).get_public_key_bytes(compressed=True)
+        ephemeral_pubkey = ephemeral.get_public_key_bytes(compressed=True)
+        return ephemeral_pubkey, ecies_keys_from_ecdh_key(ecdh_key)
+
     @classmethod
     def order(cls):
         return CURVE_ORDER
@@ -422,6 +427,15 @@ class ECPrivkey(ECPubkey):
         mac = encrypted[-32:]
         if magic_found != magic:
             raise Exception('invalid ciphertext: invalid magic bytes')
+        iv, key_e, key_m = self.ecies_keys_from_ephemeral_pubkey(ephemeral_pubkey_bytes)
+        if mac != hmac_oneshot(key_m, encrypted[:-32], hashlib.sha256):
+            raise InvalidPassword()
+        return aes_decrypt_with_iv(key_e, iv, ciphertext)
+
+    def ecies_keys_from_ephemeral_pubkey(self, ephemeral_pubkey_bytes: bytes) -> Tuple[bytes, bytes, bytes]:
+        """Returns the (iv, key_e, key_m) ECIES keys for decrypting
+        a message that was encrypted with the given ephemeral pubkey.
+        """
         try:
             ecdsa_point = _ser_to_python_ecdsa_point(ephemeral_pubkey_bytes)
         except AssertionError as e:
@@ -430,11 +444,12 @@ class ECPrivkey(ECPubkey):
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
         ephemeral_pubkey = ECPubkey.from_point(ecdsa_point)
         ecdh_key = (ephemeral_pubkey * self.secret_scalar).get_public_key_bytes(compressed=True)
-        key = hashlib.sha512(ecdh_key).digest()
-        iv, key_e, key_m = key[0:16], key[16:32], key[32:]
-        if mac != hmac_oneshot(key_m, encrypted[:-32], hashlib.sha256):
-            raise InvalidPassword()
-        return aes_decrypt_with_iv(key_e, iv, ciphertext)
+        return ecies_keys_from_ecdh_key(ecdh_key)
+
+
+def ecies_keys_from_ecdh_key(ecdh_key: bytes) -> Tuple[bytes, bytes, bytes]:
+    key = hashlib.sha512(ecdh_key).digest()
+    return key[0:16], key[16:32], key[32:]
 
 
 def construct_sig65(sig_string: bytes, recid: int, is_compressed: bool) -> bytes:
@@ -510,7 +510,7 @@ class ElectrumWindow(App):
         # connect callbacks
         if self.network:
             interests = ['wallet_updated', 'network_updated', 'blockchain_updated',
-                         'status', 'new_transaction', 'verified']
+                         'status', 'new_transactions', 'verified']
             self.network.register_callback(self.on_network_event, interests)
             self.network.register_callback(self.on_fee, ['fee'])
             self.network.register_callback(self.on_fee_histogram, ['fee_histogram'])
@@ -702,7 +702,7 @@ class ElectrumWindow(App):
             self._trigger_update_wallet()
         elif event == 'status':
             self._trigger_update_status()
-        elif event == 'new_transaction':
+        elif event == 'new_transactions':
             self._trigger_update_wallet()
         elif event == 'verified':
             self._trigger_update_wallet()
@@ -736,7 +736,10 @@ class ElectrumWindow(App):
             server_height = self.network.get_server_height()
             server_lag = self.num_blocks - server_height
             if not self.wallet.up_to_date or server_height == 0:
+                num_done, num_total = self.wallet.get_sync_progress()
                 status = _("Synchronizing...")
+                if num_total:
+                    status += " ({}/{})".format(num_done, num_total)
             elif server_lag > 1:
                 status = _("Server lagging")
             else:
@@ -207,7 +207,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         if self.network:
             self.network_signal.connect(self.on_network_qt)
             interests = ['wallet_updated', 'network_updated', 'blockchain_updated',
-                         'new_transaction', 'status',
+                         'new_transactions', 'status',
                          'banner', 'verified', 'fee', 'fee_histogram']
             # To avoid leaking references to "self" that prevent the
             # window from being GC-ed when closed, callbacks should be
@@ -353,10 +353,11 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         elif event == 'blockchain_updated':
             # to update number of confirmations in history
             self.need_update.set()
-        elif event == 'new_transaction':
-            wallet, tx = args
+        elif event == 'new_transactions':
+            wallet, txs = args
             if wallet == self.wallet:
-                self.tx_notification_queue.put(tx)
+                for tx in txs:
+                    self.tx_notification_queue.put(tx)
         elif event in ['status', 'banner', 'verified', 'fee', 'fee_histogram']:
             # Handle in GUI thread
             self.network_signal.emit(event, args)
@@ -784,7 +785,10 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             # until we get a headers subscription request response.
             # Display the synchronizing message in that case.
             if not self.wallet.up_to_date or server_height == 0:
+                num_done, num_total = self.wallet.get_sync_progress()
                 text = _("Synchronizing...")
+                if num_total:
+                    text += " ({}/{})".format(num_done, num_total)
                 icon = read_QIcon("status_waiting.png")
             elif server_lag > 1:
                 text = _("Server is lagging ({} blocks)").format(server_lag)
@@ -2011,7 +2015,8 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             'bitcoin': bitcoin,
         })
 
-        c = commands.Commands(self.config, self.wallet, self.network, lambda: self.console.set_json(True))
+        c = commands.Commands(self.config, self.wallet, self.network, lambda: self.console.set_json(True),
+                              daemon=self.gui_object.daemon)
         methods = {}
         def mkfunc(f, method):
             return lambda *args: f(method, args, self.password_dialog)
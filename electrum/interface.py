@@ -69,7 +69,11 @@ class NotificationSession(RPCSession):
         super(NotificationSession, self).__init__(*args, **kwargs)
         self.subscriptions = defaultdict(list)
         self.cache = {}
-        self.in_flight_requests_semaphore = asyncio.Semaphore(100)
+        self.max_in_flight_requests = 100
+        self.in_flight_requests_semaphore = asyncio.Semaphore(self.max_in_flight_requests)
+        # batches take their slots of the semaphore one at a time;
+        # this lock prevents two batches from deadlocking each other
+        self._batch_slots_lock = asyncio.Lock()
         self.default_timeout = NetworkTimeout.Generic.NORMAL
 
     async def handle_request(self, request):
@@ -98,6 +102,41 @@ class NotificationSession(RPCSession):
             except asyncio.TimeoutError as e:
                 raise RequestTimedOut('request timed out: {}'.format(args)) from e
 
+    async def send_batch_request(self, method: str, params_list: List[List], *, timeout=None) -> List:
+        """Sends a JSON-RPC batch request, calling 'method' once for
+        each params in params_list. Returns the results in order.
+        Each call in the batch counts against the in-flight requests limit.
+        """
+        n = len(params_list)
+        if not 0 < n <= self.max_in_flight_requests:
+            raise ValueError(f'invalid batch size: {n}')
+        if timeout is None:
+            timeout = self.default_timeout
+
+        async def send_batch():
+            async with self.send_batch() as batch:
+                for params in params_list:
+                    batch.add_request(method, params)
+            return batch.results
+
+        acquired = 0
+        try:
+            async with self._batch_slots_lock:
+                while acquired < n:
+                    await self.in_flight_requests_semaphore.acquire()
+                    acquired += 1
+            try:
+                results = await asyncio.wait_for(send_batch(), timeout)
+            except asyncio.TimeoutError as e:
+                raise RequestTimedOut('batch request timed out: {} x{}'.format(method, n)) from e
+        finally:
+            for _ in range(acquired):
+                self.in_flight_requests_semaphore.release()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return list(results)
+
     async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
         # note: until the cache is written for the first time,
         # each 'subscribe' call might make a request on the network.
@@ -110,6 +149,29 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_batch(self, method: str, params_list: List[List], queue: asyncio.Queue):
+        """Like subscribe, for several params at once. Subscriptions
+        that are not cached are sent in batch requests.
+        """
+        to_request = []
+        for params in params_list:
+            key = self.get_hashable_key_for_rpc_call(method, params)
+            self.subscriptions[key].append(queue)
+            if key in self.cache:
+                await queue.put(params + [self.cache[key]])
+            else:
+                to_request.append(params)
+        for i in range(0, len(to_request), self.max_in_flight_requests):
+            chunk = to_request[i:i + self.max_in_flight_requests]
+            if len(chunk) == 1:
+                results = [await self.send_request(method, chunk[0])]
+            else:
+                results = await self.send_batch_request(method, chunk)
+            for params, result in zip(chunk, results):
+                key = self.get_hashable_key_for_rpc_call(method, params)
+                self.cache[key] = result
+                await queue.put(params + [result])
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
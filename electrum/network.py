@@ -26,19 +26,20 @@ import os
 import random
 import re
 from collections import defaultdict
+from functools import partial
 import threading
 import socket
 import json
 import sys
 import ipaddress
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple
+from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, Callable, Any, TYPE_CHECKING
 import traceback
 
 import dns
 import dns.resolver
 import aiorpcx
-from aiorpcx import TaskGroup
+from aiorpcx import TaskGroup, run_in_thread
 from aiohttp import ClientResponse
 
 from . import util
@@ -52,12 +53,20 @@ from . import bitcoin
 from .blockchain import Blockchain, HEADER_SIZE
 from .interface import (Interface, serialize_server, deserialize_server,
                         RequestTimedOut, NetworkTimeout)
+from .transaction import Transaction
+from .tx_cache import TxCache, TX_CACHE_MEMORY_SIZE
 from .version import PROTOCOL_VERSION
 from .simple_config import SimpleConfig
 from .i18n import _
 
+if TYPE_CHECKING:
+    from .synchronizer import Notifier
+
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# see request_from_any_interface
+FETCH_MAX_TRIES = 3
+FETCH_MAX_INVALID_ANSWERS = 3
 
 
 def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
@@ -252,6 +261,18 @@ class Network(PrintError):
         dir_path = os.path.join(self.config.path, 'certs')
         util.make_dir(dir_path)
 
+        # raw transactions, shared by all wallets. With tx_cache_on_disk, the
+        # transactions of wallets whose file is not encrypted are also stored,
+        # unencrypted, in <datadir>/tx_cache; see Synchronizer._get_transaction
+        tx_cache_path = os.path.join(self.config.path, 'tx_cache') if self.config.get('tx_cache_on_disk', False) else None
+        self.tx_cache = TxCache(tx_cache_path, max_memory=self.config.get('tx_cache_size', TX_CACHE_MEMORY_SIZE))
+        # whether to fetch histories and transactions from all connected servers
+        self.fetch_from_all_servers = self.config.get('fetch_from_all_servers', False)
+        self._invalid_answers = defaultdict(int)  # server -> number of invalid answers
+        # watches addresses for the 'notify' command; set when first needed
+        self.notifier = None  # type: Optional[Notifier]
+        self._notifier_lock = threading.Lock()
+
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -922,11 +943,87 @@ class Network(PrintError):
     async def request_chunk(self, height, tip=None, *, can_return_early=False):
         return await self.interface.request_chunk(height, tip=tip, can_return_early=can_return_early)
 
+    async def request_from_any_interface(self, method: str, params: Sequence, is_valid: Callable[[Any], bool],
+                                         *, timeout=None) -> Optional[Any]:
+        """Sends a request to connected interfaces picked at random, until
+        one of them gives an answer that is_valid accepts. Servers that keep
+        giving invalid answers are not asked anymore.
+        Returns None if none of the interfaces tried could answer.
+        """
+        with self.interfaces_lock:
+            interfaces = [iface for server, iface in self.interfaces.items()
+                          if self._invalid_answers[server] < FETCH_MAX_INVALID_ANSWERS]
+        random.shuffle(interfaces)
+        for iface in interfaces[:FETCH_MAX_TRIES]:
+            session = iface.session
+            if session is None or session.is_closing():
+                continue
+            try:
+                result = await session.send_request(method, params, timeout=timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.print_error(f'{method} request to {iface.server} failed: {repr(e)}')
+                continue
+            try:
+                valid = is_valid(result)
+            except Exception:
+                valid = False
+            if valid:
+                return result
+            self.print_error(f'invalid answer from {iface.server} to {method} {params}')
+            self._invalid_answers[iface.server] += 1
+        return None
+
+    def get_notifier(self) -> 'Notifier':
+        """The Notifier of the 'notify' command, created when first needed."""
+        from .synchronizer import Notifier
+        with self._notifier_lock:
+            if self.notifier is None:
+                self.notifier = Notifier(self)
+            return self.notifier
+
+    async def get_transaction(self, tx_hash: str, *, timeout=None, cache_on_disk=False) -> str:
+        """cache_on_disk: whether the transaction may be written to the
+        disk store of the tx cache, i.e. it is not private to an
+        encrypted wallet."""
+        raw = self.tx_cache.get_from_memory(tx_hash)
+        if raw is None and self.tx_cache.has_disk_store():
+            # an SQLite query, off the event loop
+            raw = await run_in_thread(self.tx_cache.get, tx_hash)
+        if raw is not None:
+            return raw
+        if self.fetch_from_all_servers:
+            raw = await self.request_from_any_interface('blockchain.transaction.get', [tx_hash],
+                                                        lambda raw: Transaction(raw).txid() == tx_hash,
+                                                        timeout=timeout)
+            if raw is not None:
+                await self._put_in_tx_cache(tx_hash, raw, cache_on_disk)
+                return raw
+        raw = await self._get_transaction_from_server(tx_hash, timeout=timeout)
+        await self._add_to_tx_cache(tx_hash, raw, cache_on_disk)
+        return raw
+
     @best_effort_reliable
-    async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
+    async def _get_transaction_from_server(self, tx_hash: str, *, timeout=None) -> str:
         return await self.interface.session.send_request('blockchain.transaction.get', [tx_hash],
                                                          timeout=timeout)
 
+    async def _add_to_tx_cache(self, tx_hash: str, raw: str, on_disk: bool):
+        # the cache is shared by all wallets, so only what matches its txid goes in
+        try:
+            txid = Transaction(raw).txid()
+        except Exception:
+            return
+        if txid == tx_hash:
+            await self._put_in_tx_cache(tx_hash, raw, on_disk)
+
+    async def _put_in_tx_cache(self, tx_hash: str, raw: str, on_disk: bool):
+        if on_disk and self.tx_cache.has_disk_store():
+            await run_in_thread(partial(self.tx_cache.put, tx_hash, raw, on_disk=True))
+        else:
+            self.tx_cache.put(tx_hash, raw, on_disk=False)
+
     @best_effort_reliable
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
         return await self.interface.session.send_request('blockchain.scripthash.get_history', [sh])
@@ -1056,6 +1153,7 @@ class Network(PrintError):
         try:
             fut.result(timeout=2)
         except (asyncio.TimeoutError, asyncio.CancelledError): pass
+        self.tx_cache.close()
 
     async def _ensure_there_is_a_main_interface(self):
         if self.is_connected():
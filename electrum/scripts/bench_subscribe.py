@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Measures the time it takes to subscribe to many addresses,
+# one request per address vs. in batch requests, against a local stub server.
+# usage: bench_subscribe.py [num_addresses] [batch_size] [latency_ms]
+import asyncio
+import hashlib
+import sys
+import time
+
+import aiorpcx
+from aiorpcx import RPCSession, TaskGroup
+
+from electrum.interface import NotificationSession
+
+
+args = sys.argv[1:]
+num_addresses = int(args[0]) if len(args) > 0 else 10000
+batch_size = int(args[1]) if len(args) > 1 else 50
+latency = int(args[2]) / 1000 if len(args) > 2 else 0.05
+
+
+class StubServerSession(RPCSession):
+
+    async def handle_request(self, request):
+        if request.method == 'server.version':
+            return ['stub', '1.4']
+        if request.method == 'blockchain.scripthash.subscribe':
+            return hashlib.sha256(request.args[0].encode()).hexdigest()
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+async def relay(reader, writer):
+    """Forwards data, delayed by half the simulated round trip."""
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            loop.call_later(latency / 2, writer.write, data)
+    finally:
+        loop.call_later(latency / 2, writer.close)
+
+
+async def start_delaying_proxy(server_port):
+    async def on_connect(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection('127.0.0.1', server_port)
+        await asyncio.gather(relay(client_reader, server_writer),
+                             relay(server_reader, client_writer))
+    return await asyncio.start_server(on_connect, '127.0.0.1', 0)
+
+
+def scripthashes():
+    return [hashlib.sha256(i.to_bytes(4, 'big')).hexdigest() for i in range(num_addresses)]
+
+
+async def subscribe_one_by_one(session, queue):
+    async with TaskGroup() as group:
+        for h in scripthashes():
+            await group.spawn(session.subscribe('blockchain.scripthash.subscribe', [h], queue))
+
+
+async def subscribe_in_batches(session, queue):
+    # same flow control as SynchronizerBase.send_subscriptions
+    max_batches = max(2, session.max_in_flight_requests // batch_size)
+    batches_in_flight = asyncio.Semaphore(max_batches)
+    async def subscribe(params_list):
+        try:
+            await session.subscribe_batch('blockchain.scripthash.subscribe', params_list, queue)
+        finally:
+            batches_in_flight.release()
+    hashes = scripthashes()
+    async with TaskGroup() as group:
+        for i in range(0, len(hashes), batch_size):
+            await batches_in_flight.acquire()
+            await group.spawn(subscribe([[h] for h in hashes[i:i + batch_size]]))
+
+
+async def run(subscribe_all):
+    async with aiorpcx.Connector(NotificationSession, host='127.0.0.1', port=port) as session:
+        await session.send_request('server.version', ['bench', '1.4'])
+        queue = asyncio.Queue()
+        t0 = time.time()
+        await subscribe_all(session, queue)
+        t1 = time.time()
+        assert queue.qsize() == num_addresses
+        return t1 - t0
+
+
+async def main():
+    global port
+    server = aiorpcx.Server(StubServerSession, '127.0.0.1', 0)
+    await server.listen()
+    proxy = await start_delaying_proxy(server.server.sockets[0].getsockname()[1])
+    port = proxy.sockets[0].getsockname()[1]
+    try:
+        print(f"subscribing to {num_addresses} addresses, server latency {latency * 1000:.0f}ms")
+        dt = await run(subscribe_one_by_one)
+        print(f"one request per address: {dt:.3f}s")
+        dt = await run(subscribe_in_batches)
+        print(f"batches of {batch_size}: {dt:.3f}s")
+    finally:
+        proxy.close()
+        await server.close()
+
+
+asyncio.get_event_loop().run_until_complete(main())
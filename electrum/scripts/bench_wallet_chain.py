@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Measures conflict and dependency detection on a chain of unconfirmed
+# transactions, each spending the wallet output of its predecessor.
+# usage: bench_wallet_chain.py [chain_length]
+import os
+import sys
+import time
+import tempfile
+
+from electrum import keystore
+from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED
+from electrum.bitcoin import address_to_script
+from electrum.storage import WalletStorage
+from electrum.transaction import Transaction
+from electrum.wallet import Standard_Wallet
+
+import synthetic_wallet
+
+
+chain_length = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+runs = 10
+
+
+def measure(name, f, runs=runs):
+    t0 = time.time()
+    for i in range(runs):
+        f()
+    print(f"{name}: {(time.time() - t0) / runs * 1000:.2f} ms")
+
+
+def add_tx(wallet, raw):
+    txid = synthetic_wallet.txid_of_raw_tx(raw)
+    wallet.add_unverified_tx(txid, TX_HEIGHT_UNCONFIRMED)
+    assert wallet.add_transaction(txid, Transaction(raw))
+    return txid
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    storage = WalletStorage(os.path.join(tmpdir, 'wallet'))
+    storage.put('keystore', keystore.from_xpub(synthetic_wallet.XPUB).dump())
+    storage.put('gap_limit', 100)
+    wallet = Standard_Wallet(storage)
+    wallet.synchronize()
+    scripts = [address_to_script(addr) for addr in wallet.get_receiving_addresses()]
+
+    funding_txid = add_tx(wallet, synthetic_wallet.make_raw_tx(
+        [(synthetic_wallet.random_hash(), 0)], [(scripts[0], 10 ** 8)]))
+    chain = []
+    prev_txid, value = funding_txid, 10 ** 8
+    for i in range(chain_length):
+        value -= 1000
+        raw = synthetic_wallet.make_unsigned_raw_tx([(prev_txid, 0)], [(scripts[i % len(scripts)], value)])
+        prev_txid = add_tx(wallet, raw)
+        chain.append(prev_txid)
+    print(f"chain of {chain_length} unconfirmed transactions")
+    measure("get_depending_transactions", lambda: wallet.get_depending_transactions(chain[0]))
+    conflict_raw = synthetic_wallet.make_unsigned_raw_tx(
+        [(funding_txid, 0)], [(synthetic_wallet.EXTERNAL_SCRIPT, 10 ** 8 - 5000)])
+    tx = Transaction(conflict_raw)
+    measure("get_conflicting_transactions", lambda: wallet.get_conflicting_transactions(None, tx))
+    measure("replace chain", lambda: add_tx(wallet, conflict_raw), runs=1)
+    assert not any(txid in wallet.transactions for txid in chain)
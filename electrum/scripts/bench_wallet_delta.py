@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Measures fee and delta computation for transactions with many inputs,
+# all spending outputs of one big funding transaction.
+# usage: bench_wallet_delta.py [num_inputs]
+import os
+import sys
+import time
+import tempfile
+
+from electrum import keystore
+from electrum.bitcoin import address_to_script
+from electrum.storage import WalletStorage
+from electrum.transaction import Transaction
+from electrum.wallet import Standard_Wallet
+
+import synthetic_wallet
+
+
+num_inputs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+runs = 10
+
+
+def measure(name, f):
+    t0 = time.time()
+    for i in range(runs):
+        f()
+    print(f"{name}: {(time.time() - t0) / runs * 1000:.2f} ms")
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    storage = WalletStorage(os.path.join(tmpdir, 'wallet'))
+    storage.put('keystore', keystore.from_xpub(synthetic_wallet.XPUB).dump())
+    storage.put('gap_limit', 100)
+    wallet = Standard_Wallet(storage)
+    wallet.synchronize()
+    addresses = wallet.get_receiving_addresses()
+
+    outputs = [(address_to_script(addresses[i % len(addresses)]), 10000 + i) for i in range(num_inputs)]
+    raw = synthetic_wallet.make_raw_tx([(synthetic_wallet.random_hash(), 0)], outputs)
+    funding_txid = synthetic_wallet.txid_of_raw_tx(raw)
+    wallet.add_transaction(funding_txid, Transaction(raw))
+
+    inputs = [(funding_txid, i) for i in range(num_inputs)]
+    raw = synthetic_wallet.make_unsigned_raw_tx(inputs, [(synthetic_wallet.EXTERNAL_SCRIPT, 1000)])
+    tx = Transaction(raw)
+    tx.inputs()
+    txid = synthetic_wallet.txid_of_raw_tx(raw)
+    print(f"spending tx with {num_inputs} inputs")
+    measure("add_transaction", lambda: wallet.add_transaction(txid, tx))
+    measure("get_wallet_delta", lambda: wallet.get_wallet_delta(tx))
+    measure("txin_value", lambda: [wallet.txin_value(txin) for txin in tx.inputs()])
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Compares the base64 and the streamed encrypted wallet file formats:
+# time and peak memory to write and to decrypt a large synthetic wallet.
+# usage: bench_wallet_encryption.py [num_txs]
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+from electrum.storage import WalletStorage, STO_EV_USER_PW
+
+import synthetic_wallet
+
+
+num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+password = 'secret'
+
+
+def measure(f):
+    tracemalloc.start()
+    t0 = time.time()
+    f()
+    t = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return t, peak // (1024 * 1024)
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'wallet')
+    print(f"creating synthetic wallet with {num_txs} transactions...")
+    synthetic_wallet.create_wallet(path, num_txs=num_txs)
+    storage = WalletStorage(path)
+    storage.set_password(password, enc_version=STO_EV_USER_PW)
+    for stream in (False, True):
+        name = 'streamed' if stream else 'base64'
+        storage.set_stream_encryption(stream)
+        t_write, mem_write = measure(storage.write)
+        size = os.path.getsize(path) // 1024
+
+        def read():
+            WalletStorage(path, manual_upgrades=True).decrypt(password)
+        t_read, mem_read = measure(read)
+        print(f"{name}: file {size} KiB, write {t_write:.3f}s (peak {mem_write} MiB), "
+              f"read {t_read:.3f}s (peak {mem_read} MiB)")
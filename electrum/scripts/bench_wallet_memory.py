@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Measures the memory used by the bookkeeping structures of a large
+# synthetic wallet once it is loaded.
+# usage: bench_wallet_memory.py [num_txs]
+import os
+import sys
+import tempfile
+
+from electrum.storage import WalletStorage
+from electrum.wallet import Wallet
+
+import synthetic_wallet
+
+
+num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+
+def deep_sizeof(o, seen):
+    if id(o) in seen:
+        return 0
+    seen.add(id(o))
+    size = sys.getsizeof(o)
+    if isinstance(o, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in o.items())
+    elif isinstance(o, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(x, seen) for x in o)
+    elif hasattr(o, '__dict__'):
+        size += deep_sizeof(vars(o), seen)
+    else:
+        for cls in type(o).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(o, name):
+                    size += deep_sizeof(getattr(o, name), seen)
+    return size
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'wallet')
+    print(f"creating synthetic wallet with {num_txs} transactions...")
+    synthetic_wallet.create_wallet(path, num_txs=num_txs)
+    wallet = Wallet(WalletStorage(path))
+    # txids are shared with the transactions table, do not count them
+    seen = set(id(txid) for txid in wallet.transactions)
+    for name in ('txi', 'txo', 'spend_graph', 'history', 'verified_tx'):
+        size = deep_sizeof(getattr(wallet, name), seen)
+        print(f"{name}: {size // 1024} KiB, {size // num_txs} bytes per tx")
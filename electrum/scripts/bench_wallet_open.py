@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# Measures the time it takes to open a large synthetic wallet.
+# usage: bench_wallet_open.py [num_txs] [--sqlite]
+import os
+import sys
+import time
+import tempfile
+
+from electrum.storage import WalletStorage
+from electrum.wallet import Wallet
+
+import synthetic_wallet
+
+
+args = sys.argv[1:]
+use_sqlite = '--sqlite' in args
+if use_sqlite:
+    args.remove('--sqlite')
+num_txs = int(args[0]) if args else 50000
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'wallet')
+    print(f"creating synthetic wallet with {num_txs} transactions...")
+    synthetic_wallet.create_wallet(path, num_txs=num_txs)
+    if use_sqlite:
+        WalletStorage(path).convert_to_sqlite().close()
+    print(f"wallet file size: {os.path.getsize(path) // 1024} KiB")
+    for i in range(3):
+        t0 = time.time()
+        storage = WalletStorage(path)
+        t1 = time.time()
+        wallet = Wallet(storage)
+        t2 = time.time()
+        print(f"run {i}: storage {t1 - t0:.3f}s, wallet {t2 - t1:.3f}s, total {t2 - t0:.3f}s")
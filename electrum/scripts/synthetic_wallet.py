@@ -0,0 +1,101 @@
+"""Helpers to create large synthetic wallet files, for benchmarks."""
+
+import os
+import random
+
+from electrum import keystore
+from electrum.bitcoin import address_to_script, int_to_hex, var_int
+from electrum.bookkeeping import TxInputs, TxOutputs, serialize_spent_outpoints
+from electrum.crypto import sha256d
+from electrum.storage import WalletStorage
+from electrum.util import bh2u
+from electrum.wallet import Standard_Wallet
+
+
+XPUB = 'xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U'
+EXTERNAL_SCRIPT = '76a914' + '00' * 20 + '88ac'
+FIRST_HEIGHT = 500000
+FIRST_TIMESTAMP = 1500000000
+
+
+def random_hash() -> str:
+    return bh2u(os.urandom(32))
+
+
+def make_raw_tx(inputs, outputs) -> str:
+    """inputs: list of (prevout_hash, prevout_n); outputs: list of (script_hex, value)"""
+    s = '02000000' + var_int(len(inputs))
+    for prevout_hash, prevout_n in inputs:
+        script_sig = '47' + bh2u(os.urandom(71)) + '21' + '02' + bh2u(os.urandom(32))
+        s += bh2u(bytes.fromhex(prevout_hash)[::-1]) + int_to_hex(prevout_n, 4)
+        s += var_int(len(script_sig) // 2) + script_sig + 'fdffffff'
+    s += var_int(len(outputs))
+    for script, value in outputs:
+        s += int_to_hex(value, 8) + var_int(len(script) // 2) + script
+    return s + '00000000'
+
+
+def make_unsigned_raw_tx(inputs, outputs) -> str:
+    """like make_raw_tx, but with empty scriptSigs, so that
+    the wallet has to look up the addresses of the inputs"""
+    s = '02000000' + var_int(len(inputs))
+    for prevout_hash, prevout_n in inputs:
+        s += bh2u(bytes.fromhex(prevout_hash)[::-1]) + int_to_hex(prevout_n, 4) + '00' + 'fdffffff'
+    s += var_int(len(outputs))
+    for script, value in outputs:
+        s += int_to_hex(value, 8) + var_int(len(script) // 2) + script
+    return s + '00000000'
+
+
+def txid_of_raw_tx(raw: str) -> str:
+    return bh2u(sha256d(bytes.fromhex(raw))[::-1])
+
+
+def create_wallet(path, num_txs=50000, num_addresses=200, num_inputs=1, seed=0):
+    """Creates a watching-only wallet file with num_txs transactions.
+    Every transaction pays to one of the wallet addresses; every second
+    transaction also spends the wallet output of its predecessor.
+    """
+    random.seed(seed)
+    storage = WalletStorage(path)
+    storage.put('keystore', keystore.from_xpub(XPUB).dump())
+    storage.put('gap_limit', num_addresses)
+    wallet = Standard_Wallet(storage)
+    wallet.synchronize()
+    addresses = wallet.get_receiving_addresses()
+    scripts = {addr: address_to_script(addr) for addr in addresses}
+
+    transactions, txi, txo, spent_outpoints = {}, {}, {}, {}
+    history = {addr: [] for addr in wallet.get_addresses()}
+    verified_tx = {}
+    prev = None  # (txid, addr, value) of the last wallet output
+    for i in range(num_txs):
+        addr = addresses[i % len(addresses)]
+        value = random.randint(10000, 10 ** 8)
+        inputs = [(random_hash(), random.randint(0, 3)) for _ in range(num_inputs)]
+        spends_prev = prev is not None and i % 2 == 1
+        if spends_prev:
+            inputs[0] = (prev[0], 0)
+        raw = make_raw_tx(inputs, [(scripts[addr], value), (EXTERNAL_SCRIPT, 1000)])
+        txid = txid_of_raw_tx(raw)
+        transactions[txid] = raw
+        txo[txid] = TxOutputs([(addr, 0, value, False)]).serialize()
+        txi[txid] = TxInputs().serialize()
+        history[addr].append([txid, FIRST_HEIGHT + i // 10])
+        if spends_prev:
+            prev_txid, prev_addr, prev_value = prev
+            txi[txid] = TxInputs([(prev_addr, prev_txid, 0, prev_value)]).serialize()
+            spent_outpoints[prev_txid] = {0: txid}
+            history[prev_addr].append([txid, FIRST_HEIGHT + i // 10])
+        verified_tx[txid] = [FIRST_HEIGHT + i // 10, FIRST_TIMESTAMP + 60 * i, i % 10 + 1, random_hash()]
+        prev = (txid, addr, value)
+
+    storage.put('transactions', transactions)
+    storage.put('txi', txi)
+    storage.put('txo', txo)
+    storage.put('spent_outpoints', serialize_spent_outpoints(spent_outpoints))
+    storage.put('addr_history', history)
+    storage.put('verified_tx3', verified_tx)
+    storage.put('stored_height', FIRST_HEIGHT + num_txs // 10 + 100)
+    storage.write()
+    return path
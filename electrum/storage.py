@@ -25,17 +25,26 @@
 import os
 import ast
 import threading
+import time
 import json
 import copy
 import re
 import stat
 import hashlib
+import hmac
 import base64
+import codecs
 import zlib
+import sys
+import traceback
+import sqlite3
 from collections import defaultdict
+from collections.abc import Mapping
+from typing import Optional, Callable, Tuple, Iterator, Dict, Set
+from types import MappingProxyType
 
-from . import util, bitcoin, ecc
-from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh
+from . import util, bitcoin, ecc, crypto
+from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh, bh2u
 from .plugin import run_hook, plugin_loaders
 from .keystore import bip44_derivation
 
@@ -44,7 +53,7 @@ from .keystore import bip44_derivation
 
 OLD_SEED_VERSION = 4        # electrum versions < 2.0
 NEW_SEED_VERSION = 11       # electrum versions >= 2.0
-FINAL_SEED_VERSION = 18     # electrum >= 2.7 will set this to prevent
+FINAL_SEED_VERSION = 19     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
 
@@ -68,13 +77,269 @@ def get_derivation_used_for_hw_device_encryption():
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
 
+# Streamed encryption: the file is a header (magic, ECIES ephemeral
+# pubkey), followed by the zlib compressed wallet data encrypted with
+# AES-128-CBC, and an HMAC-SHA256 of everything before it. Unlike the
+# base64 format, it is compressed, encrypted and read in chunks.
+STREAM_ENCRYPTION_MAGIC = {
+    STO_EV_USER_PW: b'BIS1',
+    STO_EV_XPUB_PW: b'BIS2',
+}
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+# storage backends
+STORAGE_BACKEND_JSON = 'json'
+STORAGE_BACKEND_SQLITE = 'sqlite'
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+# journal record operations
+JOURNAL_OP_SET = 'set'
+JOURNAL_OP_DEL = 'del'
+# the journal is compacted into the main file once it gets larger than
+# the main file itself, but never before it reaches this size (in bytes)
+JOURNAL_MIN_COMPACTION_SIZE = 1024 * 1024
+
+# default for the 'wallet_write_interval' config variable, in seconds
+DEFAULT_WRITE_INTERVAL = 5
+
+
+def iter_json_chunks(data: dict, batch_size: int = 1000) -> Iterator[str]:
+    """Encodes data as JSON, in pieces: large dicts at the top level of
+    data are split into batches of items, so that no piece is larger
+    than a batch.
+    """
+    yield '{'
+    for i, key in enumerate(sorted(data)):
+        value = data[key]
+        prefix = (', ' if i else '') + json.dumps(key) + ': '
+        if isinstance(value, dict) and len(value) > batch_size:
+            yield prefix + '{'
+            subkeys = sorted(value)
+            for j in range(0, len(subkeys), batch_size):
+                batch = {k: value[k] for k in subkeys[j:j + batch_size]}
+                yield (', ' if j else '') + json.dumps(batch, sort_keys=True, cls=util.MyEncoder)[1:-1]
+            yield '}'
+        else:
+            yield prefix + json.dumps(value, sort_keys=True, cls=util.MyEncoder)
+    yield '}'
+
+
+class EncryptedStreamWriter:
+    """Writes a file in the streamed encryption format, see
+    STREAM_ENCRYPTION_MAGIC.
+    """
+
+    def __init__(self, f, pubkey: ecc.ECPubkey, magic: bytes):
+        self.f = f
+        ephemeral_pubkey, (iv, key_e, key_m) = pubkey.ecies_ephemeral_keys()
+        self.compressor = zlib.compressobj()
+        self.encrypter = crypto.AESCBCEncrypter(key_e, iv)
+        self.mac = hmac.new(key_m, digestmod=hashlib.sha256)
+        self.file_hash = hashlib.sha256()
+        self.size = 0
+        self._write_ciphertext(magic + ephemeral_pubkey)
+
+    def _write_ciphertext(self, data: bytes):
+        self.f.write(data)
+        self.mac.update(data)
+        self.file_hash.update(data)
+        self.size += len(data)
+
+    def write(self, data: bytes):
+        self._write_ciphertext(self.encrypter.update(self.compressor.compress(data)))
+
+    def close(self) -> Tuple[str, int]:
+        """Writes the remaining data and the mac.
+        Returns the hash and the size of the file.
+        """
+        self._write_ciphertext(self.encrypter.update(self.compressor.flush()) + self.encrypter.finalize())
+        mac = self.mac.digest()
+        self.f.write(mac)
+        self.file_hash.update(mac)
+        self.size += len(mac)
+        return bh2u(self.file_hash.digest()), self.size
+
+
+def _read_chunks(f, size: int) -> Iterator[bytes]:
+    while size > 0:
+        chunk = f.read(min(size, STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        size -= len(chunk)
+        yield chunk
+
+
+def read_stream_encrypted_file(path: str, privkey: ecc.ECPrivkey, magic: bytes) -> Tuple[str, str, int]:
+    """Decrypts a file written by EncryptedStreamWriter.
+    Returns the plaintext, and the hash and the size of the file.
+
+    The file is read twice: the mac is verified first, so that nothing
+    is decompressed before it is authenticated.
+    """
+    with open(path, "rb") as f:
+        header = f.read(len(magic) + 33)
+        if header[:len(magic)] != magic:
+            raise WalletFileException('invalid magic bytes')
+        iv, key_e, key_m = privkey.ecies_keys_from_ephemeral_pubkey(header[len(magic):])
+        # the last 32 bytes are the mac
+        size = os.fstat(f.fileno()).st_size
+        if size < len(header) + 32:
+            raise InvalidPassword()
+        mac = hmac.new(key_m, header, digestmod=hashlib.sha256)
+        file_hash = hashlib.sha256(header)
+        for chunk in _read_chunks(f, size - len(header) - 32):
+            mac.update(chunk)
+            file_hash.update(chunk)
+        tail = f.read(32)
+        if not hmac.compare_digest(mac.digest(), tail):
+            raise InvalidPassword()
+        file_hash.update(tail)
+        # the mac is valid, decrypt
+        f.seek(len(header))
+        check_hash = hashlib.sha256(header)
+        decrypter = crypto.AESCBCDecrypter(key_e, iv)
+        decompressor = zlib.decompressobj()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        parts = []
+        try:
+            for chunk in _read_chunks(f, size - len(header) - 32):
+                check_hash.update(chunk)
+                parts.append(decoder.decode(decompressor.decompress(decrypter.update(chunk))))
+            parts.append(decoder.decode(decompressor.decompress(decrypter.finalize())))
+            parts.append(decoder.decode(decompressor.flush(), final=True))
+        except zlib.error:
+            raise WalletFileException('Cannot decompress wallet file')
+        check_hash.update(f.read(32))
+    if check_hash.digest() != file_hash.digest():
+        raise WalletFileException('wallet file changed while it was read')
+    return ''.join(parts), bh2u(file_hash.digest()), size
+
+
+class StorageWriter(threading.Thread, PrintError):
+    """Writes a storage to disk in the background.
+
+    Write requests are coalesced: the storage gets written at most once
+    every `interval` seconds, or right away on flush() and stop().
+    The thread is not a daemon thread, so that a write in progress is
+    not interrupted at exit; it stops by itself when the main thread
+    has exited.
+    """
+
+    def __init__(self, storage: 'JsonDB', interval: float):
+        threading.Thread.__init__(self, name='StorageWriter')
+        self.daemon = False
+        self.storage = storage
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.flush_requested = False
+        self.last_write_time = 0
+        # requests are numbered; a write covers all requests made before it started
+        self.requested = 0
+        self.written = 0
+        # statistics
+        self.num_writes = 0
+        self.last_latency = None  # type: Optional[float]
+        self.max_latency = 0.
+
+    def diagnostic_name(self):
+        return os.path.basename(self.storage.path)
+
+    def schedule(self):
+        with self.cond:
+            self.requested += 1
+            self.cond.notify_all()
+
+    def flush(self):
+        """Writes pending changes and waits until they are on disk."""
+        with self.cond:
+            self.requested += 1
+            target = self.requested
+            self.flush_requested = True
+            self.cond.notify_all()
+            while self.written < target and self.is_alive():
+                self.cond.wait(1)
+        if self.written < target:
+            self.storage.write()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.join()
+
+    def _wait_for_request(self) -> bool:
+        # must be called with self.cond
+        while not (self.stopping or self.flush_requested):
+            if not threading.main_thread().is_alive():
+                self.stopping = True
+                break
+            if self.requested > self.written:
+                delay = self.last_write_time + self.interval - time.time()
+                if delay <= 0:
+                    break
+            else:
+                delay = 1
+            self.cond.wait(min(delay, 1))
+        return self.requested > self.written
+
+    def run(self):
+        while True:
+            with self.cond:
+                has_request = self._wait_for_request()
+                self.flush_requested = False
+                covered = self.requested
+                stopping = self.stopping
+            if has_request:
+                t0 = time.time()
+                try:
+                    self.storage.write()
+                except BaseException as e:
+                    self.print_error("error writing storage:", repr(e))
+                    traceback.print_exc(file=sys.stderr)
+                self.last_write_time = t1 = time.time()
+                self.num_writes += 1
+                self.last_latency = t1 - t0
+                self.max_latency = max(self.max_latency, self.last_latency)
+                self.print_error("write took {:.3f}s".format(self.last_latency))
+            with self.cond:
+                self.written = covered
+                self.cond.notify_all()
+            if stopping:
+                return
+
+    def get_stats(self) -> dict:
+        return {
+            'num_writes': self.num_writes,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+        }
+
+
 class JsonDB(PrintError):
+    """Note: values stored in self.data are never mutated in place (put()
+    replaces them), so they can be shared with readers without copying.
+    """
 
     def __init__(self, path):
         self.db_lock = threading.RLock()
         self.data = {}
         self.path = os.path.normcase(os.path.abspath(path))
         self.modified = False
+        # Journaled writes: instead of rewriting the whole file, write()
+        # appends the changes made since the last write to a journal file.
+        # The journal starts with a header naming the hash of the main
+        # file it applies to, so that a stale journal is never replayed.
+        self.use_journal = False
+        self.journal_path = self.path + '.journal'
+        self._journal_ops = []  # pending (op, path, value) since last write
+        self._needs_full_write = True
+        self._snapshot_hash = None  # type: Optional[str]
+        self._snapshot_size = 0
+        self._journal_size = 0
+        self._writer = None  # type: Optional[StorageWriter]
 
     def get(self, key, default=None):
         with self.db_lock:
@@ -85,6 +350,19 @@ class JsonDB(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def get_readonly(self, key, default=None):
+        """Like get(), but without copying the value.
+        Dicts are returned as read-only views; the caller must not
+        mutate anything reachable from the returned object.
+        """
+        with self.db_lock:
+            v = self.data.get(key)
+        if v is None:
+            return default
+        if isinstance(v, dict):
+            return MappingProxyType(v)
+        return v
+
     def put(self, key, value):
         try:
             json.dumps(key, cls=util.MyEncoder)
@@ -94,16 +372,56 @@ class JsonDB(PrintError):
             return
         with self.db_lock:
             if value is not None:
-                if self.data.get(key) != value:
+                old_value = self.data.get(key)
+                if isinstance(old_value, dict) and isinstance(value, dict):
+                    # only journal the items that changed
+                    changed = self._diff_dict(old_value, value)
+                    if changed is None:
+                        return
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    new_value = self.data[key] = copy.deepcopy(value)
+                    if self.use_journal:
+                        for subkey in changed:
+                            if subkey in new_value:
+                                self._journal_ops.append((JOURNAL_OP_SET, [key, subkey], new_value[subkey]))
+                            else:
+                                self._journal_ops.append((JOURNAL_OP_DEL, [key, subkey], None))
+                elif old_value != value:
+                    self.modified = True
+                    new_value = self.data[key] = copy.deepcopy(value)
+                    if self.use_journal:
+                        self._journal_ops.append((JOURNAL_OP_SET, [key], new_value))
             elif key in self.data:
                 self.modified = True
                 self.data.pop(key)
+                if self.use_journal:
+                    self._journal_ops.append((JOURNAL_OP_DEL, [key], None))
+
+    def put_raw_transactions(self, txids: Set[str], added: Dict[str, str]) -> None:
+        """Sets 'transactions' to the raw transactions of txids.
+        added maps the txids that may not be stored yet to their raw tx;
+        the other txids keep the raw tx they have in storage.
+        """
+        with self.db_lock:
+            stored = self.data.get('transactions') or {}
+            value = {txid: added[txid] if txid in added else stored[txid] for txid in txids}
+        self.put('transactions', value)
+
+    @staticmethod
+    def _diff_dict(old: dict, new: dict) -> Optional[list]:
+        """Returns the keys whose values differ between old and new,
+        or None if the dicts are equal.
+        """
+        changed = [k for k, v in new.items() if k not in old or old[k] != v]
+        num_added = sum(1 for k in changed if k not in old)
+        if len(old) != len(new) - num_added:
+            changed += [k for k in old if k not in new]
+        return changed or None
 
     def get_all_data(self) -> dict:
+        # a shallow copy is enough, see class docstring
         with self.db_lock:
-            return copy.deepcopy(self.data)
+            return dict(self.data)
 
     def overwrite_all_data(self, data: dict) -> None:
         try:
@@ -113,25 +431,64 @@ class JsonDB(PrintError):
             return
         with self.db_lock:
             self.modified = True
-            self.data = copy.deepcopy(data)
+            self._needs_full_write = True
+            self.data = dict(data)
 
     @profiler
     def write(self):
         with self.db_lock:
             self._write()
 
+    def start_writer(self, interval: float = DEFAULT_WRITE_INTERVAL):
+        """Starts a background thread that writes the storage after
+        schedule_write() was called, see StorageWriter.
+        """
+        with self.db_lock:
+            if self._writer is None:
+                self._writer = StorageWriter(self, interval)
+                self._writer.start()
+
+    def stop_writer(self):
+        """Stops the background writer; pending writes are done first."""
+        with self.db_lock:
+            writer, self._writer = self._writer, None
+        if writer:
+            writer.stop()
+
+    def schedule_write(self):
+        """Requests a write. With a background writer running, the write
+        happens later on that thread; otherwise it happens now.
+        """
+        writer = self._writer
+        if writer is not None and writer.is_alive():
+            writer.schedule()
+        else:
+            self.write()
+
+    def flush(self):
+        """Writes pending changes, waiting for the background writer if any."""
+        writer = self._writer
+        if writer is not None:
+            writer.flush()
+        else:
+            self.write()
+
     def _write(self):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write db')
             return
         if not self.modified:
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
-        s = self.encrypt_before_writing(s)
+        if self._can_append_to_journal():
+            self._append_to_journal()
+        else:
+            self._write_snapshot()
+        self.modified = False
 
+    def _write_snapshot(self):
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        with open(temp_path, "w", encoding='utf-8') as f:
-            f.write(s)
+        with open(temp_path, "wb") as f:
+            snapshot_hash, size = self._write_snapshot_to_file(f)
             f.flush()
             os.fsync(f.fileno())
 
@@ -139,7 +496,107 @@ class JsonDB(PrintError):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self.print_error("saved", self.path)
-        self.modified = False
+        # the journal now refers to an old snapshot
+        self._set_snapshot(snapshot_hash, size)
+        self._remove_journal()
+        self._needs_full_write = False
+
+    def _write_snapshot_to_file(self, f) -> Tuple[str, int]:
+        """Writes self.data to the binary file f.
+        Returns the hash and the size of what was written.
+        """
+        s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
+        s = self.encrypt_before_writing(s)
+        b = s.encode('utf-8')
+        f.write(b)
+        return bh2u(hashlib.sha256(b).digest()), len(b)
+
+    def _set_snapshot(self, snapshot_hash: str, size: int):
+        self._snapshot_hash = snapshot_hash
+        self._snapshot_size = size
+
+    def _remove_journal(self):
+        self._journal_ops = []
+        self._journal_size = 0
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+
+    def _can_append_to_journal(self) -> bool:
+        if not self.use_journal or self._needs_full_write:
+            return False
+        if self._snapshot_hash is None or not os.path.exists(self.path):
+            return False
+        # compact if the journal has grown too large
+        return self._journal_size <= max(JOURNAL_MIN_COMPACTION_SIZE, self._snapshot_size)
+
+    def _append_to_journal(self):
+        record = json.dumps(self._journal_ops, cls=util.MyEncoder)
+        record = self.encrypt_before_writing(record)
+        is_new_journal = not os.path.exists(self.journal_path)
+        s = record + '\n'
+        if is_new_journal:
+            s = json.dumps({'snapshot': self._snapshot_hash}) + '\n' + s
+        b = s.encode('utf-8')
+        with open(self.journal_path, "ab") as f:
+            f.write(b)
+            f.flush()
+            os.fsync(f.fileno())
+        if is_new_journal:
+            os.chmod(self.journal_path, os.stat(self.path).st_mode)
+        self._journal_size += len(b)
+        self._journal_ops = []
+        self.print_error("appended to journal", self.journal_path)
+
+    def _replay_journal(self, decrypt_record: Callable[[str], str] = None):
+        """Applies the records of the journal to self.data.
+        A journal that does not belong to the current main file is deleted,
+        and a partially written last record is truncated.
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb") as f:
+            lines = f.readlines()
+        try:
+            header = json.loads(lines[0].decode('utf-8'))
+            is_stale = header['snapshot'] != self._snapshot_hash
+        except Exception:
+            is_stale = True
+        if is_stale:
+            self.print_error("ignoring stale journal", self.journal_path)
+            self._remove_journal()
+            return
+        good_size = len(lines[0])
+        num_records = 0
+        for line in lines[1:]:
+            try:
+                if not line.endswith(b'\n'):
+                    raise Exception('incomplete record')
+                record = line.decode('utf-8').rstrip('\n')
+                if decrypt_record:
+                    record = decrypt_record(record)
+                ops = json.loads(record)
+            except Exception as e:
+                self.print_error("truncating journal at invalid record:", repr(e))
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(good_size)
+                break
+            for op, path, value in ops:
+                self._apply_journal_op(op, path, value)
+            good_size += len(line)
+            num_records += 1
+        self._journal_size = good_size
+        self.print_error("replayed {} journal records".format(num_records))
+
+    def _apply_journal_op(self, op: str, path: list, value):
+        d = self.data
+        for key in path[:-1]:
+            d = d.setdefault(key, {})
+        if op == JOURNAL_OP_SET:
+            d[path[-1]] = value
+        elif op == JOURNAL_OP_DEL:
+            d.pop(path[-1], None)
+        else:
+            raise WalletFileException('unknown journal operation: {}'.format(op))
 
     def encrypt_before_writing(self, plaintext: str) -> str:
         return plaintext
@@ -150,23 +607,50 @@ class JsonDB(PrintError):
 
 class WalletStorage(JsonDB):
 
-    def __init__(self, path, manual_upgrades=False):
+    def __new__(cls, path, manual_upgrades=False, *, backend=None):
+        # existing files are opened with the backend they were written with
+        if cls is WalletStorage:
+            path = os.path.normcase(os.path.abspath(path))
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    is_sqlite = f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+            else:
+                is_sqlite = backend == STORAGE_BACKEND_SQLITE
+            if is_sqlite:
+                cls = SqliteWalletStorage
+        return super().__new__(cls)
+
+    def __init__(self, path, manual_upgrades=False, *, backend=None):
         JsonDB.__init__(self, path)
         self.print_error("wallet path", path)
         self.manual_upgrades = manual_upgrades
         self.pubkey = None
+        self._stream_encryption = False
         if self.file_exists():
-            with open(self.path, "r", encoding='utf-8') as f:
-                self.raw = f.read()
-            self._encryption_version = self._init_encryption_version()
-            if not self.is_encrypted():
-                self.load_data(self.raw)
+            self._needs_full_write = False
+            with open(self.path, "rb") as f:
+                magic = f.read(4)
+            stream_versions = {v: k for k, v in STREAM_ENCRYPTION_MAGIC.items()}
+            if magic in stream_versions:
+                # the file is read in decrypt()
+                self.raw = None
+                self._stream_encryption = True
+                self._encryption_version = stream_versions[magic]
+            else:
+                with open(self.path, "rb") as f:
+                    b = f.read()
+                self.raw = b.decode('utf-8')
+                # the size in bytes, as written by _write_snapshot_to_file
+                self._set_snapshot(bh2u(hashlib.sha256(b).digest()), len(b))
+                self._encryption_version = self._init_encryption_version()
+                if not self.is_encrypted():
+                    self.load_data(self.raw)
         else:
             self._encryption_version = STO_EV_PLAINTEXT
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
-    def load_data(self, s):
+    def load_data(self, s, decrypt_journal_record=None):
         try:
             self.data = json.loads(s)
         except:
@@ -187,6 +671,11 @@ class WalletStorage(JsonDB):
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
 
+        self._replay_journal(decrypt_journal_record)
+        self.use_journal = bool(self.get('use_journal', False))
+        self._after_load()
+
+    def _after_load(self):
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -257,14 +746,19 @@ class WalletStorage(JsonDB):
 
     def decrypt(self, password):
         ec_key = self.get_eckey_from_password(password)
-        if self.raw:
-            enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
+        enc_magic = self._get_encryption_magic()
+        def decrypt_record(record: str) -> str:
+            return zlib.decompress(ec_key.decrypt_message(record, enc_magic)).decode('utf8')
+        if self._stream_encryption:
+            stream_magic = STREAM_ENCRYPTION_MAGIC[self._encryption_version]
+            s, snapshot_hash, size = read_stream_encrypted_file(self.path, ec_key, stream_magic)
+            self._set_snapshot(snapshot_hash, size)
+        elif self.raw:
+            s = decrypt_record(self.raw)
         else:
             s = None
         self.pubkey = ec_key.get_public_key_hex()
-        s = s.decode('utf8')
-        self.load_data(s)
+        self.load_data(s, decrypt_journal_record=decrypt_record)
 
     def encrypt_before_writing(self, plaintext: str) -> str:
         s = plaintext
@@ -277,6 +771,15 @@ class WalletStorage(JsonDB):
             s = s.decode('utf8')
         return s
 
+    def _write_snapshot_to_file(self, f):
+        if not (self.pubkey and self._stream_encryption):
+            return super()._write_snapshot_to_file(f)
+        stream_magic = STREAM_ENCRYPTION_MAGIC[self._encryption_version]
+        writer = EncryptedStreamWriter(f, ecc.ECPubkey(bfh(self.pubkey)), stream_magic)
+        for chunk in iter_json_chunks(self.data):
+            writer.write(chunk.encode('utf-8'))
+        return writer.close()
+
     def check_password(self, password):
         """Raises an InvalidPassword exception on invalid password"""
         if not self.is_encrypted():
@@ -301,6 +804,60 @@ class WalletStorage(JsonDB):
         # make sure next storage.write() saves changes
         with self.db_lock:
             self.modified = True
+            # the journal is encrypted with the old key
+            self._needs_full_write = True
+
+    def set_journal_enabled(self, enabled: bool):
+        """Enable journaled writes: write() then only appends the changes
+        to a journal file next to the wallet file, which gets compacted
+        into the wallet file when it grows too large.
+        The setting is saved in the wallet file (see the set_journal command).
+        """
+        with self.db_lock:
+            self.put('use_journal', True if enabled else None)
+            self.use_journal = enabled
+            # start from (or return to) a single file
+            self._needs_full_write = True
+            self.modified = True
+
+    def set_stream_encryption(self, enabled: bool):
+        """Switch an encrypted wallet file to the streamed encryption
+        format (or back), which is faster to read and write for large
+        wallets, but cannot be opened by older versions of Electrum.
+        Nothing is saved besides the file itself: the format is detected
+        from its magic bytes when the file is opened.
+        """
+        with self.db_lock:
+            self._stream_encryption = enabled
+            self._needs_full_write = True
+            self.modified = True
+
+    def convert_to_sqlite(self) -> 'SqliteWalletStorage':
+        """Converts the wallet file into an SQLite database, in place.
+        Returns the storage for the converted file; this object must not
+        be used anymore.
+        """
+        if self.is_encrypted():
+            raise WalletFileException('Storage encryption is not supported with SQLite. '
+                                      'Remove the storage password before converting.')
+        if self.requires_upgrade():
+            self.upgrade()
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        db = SqliteWalletStorage(temp_path, manual_upgrades=True)
+        with self.db_lock:
+            db.data = dict(self.data)
+            db.data.pop('use_journal', None)
+            db.modified = True
+            db.write()
+            db.close()
+            mode = os.stat(self.path).st_mode if os.path.exists(self.path) else stat.S_IREAD | stat.S_IWRITE
+            os.replace(temp_path, self.path)
+            os.chmod(self.path, mode)
+            self._remove_journal()
+        self.print_error("converted to sqlite", self.path)
+        return WalletStorage(self.path, manual_upgrades=self.manual_upgrades)
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -368,6 +925,7 @@ class WalletStorage(JsonDB):
         self.convert_version_16()
         self.convert_version_17()
         self.convert_version_18()
+        self.convert_version_19()
 
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
         self.write()
@@ -589,7 +1147,22 @@ class WalletStorage(JsonDB):
         self.put('verified_tx3', None)
         self.put('seed_version', 18)
 
-    # def convert_version_19(self):
+    def convert_version_19(self):
+        # compact format for txi, txo and spent_outpoints, see bookkeeping.py
+        if not self._is_upgrade_method_needed(18, 18):
+            return
+        from .bookkeeping import TxInputs, TxOutputs, serialize_spent_outpoints
+        txi = self.get_readonly('txi', {})
+        self.put('txi', {txid: TxInputs.from_legacy(d).serialize() for txid, d in txi.items()})
+        txo = self.get_readonly('txo', {})
+        self.put('txo', {txid: TxOutputs.from_legacy(d).serialize() for txid, d in txo.items()})
+        spent_outpoints = self.get_readonly('spent_outpoints', {})
+        spent_outpoints = {prevout_hash: {int(n): txid for n, txid in d.items()}
+                           for prevout_hash, d in spent_outpoints.items()}
+        self.put('spent_outpoints', serialize_spent_outpoints(spent_outpoints))
+        self.put('seed_version', 19)
+
+    # def convert_version_20(self):
     #     TODO for "next" upgrade:
     #       - move "pw_hash_version" from keystore to storage
     #     pass
@@ -682,3 +1255,239 @@ class WalletStorage(JsonDB):
                 # creation was complete if electrum was run from source
                 msg += "\nPlease open this file with Electrum 1.9.8, and move your coins to a new wallet."
         raise WalletFileException(msg)
+
+
+class SqliteRawTransactions(Mapping):
+    """Raw transactions of an SqliteWalletStorage, txid -> raw tx hex.
+    Only the txids are kept in memory; raw transactions are read from
+    the database when accessed.
+    """
+
+    def __init__(self, storage: 'SqliteWalletStorage'):
+        self.storage = storage
+        self._txids = set()
+        self._unsaved = {}  # txid -> raw, not yet written
+
+    def __getitem__(self, txid):
+        raw = self._unsaved.get(txid)
+        if raw is not None:
+            return raw
+        if txid not in self._txids:
+            raise KeyError(txid)
+        with self.storage.db_lock:
+            row = self.storage._conn.execute('SELECT raw FROM transactions WHERE txid=?', (txid,)).fetchone()
+        return row[0]
+
+    def __iter__(self):
+        return iter(self._txids)
+
+    def __len__(self):
+        return len(self._txids)
+
+    def __contains__(self, txid):
+        return txid in self._txids
+
+    def items(self):
+        # one query instead of one per transaction
+        with self.storage.db_lock:
+            if self.storage._conn is None:
+                return list(self._unsaved.items())
+            rows = self.storage._conn.execute('SELECT txid, raw FROM transactions').fetchall()
+            items = {txid: raw for txid, raw in rows if txid in self._txids}
+            items.update(self._unsaved)
+        return list(items.items())
+
+    def __deepcopy__(self, memo):
+        return dict(self.items())
+
+
+class SqliteWalletStorage(WalletStorage):
+    """Wallet storage backed by an SQLite database.
+
+    Transactions, txi/txo, address histories and statuses, spent outpoints,
+    tx fees and SPV data are kept in their own tables, one row per transaction or
+    address; everything else is stored as JSON in a key-value table.
+    Raw transactions are loaded on demand (see SqliteRawTransactions).
+    Changes are tracked as journal operations by put(), and write()
+    applies them in a single SQL transaction.
+
+    Storage encryption is not supported.
+    """
+
+    TABLES = ('txi', 'txo', 'addr_history', 'addr_status', 'spent_outpoints', 'tx_fees', 'verified_tx3', 'transactions')
+
+    def __init__(self, path, manual_upgrades=False, *, backend=None):
+        JsonDB.__init__(self, path)
+        self.print_error("wallet path", path)
+        self.manual_upgrades = manual_upgrades
+        self.pubkey = None
+        self._encryption_version = STO_EV_PLAINTEXT
+        self._stream_encryption = False
+        # put() records changes as journal ops, see _write
+        self.use_journal = True
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        self.raw_transactions = SqliteRawTransactions(self)
+        if self.file_exists():
+            self._connect()
+            self._load()
+            self._needs_full_write = False
+            self._after_load()
+        else:
+            # avoid new wallets getting 'upgraded'
+            self.put('seed_version', FINAL_SEED_VERSION)
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            for table in self.TABLES:
+                if table == 'transactions':
+                    self._conn.execute('CREATE TABLE IF NOT EXISTS transactions (txid TEXT PRIMARY KEY, raw TEXT NOT NULL)')
+                elif table == 'verified_tx3':
+                    self._conn.execute('CREATE TABLE IF NOT EXISTS verified_tx3 (txid TEXT PRIMARY KEY, height INTEGER, '
+                                       'timestamp INTEGER, txpos INTEGER, header_hash TEXT)')
+                    self._conn.execute('CREATE INDEX IF NOT EXISTS verified_tx3_height ON verified_tx3 (height)')
+                else:
+                    self._conn.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT NOT NULL)'.format(table))
+
+    def close(self):
+        with self.db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @profiler
+    def _load(self):
+        try:
+            c = self._conn.cursor()
+            data = {key: json.loads(value) for key, value in c.execute('SELECT key, value FROM kv')}
+            for table in self.TABLES:
+                if table == 'transactions':
+                    self.raw_transactions._txids = set(row[0] for row in c.execute('SELECT txid FROM transactions'))
+                    data[table] = self.raw_transactions
+                elif table == 'verified_tx3':
+                    data[table] = {row[0]: list(row[1:]) for row in c.execute('SELECT * FROM verified_tx3')}
+                else:
+                    data[table] = {key: json.loads(value)
+                                   for key, value in c.execute('SELECT key, value FROM {}'.format(table))}
+        except (sqlite3.Error, ValueError) as e:
+            raise WalletFileException("Cannot read wallet file '{}': {}".format(self.path, repr(e))) from e
+        self.data = data
+
+    def put(self, key, value):
+        if key != 'transactions' or self.data.get(key) is not self.raw_transactions:
+            # data may have been replaced with a plain dict (e.g. overwrite_all_data)
+            return super().put(key, value)
+        value = value or {}
+        self.put_raw_transactions(set(value), value)
+
+    def put_raw_transactions(self, txids, added):
+        # raw transactions are not compared, as a txid determines its raw tx;
+        # the stored ones are never read
+        key = 'transactions'
+        txs = self.raw_transactions
+        with self.db_lock:
+            if self.data.get(key) is not txs:
+                return super().put_raw_transactions(txids, added)
+            for txid in txs._txids - txids:
+                txs._txids.discard(txid)
+                txs._unsaved.pop(txid, None)
+                self._journal_ops.append((JOURNAL_OP_DEL, [key, txid], None))
+                self.modified = True
+            for txid in txids - txs._txids:
+                txs._txids.add(txid)
+                txs._unsaved[txid] = raw = str(added[txid])
+                self._journal_ops.append((JOURNAL_OP_SET, [key, txid], raw))
+                self.modified = True
+
+    def _write(self):
+        if threading.currentThread().isDaemon():
+            self.print_error('warning: daemon thread cannot write db')
+            return
+        if not self.modified:
+            return
+        if self._conn is None:
+            self._connect()
+        with self._conn:  # one sql transaction
+            if self._needs_full_write:
+                self._write_all()
+            else:
+                self._apply_journal_ops()
+        self._journal_ops = []
+        self.raw_transactions._unsaved.clear()
+        self._needs_full_write = False
+        self.modified = False
+        self.print_error("saved", self.path)
+
+    def _insert_rows(self, table, items):
+        if table == 'transactions':
+            sql = 'INSERT OR REPLACE INTO transactions VALUES (?,?)'
+            rows = items
+        elif table == 'verified_tx3':
+            sql = 'INSERT OR REPLACE INTO verified_tx3 VALUES (?,?,?,?,?)'
+            rows = ((k, *v) for k, v in items)
+        else:
+            sql = 'INSERT OR REPLACE INTO {} VALUES (?,?)'.format(table)
+            rows = ((k, json.dumps(v, cls=util.MyEncoder)) for k, v in items)
+        self._conn.executemany(sql, rows)
+
+    def _delete_rows(self, table, keys):
+        key_column = 'txid' if table in ('transactions', 'verified_tx3') else 'key'
+        self._conn.executemany('DELETE FROM {} WHERE {}=?'.format(table, key_column), ((k,) for k in keys))
+
+    def _write_kv(self, key):
+        if key in self.data:
+            value = json.dumps(self.data[key], cls=util.MyEncoder)
+            self._conn.execute('INSERT OR REPLACE INTO kv VALUES (?,?)', (key, value))
+        else:
+            self._conn.execute('DELETE FROM kv WHERE key=?', (key,))
+
+    def _write_all(self):
+        self._conn.execute('DELETE FROM kv')
+        for table in self.TABLES:
+            value = self.data.get(table) or {}
+            if value is self.raw_transactions:
+                # only the raw transactions changed since the last write
+                self._apply_journal_ops([op for op in self._journal_ops if op[1][0] == table])
+                continue
+            self._conn.execute('DELETE FROM {}'.format(table))
+            self._insert_rows(table, value.items())
+            if table == 'transactions':
+                self.raw_transactions._txids = set(value)
+                self.data[table] = self.raw_transactions
+        for key in self.data:
+            if key not in self.TABLES:
+                self._write_kv(key)
+
+    def _apply_journal_ops(self, ops=None):
+        if ops is None:
+            ops = self._journal_ops
+        dirty_kv_keys = set()
+        for op, path, value in ops:
+            key = path[0]
+            if key not in self.TABLES:
+                dirty_kv_keys.add(key)
+            elif len(path) == 2:
+                if op == JOURNAL_OP_SET:
+                    self._insert_rows(key, [(path[1], value)])
+                else:
+                    self._delete_rows(key, [path[1]])
+            else:
+                self._conn.execute('DELETE FROM {}'.format(key))
+                if op == JOURNAL_OP_SET:
+                    self._insert_rows(key, value.items())
+        for key in dirty_kv_keys:
+            self._write_kv(key)
+
+    def set_password(self, password, enc_version=None):
+        # a password only protects the keystore, and only if the caller
+        # asks for a plaintext file explicitly
+        if password and enc_version != STO_EV_PLAINTEXT:
+            raise WalletFileException('Storage encryption is not supported with SQLite.')
+        super().set_password(None, STO_EV_PLAINTEXT)
+
+    def set_journal_enabled(self, enabled: bool):
+        raise WalletFileException('SQLite storage does not use a journal file.')
+
+    def convert_to_sqlite(self):
+        return self
@@ -22,15 +22,21 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import os
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING
-from collections import defaultdict
+import heapq
+import itertools
+import sqlite3
+import time
+from typing import Dict, List, Tuple, Callable, Optional, TYPE_CHECKING
+from collections import defaultdict, deque
+from functools import partial
 
 from aiorpcx import TaskGroup, run_in_thread
 
 from .transaction import Transaction
-from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer
+from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer, PrintError
 from .bitcoin import address_to_scripthash, is_address
 
 if TYPE_CHECKING:
@@ -38,6 +44,25 @@ if TYPE_CHECKING:
     from .address_synchronizer import AddressSynchronizer
 
 
+# transactions received from the server are added to the wallet in
+# batches of up to this size
+TX_BATCH_SIZE = 100
+# default number of address subscriptions sent per batch request;
+# can be changed with the 'subscribe_batch_size' config key
+SUBSCRIBE_BATCH_SIZE = 50
+# default maximum number of history and transaction requests in flight;
+# can be changed with the 'fetch_window' config key
+FETCH_WINDOW = 50
+# defaults for the Notifier, see its docstring
+NOTIFIER_QUEUE_SIZE = 10000
+NOTIFIER_MAX_RETRIES = 10
+NOTIFIER_MAX_BACKOFF = 300  # seconds
+# priorities of the requests of the synchronizer, lowest first
+HISTORY_PRIORITY = (0,)
+def tx_priority(tx_height: int) -> Tuple:
+    # newest transactions first
+    return (1, 0) if tx_height <= 0 else (2, -tx_height)
+
 def history_status(h):
     if not h:
         return None
@@ -47,6 +72,112 @@ def history_status(h):
     return bh2u(hashlib.sha256(status.encode('ascii')).digest())
 
 
+class FetchScheduler(PrintError):
+    """Runs network requests, with a limited number of them in flight.
+    Waiting requests are started in order of priority.
+
+    The window (the number of requests in flight) grows by one per
+    window of responses while latency stays low. It shrinks when the
+    latency goes up, as requests then queue at the server, and is
+    halved when requests fail or are interrupted, e.g. by a timeout.
+    """
+
+    INITIAL_WINDOW = 10
+    # latency above 2*min_latency + 100ms counts as congestion
+    LATENCY_FACTOR = 2
+    LATENCY_SLACK = 0.1
+
+    def __init__(self, max_window: int, on_progress: Callable[[], None] = None):
+        self.max_window = max(1, max_window)
+        self.window = float(min(self.INITIAL_WINDOW, self.max_window))
+        self.on_progress = on_progress
+        self.min_latency = None  # type: Optional[float]
+        self.avg_latency = None  # type: Optional[float]
+        self.restart()
+
+    def restart(self):
+        """Forgets waiting requests; their tasks have been cancelled."""
+        self._queue = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self.in_flight = 0
+        self._new_round()
+
+    def _new_round(self):
+        # progress of the current round of requests
+        self.num_done = 0
+        self.num_total = 0
+        # value of num_done before which the window is not decreased again
+        self._next_decrease = 0
+
+    def get_progress(self) -> Tuple[int, int]:
+        return self.num_done, self.num_total
+
+    async def run(self, priority, func, *args):
+        """Awaits func(*args) once the window allows it."""
+        self.num_total += 1
+        if self._queue or self.in_flight >= int(self.window):
+            fut = asyncio.get_event_loop().create_future()
+            heapq.heappush(self._queue, (priority, next(self._seq), fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.cancelled():
+                    self.num_total -= 1
+                else:
+                    # we were given a slot, pass it on
+                    self.in_flight -= 1
+                    self.num_total -= 1
+                    self._start_next()
+                raise
+        else:
+            self.in_flight += 1
+        t0 = time.monotonic()
+        try:
+            result = await func(*args)
+        except BaseException:
+            self._decrease(0.5)
+            raise
+        else:
+            self._on_response(time.monotonic() - t0)
+            return result
+        finally:
+            self.in_flight -= 1
+            self.num_done += 1
+            self._start_next()
+            if self.on_progress:
+                self.on_progress()
+            if self.num_done == self.num_total:
+                self._new_round()
+
+    def _start_next(self):
+        while self._queue and self.in_flight < int(self.window):
+            priority, seq, fut = heapq.heappop(self._queue)
+            if fut.done():
+                continue  # cancelled
+            fut.set_result(None)
+            self.in_flight += 1
+
+    def _on_response(self, latency: float):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency = 0.8 * self.avg_latency + 0.2 * latency
+        if self.avg_latency > self.LATENCY_FACTOR * self.min_latency + self.LATENCY_SLACK:
+            self._decrease(0.75)
+        else:
+            self.window = min(self.max_window, self.window + 1 / self.window)
+
+    def _decrease(self, factor: float):
+        # at most once per window, as the responses to requests that were
+        # sent before the decrease carry the same signal
+        if self.num_done < self._next_decrease:
+            return
+        self.window = max(1.0, self.window * factor)
+        self._next_decrease = self.num_done + self.in_flight
+
+
 class SynchronizerBase(NetworkJobOnDefaultServer):
     """Subscribe over the network to a set of addresses, and monitor their statuses.
     Every time a status changes, run a coroutine provided by the subclass.
@@ -63,6 +194,8 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         # Queues
         self.add_queue = asyncio.Queue()
         self.status_queue = asyncio.Queue()
+        # set when a request completes
+        self.state_changed = asyncio.Event()
 
     async def _start_tasks(self):
         try:
@@ -88,15 +221,32 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         raise NotImplementedError()  # implemented by subclasses
 
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            self.requested_addrs.remove(addr)
+        batch_size = self.network.config.get('subscribe_batch_size', SUBSCRIBE_BATCH_SIZE)
+        batch_size = max(1, min(batch_size, self.session.max_in_flight_requests))
+        # keep just enough batches in flight to fill the session's
+        # request window; meanwhile the queue fills up
+        max_batches = max(2, self.session.max_in_flight_requests // batch_size)
+        batches_in_flight = asyncio.Semaphore(max_batches)
+
+        async def subscribe_to_addresses(addrs):
+            try:
+                params_list = []
+                for addr in addrs:
+                    h = address_to_scripthash(addr)
+                    self.scripthash_to_address[h] = addr
+                    params_list.append([h])
+                await self.session.subscribe_batch('blockchain.scripthash.subscribe', params_list, self.status_queue)
+                self.requested_addrs.difference_update(addrs)
+                self.state_changed.set()
+            finally:
+                batches_in_flight.release()
 
         while True:
-            addr = await self.add_queue.get()
-            await self.group.spawn(subscribe_to_address, addr)
+            await batches_in_flight.acquire()
+            addrs = [await self.add_queue.get()]
+            while len(addrs) < batch_size and not self.add_queue.empty():
+                addrs.append(self.add_queue.get_nowait())
+            await self.group.spawn(subscribe_to_addresses, addrs)
 
     async def handle_status(self):
         while True:
@@ -119,12 +269,20 @@ class Synchronizer(SynchronizerBase):
     '''
     def __init__(self, wallet: 'AddressSynchronizer'):
         self.wallet = wallet
+        self.fetch_scheduler = FetchScheduler(wallet.network.config.get('fetch_window', FETCH_WINDOW),
+                                              on_progress=self._on_fetch_progress)
+        self._last_progress_report = 0
         SynchronizerBase.__init__(self, wallet.network)
 
     def _reset(self):
         super()._reset()
+        self.fetch_scheduler.restart()
         self.requested_tx = {}
         self.requested_histories = {}
+        # (tx_hash, tx, tx_height) received, not yet added to the wallet
+        self.tx_batch = []
+        # whether new addresses may have to be generated
+        self.need_synchronize = True
 
     def diagnostic_name(self):
         return '{}:{}'.format(self.__class__.__name__, self.wallet.diagnostic_name())
@@ -134,16 +292,60 @@ class Synchronizer(SynchronizerBase):
                 and not self.requested_histories
                 and not self.requested_tx)
 
+    async def _start_tasks(self):
+        # a new block can age the transactions of the addresses at the
+        # end of the gap limit
+        self.network.register_callback(self._on_blockchain_updated, ['blockchain_updated'])
+        try:
+            await super()._start_tasks()
+        finally:
+            self.network.unregister_callback(self._on_blockchain_updated)
+
+    def get_progress(self) -> Tuple[int, int]:
+        """Returns the number of history and transaction requests done,
+        and the total, in the current round of requests."""
+        return self.fetch_scheduler.get_progress()
+
+    def _on_fetch_progress(self):
+        now = time.monotonic()
+        if now - self._last_progress_report < 1:
+            return
+        self._last_progress_report = now
+        self.network.notify('status')
+
+    def _on_blockchain_updated(self, event):
+        self.need_synchronize = True
+        self.state_changed.set()
+
     async def _on_address_status(self, addr, status):
-        history = self.wallet.history.get(addr, [])
-        if history_status(history) == status:
+        try:
+            await self._update_address_history(addr, status)
+        finally:
+            self.state_changed.set()
+
+    def _get_stored_status(self, addr):
+        # the wallet keeps the status along with the history, so that we
+        # don't have to hash the whole history every time we reconnect
+        status = self.wallet.address_status.get(addr)
+        if status is None:
+            # a read lock: this runs on the event loop, and must not wait
+            # for queries of other threads to finish
+            with self.wallet.read_lock:
+                status = history_status(self.wallet.history.get(addr, []))
+                if status is not None:
+                    with self.wallet._cache_lock:
+                        self.wallet.address_status[addr] = status
+        return status
+
+    async def _update_address_history(self, addr, status):
+        if self._get_stored_status(addr) == status:
             return
         if addr in self.requested_histories:
             return
         # request address history
         self.requested_histories[addr] = status
         h = address_to_scripthash(addr)
-        result = await self.network.get_history_for_scripthash(h)
+        result = await self.fetch_scheduler.run(HISTORY_PRIORITY, self._get_history, h, status)
         self.print_error("receiving history", addr, len(result))
         hashes = set(map(lambda item: item['tx_hash'], result))
         hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
@@ -158,13 +360,29 @@ class Synchronizer(SynchronizerBase):
             self.print_error("error: status mismatch: %s" % addr)
         else:
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees, status)
+            if self.wallet.is_gap_address(addr):
+                self.need_synchronize = True
             # Request transactions we don't have
             await self._request_missing_txs(hist)
 
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
 
+    async def _get_history(self, h, status):
+        if self.network.fetch_from_all_servers:
+            # any server will do, as long as the history matches
+            # the status announced by our main server
+            def is_valid(result):
+                hist = [(item['tx_hash'], item['height']) for item in result]
+                hashes = set(tx_hash for tx_hash, height in hist)
+                return len(hashes) == len(hist) and history_status(hist) == status
+            result = await self.network.request_from_any_interface(
+                'blockchain.scripthash.get_history', [h], is_valid)
+            if result is not None:
+                return result
+        return await self.network.get_history_for_scripthash(h)
+
     async def _request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
         transaction_hashes = []
@@ -180,9 +398,18 @@ class Synchronizer(SynchronizerBase):
         async with TaskGroup() as group:
             for tx_hash in transaction_hashes:
                 await group.spawn(self._get_transaction, tx_hash)
+        self._add_tx_batch()
 
     async def _get_transaction(self, tx_hash):
-        result = await self.network.get_transaction(tx_hash)
+        # another wallet of the daemon may have it already; the disk store
+        # of the cache is only looked up by get_transaction, off the loop
+        result = self.network.tx_cache.get_from_memory(tx_hash)
+        if result is None:
+            priority = tx_priority(self.requested_tx[tx_hash])
+            # transactions of encrypted wallets are not written unencrypted to disk
+            get_transaction = partial(self.network.get_transaction,
+                                      cache_on_disk=not self.wallet.storage.is_encrypted())
+            result = await self.fetch_scheduler.run(priority, get_transaction, tx_hash)
         tx = Transaction(result)
         try:
             tx.deserialize()
@@ -193,12 +420,25 @@ class Synchronizer(SynchronizerBase):
             self.print_error("received tx does not match expected txid ({} != {})"
                              .format(tx_hash, tx.txid()))
             return
-        tx_height = self.requested_tx.pop(tx_hash)
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        tx_height = self.requested_tx[tx_hash]
+        self.tx_batch.append((tx_hash, tx, tx_height))
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
+        if len(self.tx_batch) >= TX_BATCH_SIZE:
+            self._add_tx_batch()
+
+    def _add_tx_batch(self):
+        batch, self.tx_batch = self.tx_batch, []
+        if not batch:
+            return
+        added = self.wallet.add_transactions(batch)
+        # the transactions stay requested until the wallet has them
+        for tx_hash, tx, tx_height in batch:
+            self.requested_tx.pop(tx_hash, None)
+        self.state_changed.set()
         # callbacks
-        self.wallet.network.trigger_callback('new_transaction', self.wallet, tx)
+        if added:
+            self.wallet.network.trigger_callback('new_transactions', self.wallet, added)
 
     async def main(self):
         self.wallet.set_up_to_date(False)
@@ -211,10 +451,14 @@ class Synchronizer(SynchronizerBase):
         # add addresses to bootstrap
         for addr in self.wallet.get_addresses():
             await self._add_address(addr)
-        # main loop
+        # main loop, woken up when a request completed or a new block arrived
+        self.state_changed.set()
         while True:
-            await asyncio.sleep(0.1)
-            await run_in_thread(self.wallet.synchronize)
+            await self.state_changed.wait()
+            self.state_changed.clear()
+            if self.need_synchronize:
+                self.need_synchronize = False
+                await run_in_thread(self.wallet.synchronize)
             up_to_date = self.is_up_to_date()
             if (up_to_date != self.wallet.is_up_to_date()
                     or up_to_date and self._processed_some_notifications):
@@ -223,35 +467,183 @@ class Synchronizer(SynchronizerBase):
                 self.wallet.network.trigger_callback('wallet_updated', self.wallet)
 
 
+def watch_list_path(config) -> str:
+    return os.path.join(config.path, 'notifier')
+
+
+class WatchList(PrintError):
+    """The addresses watched by the Notifier, and their URLs, stored in
+    an SQLite database so that they are watched again after a restart."""
+
+    def __init__(self, path: str):
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        try:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS watched (address TEXT NOT NULL, url TEXT NOT NULL, '
+                                   'PRIMARY KEY (address, url))')
+        except sqlite3.Error as e:
+            self.print_error('cannot open watch list, addresses will not be watched after a restart', path, repr(e))
+            self._conn = None
+
+    def load(self) -> Dict[str, List[str]]:
+        watched = defaultdict(list)
+        if self._conn is not None:
+            for addr, url in self._conn.execute('SELECT address, url FROM watched'):
+                watched[addr].append(url)
+        return watched
+
+    def add(self, addr: str, url: str):
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute('INSERT OR IGNORE INTO watched VALUES (?,?)', (addr, url))
+
+
 class Notifier(SynchronizerBase):
     """Watch addresses. Every time the status of an address changes,
     an HTTP POST is sent to the corresponding URL.
+
+    Notifications are queued per URL, up to 'notifier_queue_size' of
+    them; if the queue is full the oldest is dropped. Up to
+    'notifier_batch_size' of them are sent per POST: with a batch size
+    of 1 (the default) the body is {"address": ..., "status": ...},
+    otherwise it is a list of those. A failed POST is retried with
+    exponential backoff, at most 'notifier_max_retries' times.
     """
-    def __init__(self, network):
+    def __init__(self, network: 'Network'):
+        config = network.config
+        self.watch_list = WatchList(watch_list_path(config))
+        self.watched_addresses = self.watch_list.load()  # type: Dict[str, List[str]]
+        self.batch_size = max(1, config.get('notifier_batch_size', 1))
+        self.max_retries = config.get('notifier_max_retries', NOTIFIER_MAX_RETRIES)
+        self.queue_size = config.get('notifier_queue_size', NOTIFIER_QUEUE_SIZE)
+        # url -> deque of (notification, time it was queued)
+        self._queues = defaultdict(lambda: deque(maxlen=self.queue_size))  # type: Dict[str, deque]
+        self._http_session = None
+        self._http_session_proxy = None
+        # stats
+        self.num_delivered = 0
+        self.num_dropped = 0
+        self.num_retries = 0
+        self._latencies = deque(maxlen=1000)  # of the last deliveries
         SynchronizerBase.__init__(self, network)
-        self.watched_addresses = defaultdict(list)  # type: Dict[str, List[str]]
-        self.start_watching_queue = asyncio.Queue()
+
+    def _reset(self):
+        super()._reset()
+        # url -> Event, set when a notification is queued for url
+        self._queued = {}  # type: Dict[str, asyncio.Event]
+
+    async def _start_tasks(self):
+        try:
+            await super()._start_tasks()
+        finally:
+            # the tasks that POST are gone; the next one opens a new session
+            await self._close_http_session()
 
     async def main(self):
         # resend existing subscriptions if we were restarted
-        for addr in self.watched_addresses:
-            await self._add_address(addr)
-        # main loop
-        while True:
-            addr, url = await self.start_watching_queue.get()
-            self.watched_addresses[addr].append(url)
+        for addr in list(self.watched_addresses):
             await self._add_address(addr)
+        # resume delivering what is still queued
+        for url, queue in list(self._queues.items()):
+            if queue:
+                await self._wake_up_delivery(url)
+
+    async def watch(self, addr: str, url: str):
+        if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
+        if url in self.watched_addresses[addr]:
+            return
+        self.watched_addresses[addr].append(url)
+        self.watch_list.add(addr, url)
+        await self._add_address(addr)
 
     async def _on_address_status(self, addr, status):
         self.print_error('new status for addr {}'.format(addr))
-        headers = {'content-type': 'application/json'}
-        data = {'address': addr, 'status': status}
+        now = time.time()
         for url in self.watched_addresses[addr]:
+            queue = self._queues[url]
+            if len(queue) == queue.maxlen:
+                self.num_dropped += 1
+            queue.append(({'address': addr, 'status': status}, now))
+            await self._wake_up_delivery(url)
+
+    async def _wake_up_delivery(self, url):
+        if url not in self._queued:
+            self._queued[url] = asyncio.Event()
+            await self.group.spawn(self._deliver, url)
+        self._queued[url].set()
+
+    async def _deliver(self, url):
+        queue = self._queues[url]
+        queued = self._queued[url]
+        retries = 0
+        while True:
+            if not queue:
+                queued.clear()
+                await queued.wait()
+                continue
+            batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
             try:
-                async with make_aiohttp_session(proxy=self.network.proxy, headers=headers) as session:
-                    async with session.post(url, json=data, headers=headers) as resp:
-                        await resp.text()
+                await self._post(url, [notification for notification, t in batch])
+            except asyncio.CancelledError:
+                self._requeue(queue, batch)
+                raise
             except Exception as e:
-                self.print_error(str(e))
-            else:
-                self.print_error('Got Response for {}'.format(addr))
+                if retries < self.max_retries:
+                    delay = min(NOTIFIER_MAX_BACKOFF, 2 ** retries)
+                    self.print_error(f'POST to {url} failed: {repr(e)}. retrying in {delay}s')
+                    retries += 1
+                    self.num_retries += 1
+                    self._requeue(queue, batch)
+                    await asyncio.sleep(delay)
+                else:
+                    self.print_error(f'POST to {url} failed: {repr(e)}. giving up on {len(batch)} notifications')
+                    retries = 0
+                    self.num_dropped += len(batch)
+                continue
+            retries = 0
+            now = time.time()
+            self.num_delivered += len(batch)
+            self._latencies.extend(now - t for notification, t in batch)
+
+    def _requeue(self, queue: deque, batch: list):
+        # the batch goes back in front of the queue. If notifications were
+        # queued meanwhile, the oldest ones are dropped, from the batch.
+        num_dropped = max(0, len(queue) + len(batch) - queue.maxlen)
+        self.num_dropped += num_dropped
+        queue.extendleft(reversed(batch[num_dropped:]))
+
+    async def _post(self, url, notifications):
+        session = await self._get_http_session()
+        data = notifications[0] if self.batch_size == 1 else notifications
+        async with session.post(url, json=data) as resp:
+            await resp.text()
+            resp.raise_for_status()
+
+    async def _get_http_session(self):
+        # one session, so that connections to each host are reused
+        if self._http_session is None or self._http_session_proxy != self.network.proxy:
+            await self._close_http_session()
+            self._http_session_proxy = self.network.proxy
+            self._http_session = make_aiohttp_session(proxy=self.network.proxy)
+        return self._http_session
+
+    async def _close_http_session(self):
+        session, self._http_session = self._http_session, None
+        if session is not None:
+            await session.close()
+
+    async def get_stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        def percentile(p):
+            return round(latencies[int(p * (len(latencies) - 1))], 3) if latencies else None
+        return {
+            'watched_addresses': len(self.watched_addresses),
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'delivered': self.num_delivered,
+            'retries': self.num_retries,
+            'dropped': self.num_dropped,
+            'latency_median': percentile(0.5),
+            'latency_p95': percentile(0.95),
+            'latency_max': percentile(1),
+        }
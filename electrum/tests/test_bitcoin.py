@@ -251,6 +251,19 @@ class Test_bitcoin(SequentialTestCase):
             with self.assertRaises(InvalidPassword):
                 crypto.pw_decode(enc, wrong_password, version=version)
 
+    @needs_test_with_all_aes_implementations
+    def test_aes_cbc_stream(self):
+        key, iv = bytes(range(16)), bytes(range(16, 32))
+        for size in (0, 15, 16, 17, 1000):
+            data = bytes(i % 251 for i in range(size))
+            ciphertext = crypto.aes_encrypt_with_iv(key, iv, data)
+            encrypter = crypto.AESCBCEncrypter(key, iv)
+            chunks = [data[i:i + 7] for i in range(0, size, 7)]
+            self.assertEqual(ciphertext, b''.join(encrypter.update(c) for c in chunks) + encrypter.finalize())
+            decrypter = crypto.AESCBCDecrypter(key, iv)
+            chunks = [ciphertext[i:i + 5] for i in range(0, len(ciphertext), 5)]
+            self.assertEqual(data, b''.join(decrypter.update(c) for c in chunks) + decrypter.finalize())
+
     def test_sha256d(self):
         self.assertEqual(b'\x95MZI\xfdp\xd9\xb8\xbc\xdb5\xd2R&x)\x95\x7f~\xf7\xfalt\xf8\x84\x19\xbd\xc5\xe8"\t\xf4',
                          sha256d(u"test"))
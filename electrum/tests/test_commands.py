@@ -1,9 +1,16 @@
+import os
+import shutil
+import tempfile
 import unittest
 from decimal import Decimal
+from unittest import mock
 
 from electrum.commands import Commands, eval_bool
+from electrum.simple_config import SimpleConfig
+from electrum.storage import WalletStorage, STO_EV_PLAINTEXT, STO_EV_USER_PW, STORAGE_BACKEND_SQLITE
+from electrum.util import WalletFileException
 
-from . import TestCaseForTestnet
+from . import SequentialTestCase, TestCaseForTestnet
 
 
 class TestCommands(unittest.TestCase):
@@ -84,3 +91,63 @@ class TestCommandsTestnet(TestCaseForTestnet):
         for xkey1, xtype1 in xprvs:
             for xkey2, xtype2 in xprvs:
                 self.assertEqual(xkey2, cmds.convert_xkey(xkey1, xtype2))
+
+
+class TestStorageCommands(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, 'somewallet')
+        self.config = SimpleConfig({'electrum_path': self.user_dir, 'wallet_path': self.wallet_path})
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def _wallet(self, password=None):
+        storage = WalletStorage(self.wallet_path)
+        if password:
+            storage.set_password(password, enc_version=STO_EV_USER_PW)
+        storage.write()
+        return mock.Mock(storage=storage)
+
+    def test_set_journal(self):
+        cmds = Commands(self.config, self._wallet(), None)
+        self.assertEqual({'journal': True}, cmds.set_journal(True))
+        self.assertTrue(WalletStorage(self.wallet_path, manual_upgrades=True).use_journal)
+        cmds.set_journal(False)
+        self.assertFalse(WalletStorage(self.wallet_path, manual_upgrades=True).use_journal)
+
+    def test_set_stream_encryption(self):
+        cmds = Commands(self.config, self._wallet(), None)
+        with self.assertRaises(Exception):
+            cmds.set_stream_encryption(True)
+        cmds = Commands(self.config, self._wallet('secret'), None)
+        cmds.set_stream_encryption(True)
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage._stream_encryption)
+        storage.decrypt('secret')
+
+    def test_sqlite_storage_checks(self):
+        self._wallet()
+        daemon = mock.Mock()
+        cmds = Commands(self.config, None, None, daemon=daemon)
+        # the daemon would overwrite the converted file
+        with self.assertRaises(Exception):
+            cmds.convert_to_sqlite()
+        daemon.get_wallet.return_value = None
+        self.assertEqual({'path': self.wallet_path}, cmds.convert_to_sqlite())
+        os.unlink(self.wallet_path)
+        # storage encryption is not silently dropped
+        with self.assertRaises(Exception):
+            cmds.create(password='secret', sqlite=True)
+        self.assertFalse(os.path.exists(self.wallet_path))
+        storage = WalletStorage(self.wallet_path, backend=STORAGE_BACKEND_SQLITE)
+        for enc_version in (None, STO_EV_USER_PW):
+            with self.assertRaises(WalletFileException):
+                storage.set_password('secret', enc_version)
+        with self.assertRaises(WalletFileException):
+            storage.set_password('secret')
+        storage.set_password('secret', STO_EV_PLAINTEXT)
+        self.assertFalse(storage.is_encrypted())
@@ -1,11 +1,16 @@
 import asyncio
 import tempfile
+import threading
 import unittest
+from collections import defaultdict
+
+import aiorpcx
 
 from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
-from electrum.interface import Interface
+from electrum.network import Network, FETCH_MAX_INVALID_ANSWERS
+from electrum.interface import Interface, NotificationSession
 from electrum.crypto import sha256
 from electrum.util import bh2u
 
@@ -114,6 +119,96 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+class StubServerSession(aiorpcx.RPCSession):
+    requests = []
+
+    async def handle_request(self, request):
+        self.requests.append(request)
+        if request.method == 'blockchain.scripthash.subscribe':
+            if request.args[0] == 'bad':
+                raise aiorpcx.RPCError(1, 'bad scripthash')
+            return 'status_' + request.args[0]
+        raise aiorpcx.RPCError(aiorpcx.JSONRPC.METHOD_NOT_FOUND, request.method)
+
+
+class TestNotificationSession(unittest.TestCase):
+
+    def setUp(self):
+        StubServerSession.requests = []
+        self.loop = asyncio.get_event_loop()
+        self.server = aiorpcx.Server(StubServerSession, '127.0.0.1', 0)
+        self.loop.run_until_complete(self.server.listen())
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.server.close())
+
+    def test_subscribe_batch(self):
+        method = 'blockchain.scripthash.subscribe'
+        hashes = ['h%d' % i for i in range(150)]
+        async def run():
+            async with aiorpcx.Connector(NotificationSession, host='127.0.0.1', port=self.port) as session:
+                queue = asyncio.Queue()
+                await session.subscribe_batch(method, [[h] for h in hashes[:120]], queue)
+                # cached subscriptions are not requested again
+                await session.subscribe_batch(method, [[h] for h in hashes], queue)
+                with self.assertRaises(aiorpcx.RPCError):
+                    await session.subscribe_batch(method, [['h0'], ['bad']], queue)
+                return [queue.get_nowait() for _ in range(queue.qsize())], session.send_count
+        results, send_count = self.loop.run_until_complete(run())
+        expected = [[h, 'status_' + h] for h in hashes[:120] + hashes] + [['h0', 'status_h0']]
+        self.assertEqual(expected, results)
+        self.assertEqual(120 + 30 + 1, len(StubServerSession.requests))
+        # batches of 100, 20 and 30, then 'bad' on its own
+        self.assertEqual(4, send_count)
+
+
+class MockSession:
+    def __init__(self, answer):
+        self.answer = answer
+        self.num_requests = 0
+    def is_closing(self):
+        return False
+    async def send_request(self, method, params, timeout=None):
+        self.num_requests += 1
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+class MockFetchInterface:
+    def __init__(self, server, answer):
+        self.server = server
+        self.session = MockSession(answer)
+
+
+class TestRequestFromAnyInterface(unittest.TestCase):
+
+    def setUp(self):
+        self.network = Network.__new__(Network)
+        self.network.interfaces_lock = threading.Lock()
+        self.network._invalid_answers = defaultdict(int)
+
+    def request(self):
+        coro = self.network.request_from_any_interface('method', [], lambda result: result == 'good')
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_invalid_answers_are_retried_elsewhere(self):
+        bad = MockFetchInterface('bad', 'evil')
+        self.network.interfaces = {
+            'good': MockFetchInterface('good', 'good'),
+            'bad': bad,
+            'failing': MockFetchInterface('failing', Exception('timed out')),
+        }
+        for i in range(20):
+            self.assertEqual('good', self.request())
+        # the misbehaving server is not asked anymore
+        self.assertEqual(FETCH_MAX_INVALID_ANSWERS, bad.session.num_requests)
+
+    def test_no_valid_answer(self):
+        self.network.interfaces = {'bad': MockFetchInterface('bad', 'evil')}
+        self.assertIsNone(self.request())
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
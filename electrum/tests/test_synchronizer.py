@@ -0,0 +1,178 @@
+import asyncio
+import shutil
+import tempfile
+import unittest
+from collections import deque
+
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import (FetchScheduler, HISTORY_PRIORITY, tx_priority,
+                                   Notifier, WatchList, watch_list_path)
+
+
+class TestFetchScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_priority_order(self):
+        scheduler = FetchScheduler(max_window=1)
+        started = []
+        release = asyncio.Event()
+
+        async def request(name):
+            started.append(name)
+            await release.wait()
+
+        async def run():
+            priorities = [('first', HISTORY_PRIORITY), ('old', tx_priority(100)),
+                          ('mempool', tx_priority(0)), ('new', tx_priority(200)),
+                          ('history', HISTORY_PRIORITY)]
+            tasks = []
+            for name, priority in priorities:
+                tasks.append(asyncio.ensure_future(scheduler.run(priority, request, name)))
+                await asyncio.sleep(0)
+            self.assertEqual((0, 5), scheduler.get_progress())
+            release.set()
+            await asyncio.gather(*tasks)
+        self.loop.run_until_complete(run())
+        self.assertEqual(['first', 'history', 'mempool', 'new', 'old'], started)
+        self.assertEqual((0, 0), scheduler.get_progress())
+
+    def test_window_is_respected(self):
+        scheduler = FetchScheduler(max_window=3)
+        in_flight = []
+        max_in_flight = 0
+
+        async def request():
+            nonlocal max_in_flight
+            in_flight.append(1)
+            max_in_flight = max(max_in_flight, len(in_flight))
+            await asyncio.sleep(0.001)
+            in_flight.pop()
+
+        async def run():
+            await asyncio.gather(*[scheduler.run(tx_priority(1), request) for _ in range(50)])
+        self.loop.run_until_complete(run())
+        self.assertEqual(3, max_in_flight)
+        self.assertEqual(3, scheduler.window)
+
+    def test_failure_shrinks_window(self):
+        scheduler = FetchScheduler(max_window=50)
+        self.assertEqual(FetchScheduler.INITIAL_WINDOW, scheduler.window)
+
+        async def fail():
+            raise Exception('timed out')
+
+        async def run():
+            with self.assertRaises(Exception):
+                await scheduler.run(HISTORY_PRIORITY, fail)
+        self.loop.run_until_complete(run())
+        self.assertEqual(FetchScheduler.INITIAL_WINDOW / 2, scheduler.window)
+
+    def test_failure_shrinks_window_in_next_round(self):
+        scheduler = FetchScheduler(max_window=50)
+
+        async def request(fail):
+            await asyncio.sleep(0)
+            if fail:
+                raise Exception('timed out')
+
+        async def run_round(failures):
+            results = await asyncio.gather(*[scheduler.run(tx_priority(1), request, fail) for fail in failures],
+                                           return_exceptions=True)
+            self.assertEqual(failures, [isinstance(r, Exception) for r in results])
+        # a large round that ends with a failure
+        self.loop.run_until_complete(run_round(99 * [False] + [True]))
+        self.assertEqual((0, 0), scheduler.get_progress())
+        window = scheduler.window
+        # the first failure of the next round counts
+        self.loop.run_until_complete(run_round([True]))
+        self.assertEqual(window / 2, scheduler.window)
+
+    def test_cancelled_requests_free_their_slot(self):
+        scheduler = FetchScheduler(max_window=1)
+        release = asyncio.Event()
+        done = []
+
+        async def request(name):
+            await release.wait()
+            done.append(name)
+
+        async def run():
+            first = asyncio.ensure_future(scheduler.run(HISTORY_PRIORITY, request, 'first'))
+            waiting = asyncio.ensure_future(scheduler.run(HISTORY_PRIORITY, request, 'cancelled'))
+            last = asyncio.ensure_future(scheduler.run(tx_priority(1), request, 'last'))
+            await asyncio.sleep(0)
+            waiting.cancel()
+            release.set()
+            await asyncio.gather(first, last)
+            self.assertTrue(waiting.cancelled())
+        self.loop.run_until_complete(run())
+        self.assertEqual(['first', 'last'], done)
+        self.assertEqual(0, scheduler.in_flight)
+        self.assertEqual((0, 0), scheduler.get_progress())
+
+
+class MockNetwork:
+    interface = None
+    proxy = None
+    def __init__(self, config):
+        self.config = config
+        self.asyncio_loop = asyncio.get_event_loop()
+    def register_callback(self, callback, events):
+        pass
+
+
+class TestNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path,
+                                    'notifier_batch_size': 2, 'notifier_max_retries': 1})
+
+    def tearDown(self):
+        shutil.rmtree(self.electrum_path)
+
+    def test_watch_list_is_persisted(self):
+        path = watch_list_path(self.config)
+        WatchList(path).add('1BitcoinEaterAddressDontSendf59kuE', 'http://localhost/a')
+        WatchList(path).add('1BitcoinEaterAddressDontSendf59kuE', 'http://localhost/b')
+        self.assertEqual({'1BitcoinEaterAddressDontSendf59kuE': ['http://localhost/a', 'http://localhost/b']},
+                         WatchList(path).load())
+
+    def test_notifications_are_batched_and_retried(self):
+        addr, url = '1BitcoinEaterAddressDontSendf59kuE', 'http://localhost/notify'
+        notifier = Notifier(MockNetwork(self.config))
+        posts = []
+        failures = [Exception('connection refused')]
+
+        async def post(url, notifications):
+            if failures:
+                raise failures.pop()
+            posts.append([n['status'] for n in notifications])
+        notifier._post = post
+
+        async def run():
+            await notifier.watch(addr, url)
+            for status in ['s1', 's2', 's3']:
+                await notifier._on_address_status(addr, status)
+            while notifier.num_delivered < 3:
+                await asyncio.sleep(0.01)
+            await notifier.group.cancel_remaining()
+            return await notifier.get_stats()
+        stats = self.loop.run_until_complete(asyncio.wait_for(run(), 10))
+        self.assertEqual([['s1', 's2'], ['s3']], posts)
+        self.assertEqual(1, stats['retries'])
+        self.assertEqual(0, stats['dropped'])
+        self.assertEqual(0, stats['queued'])
+        # the address is watched again after a restart
+        self.assertEqual({addr: [url]}, Notifier(MockNetwork(self.config)).watched_addresses)
+
+    def test_retried_batch_does_not_overflow_queue(self):
+        notifier = Notifier(MockNetwork(self.config))
+        queue = deque(['n3', 'n4'], maxlen=3)
+        notifier._requeue(queue, ['n1', 'n2'])
+        # the oldest notification is dropped, and counted
+        self.assertEqual(['n2', 'n3', 'n4'], list(queue))
+        self.assertEqual(1, notifier.num_dropped)
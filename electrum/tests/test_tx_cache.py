@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+
+from electrum.tx_cache import TxCache
+
+from . import SequentialTestCase
+
+
+class TestTxCache(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.user_dir, 'tx_cache')
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_memory_is_bounded(self):
+        cache = TxCache(max_memory=10)
+        cache.put('a', '0000')
+        cache.put('b', '1111')
+        self.assertEqual('0000', cache.get('a'))  # 'b' is now the oldest
+        cache.put('c', '2222')
+        self.assertEqual('0000', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('2222', cache.get('c'))
+
+    def test_disk_store_survives_restart(self):
+        cache = TxCache(self.path, max_memory=4)
+        cache.put('a', '0000')
+        cache.put('b', '1111')
+        # evicted from memory, but still on disk
+        self.assertEqual('0000', cache.get('a'))
+        cache.close()
+        cache = TxCache(self.path)
+        self.assertEqual('0000', cache.get('a'))
+        self.assertEqual('1111', cache.get('b'))
+        self.assertIsNone(cache.get('c'))
+        cache.close()
+
+    def test_memory_only_entries(self):
+        cache = TxCache(self.path)
+        cache.put('a', '0000', on_disk=False)
+        cache.put('b', '1111')
+        self.assertEqual('0000', cache.get_from_memory('a'))
+        cache.close()
+        # e.g. transactions of encrypted wallets are not written to disk
+        cache = TxCache(self.path)
+        self.assertIsNone(cache.get_from_memory('b'))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual('1111', cache.get('b'))
+        cache.close()
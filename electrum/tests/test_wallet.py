@@ -4,12 +4,19 @@ import sys
 import os
 import json
 from decimal import Decimal
-from unittest import TestCase
+from unittest import TestCase, mock
 import time
 
 from io import StringIO
-from electrum.storage import WalletStorage, FINAL_SEED_VERSION
+from electrum.storage import (WalletStorage, SqliteWalletStorage, SqliteRawTransactions, FINAL_SEED_VERSION, STO_EV_USER_PW,
+                              STORAGE_BACKEND_SQLITE)
+from electrum.util import WalletFileException, InvalidPassword
 from electrum.wallet import Abstract_Wallet
+from electrum.address_synchronizer import LazyTransactionStore
+from electrum.bookkeeping import (TxInputs, TxOutputs, UtxoIndex, SpendGraph, HistoryIndex,
+                                  VerifiedTxIndex, AddressList, address_set, serialize_spent_outpoints,
+                                  deserialize_spent_outpoints)
+from electrum.transaction import Transaction
 from electrum.exchange_rate import ExchangeBase, FxThread
 from electrum.util import TxMinedInfo
 from electrum.bitcoin import COIN
@@ -75,6 +82,424 @@ class TestWalletStorage(WalletTestCase):
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
 
+    def test_get_readonly(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', {'a': 'b'})
+        labels = storage.get_readonly('labels')
+        self.assertEqual({'a': 'b'}, dict(labels))
+        with self.assertRaises(TypeError):
+            labels['c'] = 'd'
+        self.assertEqual(5, storage.get_readonly('missing', 5))
+        # later puts do not affect views obtained earlier
+        storage.put('labels', {'a': 'x'})
+        self.assertEqual('b', labels['a'])
+
+    def test_journal_roundtrip(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('transactions', {'a': '00', 'b': '01'})
+        storage.set_journal_enabled(True)
+        storage.write()
+        self.assertFalse(os.path.exists(storage.journal_path))
+
+        with open(self.wallet_path, "r") as f:
+            snapshot = f.read()
+        storage.put('transactions', {'a': '00', 'c': '02'})
+        storage.put('labels', {'a': 'label'})
+        storage.write()
+        self.assertTrue(os.path.exists(storage.journal_path))
+        # the main file is not rewritten
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(snapshot, f.read())
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual({'a': '00', 'c': '02'}, storage2.get('transactions'))
+        self.assertEqual({'a': 'label'}, storage2.get('labels'))
+        self.assertTrue(storage2.use_journal)
+
+    def test_journal_snapshot_size_in_bytes(self):
+        # a file with non-ascii characters, e.g. written by hand
+        with open(self.wallet_path, "w", encoding='utf-8') as f:
+            f.write(json.dumps({'labels': {'a': '\u00e9t\u00e9 \u20bf'}}, ensure_ascii=False))
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(os.path.getsize(self.wallet_path), storage._snapshot_size)
+        storage.set_journal_enabled(True)
+        storage.write()
+        self.assertEqual(os.path.getsize(self.wallet_path), storage._snapshot_size)
+        storage.put('labels', {'a': '\u20bf'})
+        storage.write()
+        self.assertEqual(os.path.getsize(storage.journal_path), storage._journal_size)
+
+    def test_journal_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.set_password('secret', enc_version=STO_EV_USER_PW)
+        storage.write()
+        storage.put('labels', {'a': 'label'})
+        storage.write()
+        with open(storage.journal_path, "r") as f:
+            self.assertNotIn('label', f.read())
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage2.is_encrypted())
+        storage2.decrypt('secret')
+        self.assertEqual({'a': 'label'}, storage2.get('labels'))
+
+    def test_journal_stale_and_truncated(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.write()
+        storage.put('a', 1)
+        storage.write()
+        storage.put('b', 2)
+        storage.write()
+        # simulate a crash in the middle of appending a record
+        with open(storage.journal_path, "a") as f:
+            f.write('[["set", ["c"], 3')
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(1, storage2.get('a'))
+        self.assertEqual(2, storage2.get('b'))
+        self.assertEqual(None, storage2.get('c'))
+        # records appended after the torn one must not get lost
+        storage2.put('d', 4)
+        storage2.write()
+        storage3 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(4, storage3.get('d'))
+        # a journal that belongs to another snapshot is not replayed
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps({'seed_version': FINAL_SEED_VERSION}))
+        storage4 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(None, storage4.get('a'))
+        self.assertFalse(os.path.exists(storage4.journal_path))
+
+    def test_journal_compaction(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_journal_enabled(True)
+        storage.write()
+        with mock.patch('electrum.storage.JOURNAL_MIN_COMPACTION_SIZE', 0):
+            for i in range(10):
+                storage.put('labels', {str(j): 'x' * 100 for j in range(i + 1)})
+                storage.write()
+        self.assertLess(os.path.getsize(storage.journal_path), 2 * os.path.getsize(self.wallet_path))
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(10, len(storage2.get('labels')))
+
+    def test_stream_encryption(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('transactions', {str(i): '00' * i for i in range(2000)})
+        storage.set_password('secret', enc_version=STO_EV_USER_PW)
+        storage.set_stream_encryption(True)
+        storage.write()
+        with open(self.wallet_path, "rb") as f:
+            self.assertEqual(b'BIS1', f.read(4))
+
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage2.is_encrypted_with_user_pw())
+        with self.assertRaises(InvalidPassword):
+            storage2.decrypt('wrong')
+        storage2.decrypt('secret')
+        self.assertEqual(storage.get('transactions'), storage2.get('transactions'))
+        # journal records on top of a streamed snapshot
+        storage2.set_journal_enabled(True)
+        storage2.write()
+        storage2.put('labels', {'a': 'label'})
+        storage2.write()
+        self.assertTrue(os.path.exists(storage2.journal_path))
+        storage3 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        storage3.decrypt('secret')
+        self.assertEqual({'a': 'label'}, storage3.get('labels'))
+        # and back to the base64 format
+        storage3.set_stream_encryption(False)
+        storage3.write()
+        storage4 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertFalse(storage4._stream_encryption)
+        storage4.decrypt('secret')
+        self.assertEqual(storage.get('transactions'), storage4.get('transactions'))
+
+    def test_stream_encryption_tampered_file(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('transactions', {str(i): '00' * i for i in range(200)})
+        storage.set_password('secret', enc_version=STO_EV_USER_PW)
+        storage.set_stream_encryption(True)
+        storage.write()
+        with open(self.wallet_path, "r+b") as f:
+            f.seek(100)
+            byte = f.read(1)
+            f.seek(100)
+            f.write(bytes([byte[0] ^ 1]))
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        # nothing is decompressed before the mac is verified
+        with mock.patch('electrum.storage.zlib.decompressobj') as decompressobj:
+            with self.assertRaises(InvalidPassword):
+                storage2.decrypt('secret')
+        self.assertFalse(decompressobj.called)
+
+    def test_background_writer(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.start_writer(interval=60)
+        writer = storage._writer
+        storage.put('a', 1)
+        storage.schedule_write()
+        # the first write happens right away, later ones are coalesced
+        storage.flush()
+        self.assertEqual(1, writer.num_writes)
+        for i in range(10):
+            storage.put('b', i)
+            storage.schedule_write()
+        time.sleep(0.1)
+        self.assertEqual(1, writer.num_writes)
+        self.assertEqual(None, WalletStorage(self.wallet_path, manual_upgrades=True).get('b'))
+        storage.stop_writer()
+        self.assertEqual(2, writer.num_writes)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(9, WalletStorage(self.wallet_path, manual_upgrades=True).get('b'))
+        # without a writer, writes are synchronous
+        storage.put('b', 10)
+        storage.schedule_write()
+        self.assertEqual(10, WalletStorage(self.wallet_path, manual_upgrades=True).get('b'))
+
+    def test_sqlite_roundtrip(self):
+        storage = WalletStorage(self.wallet_path, backend=STORAGE_BACKEND_SQLITE)
+        self.assertIsInstance(storage, SqliteWalletStorage)
+        storage.put('transactions', {'a': '00', 'b': '01'})
+        storage.put('verified_tx3', {'a': (100, 1500000000, 1, '00' * 32)})
+        storage.put('labels', {'a': 'label'})
+        storage.write()
+        storage.close()
+
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertIsInstance(storage2, SqliteWalletStorage)
+        self.assertEqual({'a': '00', 'b': '01'}, storage2.get('transactions'))
+        self.assertEqual('01', storage2.get_readonly('transactions')['b'])
+        self.assertEqual({'a': [100, 1500000000, 1, '00' * 32]}, storage2.get('verified_tx3'))
+        self.assertEqual({'a': 'label'}, storage2.get('labels'))
+        # incremental writes
+        storage2.put('transactions', {'a': '00', 'c': '02'})
+        storage2.put('labels', None)
+        storage2.write()
+        storage2.close()
+
+        storage3 = WalletStorage(self.wallet_path)
+        self.assertEqual({'a': '00', 'c': '02'}, storage3.get('transactions'))
+        self.assertEqual(None, storage3.get('labels'))
+        storage3.close()
+
+    def test_sqlite_save_does_not_read_transactions(self):
+        raw = TestLazyTransactionStore.raw1
+        storage = WalletStorage(self.wallet_path, backend=STORAGE_BACKEND_SQLITE)
+        storage.put('transactions', {'a': raw})
+        storage.write()
+        txs = LazyTransactionStore(storage.get_readonly('transactions'))
+        txs['b'] = Transaction(raw)
+        with mock.patch.object(SqliteRawTransactions, '__getitem__', side_effect=AssertionError):
+            storage.put_raw_transactions(set(txs), txs.get_unsaved_raw())
+            storage.write()
+        storage.close()
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'a': raw, 'b': raw}, storage2.get('transactions'))
+        storage2.close()
+
+    def test_sqlite_no_encryption(self):
+        storage = WalletStorage(self.wallet_path, backend=STORAGE_BACKEND_SQLITE)
+        with self.assertRaises(WalletFileException):
+            storage.set_password('secret', enc_version=STO_EV_USER_PW)
+
+    def test_convert_to_sqlite(self):
+        storage = WalletStorage(self.wallet_path)
+        data = {'transactions': {'a': '00'}, 'txi': {'a': 'addr:0000' + 'bb' * 32 + '000000000100000000000000'},
+                'txo': {'a': 'addr:000000000000010000000000000000'}, 'labels': {'a': 'label'},
+                'seed_version': FINAL_SEED_VERSION}
+        for key, value in data.items():
+            storage.put(key, value)
+        storage.write()
+
+        storage2 = storage.convert_to_sqlite()
+        self.assertIsInstance(storage2, SqliteWalletStorage)
+        for key, value in data.items():
+            self.assertEqual(value, storage2.get(key))
+        storage2.close()
+        with open(self.wallet_path, "rb") as f:
+            self.assertEqual(b'SQLite format 3\x00', f.read(16))
+
+class TestLazyTransactionStore(TestCase):
+
+    # a coinbase tx, and one of its own txid with a different raw tx
+    raw1 = '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff0704ffff001d0104ffffffff0100f2052a0100000043410496b538e853519c726a2c91e61ec11600ae1390813a627c66fb8be7947be63c52da7589379515d4e0a604f8141781e62294721166bf621e73a82cbf2342c858eeac00000000'
+    raw2 = raw1[:-8] + '01000000'
+
+    def test_lazy_transactions(self):
+        txs = LazyTransactionStore({'a': self.raw1, 'b': self.raw2}, cache_size=1)
+        self.assertEqual(2, len(txs))
+        self.assertEqual({'a', 'b'}, set(txs))
+        self.assertEqual(0, len(txs._cache))
+        tx_a = txs['a']
+        self.assertEqual(self.raw1, str(tx_a))
+        self.assertIs(tx_a, txs['a'])
+        txs['b']
+        # 'a' was evicted from the cache
+        self.assertIsNot(tx_a, txs['a'])
+        self.assertEqual(self.raw2, txs.get_raw('b'))
+        del txs['a']
+        self.assertNotIn('a', txs)
+        with self.assertRaises(KeyError):
+            txs['a']
+        # added transactions are not evicted until they are saved
+        txs['c'] = tx_c = Transaction(self.raw1)
+        txs['b']
+        self.assertIs(tx_c, txs['c'])
+        txs.set_raw_source({'b': self.raw2, 'c': self.raw1})
+        self.assertEqual({'b', 'c'}, set(txs))
+        self.assertEqual(self.raw1, txs.get_raw('c'))
+
+
+class TestBookkeeping(TestCase):
+
+    h1 = 'aa' * 32
+    h2 = 'bb' * 32
+
+    def test_txoutputs(self):
+        txo = TxOutputs([('addr1', 0, 1000, False), ('addr2', 1, 2000, False), ('addr1', 3, 3000, False)])
+        self.assertEqual(3, len(txo))
+        self.assertEqual(('addr1', 'addr2'), txo.addresses())
+        self.assertEqual(('addr2', 2000, False), txo.get_output(1))
+        self.assertIsNone(txo.get_output(2))
+        txo2 = TxOutputs.deserialize(txo.serialize())
+        self.assertEqual(txo, txo2)
+        self.assertEqual(list(txo), list(txo2))
+        self.assertEqual(txo, TxOutputs.from_legacy({'addr1': [[0, 1000, False], [3, 3000, False]],
+                                                     'addr2': [[1, 2000, False]]}))
+        self.assertFalse(TxOutputs())
+        self.assertEqual(TxOutputs(), TxOutputs.deserialize(TxOutputs().serialize()))
+
+    def test_txinputs(self):
+        txi = TxInputs([('addr1', self.h1, 0, 1000)])
+        self.assertEqual([('addr1', self.h1, 0, 1000)], list(txi))
+        self.assertIs(txi, txi.with_input('addr1', self.h1, 0, 1000))
+        txi2 = txi.with_input('addr2', self.h2, 5, 2000)
+        self.assertEqual(1, len(txi))
+        self.assertEqual([('addr1', self.h1, 0, 1000), ('addr2', self.h2, 5, 2000)], list(txi2))
+        self.assertEqual(txi2, TxInputs.deserialize(txi2.serialize()))
+        self.assertEqual(txi2, TxInputs.from_legacy({'addr1': [[self.h1 + ':0', 1000]],
+                                                     'addr2': [[self.h2 + ':5', 2000]]}))
+
+    def test_spent_outpoints(self):
+        spent_outpoints = {self.h1: {0: self.h2, 3: self.h2}, self.h2: {}}
+        d = serialize_spent_outpoints(spent_outpoints)
+        self.assertEqual({self.h1: '0:%s 3:%s' % (self.h2, self.h2)}, d)
+        self.assertEqual({self.h1: {0: self.h2, 3: self.h2}}, deserialize_spent_outpoints(d))
+
+    def test_utxo_index(self):
+        utxos = UtxoIndex()
+        # h2 spends output 0 of h1, and pays to addr2
+        utxos.add_inputs(TxInputs([('addr1', self.h1, 0, 1000)]))
+        utxos.add_outputs(self.h2, TxOutputs([('addr2', 0, 900, False)]))
+        self.assertEqual(1, len(utxos))
+        utxos.add_outputs(self.h1, TxOutputs([('addr1', 0, 1000, False), ('addr1', 1, 500, True)]))
+        self.assertEqual({(self.h1, 1): (500, True)}, utxos.get_addr_utxos('addr1'))
+        self.assertIsNone(utxos.get((self.h1, 0)))
+        self.assertEqual(('addr1', 1000, False), utxos.get_output((self.h1, 0)))
+        self.assertIsNone(utxos.get_output((self.h1, 2)))
+        self.assertEqual(('addr2', 900, False), utxos.get((self.h2, 0)))
+        self.assertEqual({'addr1', 'addr2'}, set(utxos.addresses()))
+        # removing h2 makes output 0 of h1 unspent again
+        utxos.remove_inputs(TxInputs([('addr1', self.h1, 0, 1000)]))
+        utxos.remove_outputs(self.h2, TxOutputs([('addr2', 0, 900, False)]))
+        self.assertEqual({(self.h1, 0): (1000, False), (self.h1, 1): (500, True)}, utxos.get_addr_utxos('addr1'))
+        self.assertEqual({'addr1'}, set(utxos.addresses()))
+        self.assertEqual(2, len(utxos))
+
+    def test_spend_graph(self):
+        # a -> b, a -> c, b -> d, c -> d (d spends outputs of b and c)
+        graph = SpendGraph({'a': {0: 'b', 1: 'c'}})
+        graph.add_spend('d', 'b', 0)
+        graph.add_spend('d', 'c', 0)
+        self.assertEqual('b', graph.get_spender('a', 0))
+        self.assertIsNone(graph.get_spender('a', 2))
+        self.assertEqual({'b', 'c'}, graph.get_children('a'))
+        self.assertEqual({'b', 'c', 'd'}, graph.get_descendants(['a']))
+        self.assertEqual({'d'}, graph.get_descendants(['b', 'c']))
+        self.assertEqual(set(), graph.get_descendants(['d']))
+        graph.remove_spends('d')
+        self.assertEqual({'a': {0: 'b', 1: 'c'}}, graph.to_dict())
+        # e replaces b
+        graph.add_spend('e', 'a', 0)
+        self.assertEqual({'e', 'c'}, graph.get_children('a'))
+        graph.remove_spends('b')
+        self.assertEqual({'a': {0: 'e', 1: 'c'}}, graph.to_dict())
+
+    def test_history_index(self):
+        h = HistoryIndex()
+        h.BLOCK_SIZE = 4
+        for i in range(10):
+            # txid, key, delta, timestamp
+            h.add('tx%d' % i, (10 - i, 0), 10 + i, 1000 - i)
+        self.assertEqual(10, len(h))
+        self.assertEqual(145, h.total())
+        self.assertEqual([('tx9', 19, 19), ('tx8', 18, 37), ('tx7', 17, 54)], list(h.items(0, 3)))
+        self.assertEqual([('tx1', 11, 135), ('tx0', 10, 145)], list(h.items(8)))
+        self.assertEqual([('tx3', 13, 112), ('tx2', 12, 124)], list(h.items_between(997, 999)))
+        # move tx0 to the start, and remove tx9
+        h.add('tx0', (0, 0), 10, 900)
+        h.remove('tx9')
+        self.assertEqual([('tx0', 10, 10), ('tx8', 18, 28)], list(h.items(0, 2)))
+        self.assertEqual([('tx0', 10, 10)], list(h.items_between(None, 990)))
+        self.assertEqual(126, h.total())
+        self.assertNotIn('tx9', h)
+        h.rebuild([('tx0', (0, 0), 10, None), ('tx1', (1, 0), -5, None)])
+        self.assertEqual([('tx1', -5, 5)], list(h.items(1)))
+        self.assertEqual(2, len(list(h.items_between(1000, 2000, now=1500))))
+
+    def test_verified_tx_index(self):
+        verified = VerifiedTxIndex([(self.h1, (100, 1000, 1, self.h2)), ('tx2', (90, 900, 0, None))])
+        self.assertEqual(TxMinedInfo(height=100, conf=None, timestamp=1000, txpos=1, header_hash=self.h2),
+                         verified[self.h1])
+        self.assertIsNone(verified['tx2'].header_hash)
+        verified['tx3'] = TxMinedInfo(height=95, conf=None, timestamp=None, txpos=None, header_hash=self.h1)
+        self.assertEqual([self.h1, 'tx3', 'tx2'], [txid for txid, info in verified.items_from_height(0)][::-1])
+        self.assertEqual(['tx3', self.h1], [txid for txid, info in verified.items_from_height(91)])
+        # moved to another block
+        verified[self.h1] = TxMinedInfo(height=80, conf=None, timestamp=800, txpos=2, header_hash=None)
+        self.assertEqual(['tx3'], [txid for txid, info in verified.items_from_height(91)])
+        self.assertEqual(80, verified.get_height(self.h1))
+        self.assertEqual(95, verified.pop('tx3').height)
+        self.assertIsNone(verified.pop('tx3', None))
+        self.assertRaises(KeyError, verified.pop, 'tx3')
+        self.assertNotIn('tx3', verified)
+        verified['tx4'] = TxMinedInfo(height=200, conf=None, timestamp=2000, txpos=0, header_hash=self.h1)
+        self.assertEqual(3, len(verified))
+        d = verified.to_dict()
+        self.assertEqual({self.h1: (80, 800, 2, None), 'tx2': (90, 900, 0, None), 'tx4': (200, 2000, 0, self.h1)}, d)
+        self.assertEqual(d, VerifiedTxIndex(d.items()).to_dict())
+
+    def test_address_list(self):
+        addresses = AddressList(['addr2', 'addr1'], 3)
+        self.assertEqual(('addr2', 'addr1'), addresses)
+        self.assertEqual(3, addresses.version)
+        self.assertIn('addr1', addresses)
+        self.assertNotIn('addr3', addresses)
+        self.assertEqual('addr1', addresses[1])
+        self.assertEqual(frozenset(['addr1', 'addr2']), addresses.set)
+        self.assertIs(addresses.set, address_set(addresses))
+        domain = {'addr1'}
+        self.assertIs(domain, address_set(domain))
+        self.assertEqual({'addr1'}, address_set(['addr1', 'addr1']))
+
+    def test_convert_version_19(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            storage = WalletStorage(os.path.join(tmpdir, 'wallet'), manual_upgrades=True)
+            storage.put('seed_version', 18)
+            storage.put('txi', {self.h2: {'addr1': [[self.h1 + ':0', 1000]]}})
+            storage.put('txo', {self.h1: {'addr1': [[0, 1000, False]]}})
+            storage.put('spent_outpoints', {self.h1: {'0': self.h2}})
+            storage.convert_version_19()
+            self.assertEqual(19, storage.get('seed_version'))
+            self.assertEqual(TxInputs([('addr1', self.h1, 0, 1000)]),
+                             TxInputs.deserialize(storage.get('txi')[self.h2]))
+            self.assertEqual(TxOutputs([('addr1', 0, 1000, False)]),
+                             TxOutputs.deserialize(storage.get('txo')[self.h1]))
+            self.assertEqual({self.h1: {0: self.h2}},
+                             deserialize_spent_outpoints(storage.get('spent_outpoints')))
+
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -95,6 +520,7 @@ class FakeWallet:
         super().__init__()
         self.fiat_value = fiat_value
         self.transactions = self.verified_tx = {'abc': 'Tx'}
+        self._cost_basis = {}
 
     def get_tx_height(self, txid):
         # because we use a current timestamp, and history is empty,
@@ -1,5 +1,9 @@
 from unittest import mock
+from decimal import Decimal
 import shutil
+import random
+import threading
+import time
 import tempfile
 from typing import Sequence
 import asyncio
@@ -7,9 +11,10 @@ import asyncio
 from electrum import storage, bitcoin, keystore, bip32
 from electrum import Transaction
 from electrum import SimpleConfig
-from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
+from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT, parents_first
+from electrum.synchronizer import history_status
 from electrum.wallet import sweep, Multisig_Wallet, Standard_Wallet, Imported_Wallet
-from electrum.util import bfh, bh2u
+from electrum.util import bfh, bh2u, TxMinedInfo
 from electrum.transaction import TxOutput
 
 from electrum.plugins.trustedcoin import trustedcoin
@@ -453,6 +458,45 @@ class TestWalletKeystoreAddressIntegrityForMainnet(SequentialTestCase):
         self.assertEqual(w.get_receiving_addresses()[0], 'bc1q84x0yrztvcjg88qef4d6978zccxulcmc9y88xcg4ghjdau999x7q7zv2qe')
         self.assertEqual(w.get_change_addresses()[0], 'bc1q0fj5mra96hhnum80kllklc52zqn6kppt3hyzr49yhr3ecr42z3tsrkg3gs')
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_address_lists_are_cached(self, mock_write):
+        ks = keystore.from_xpub('xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U')
+        w = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        addresses = w.get_addresses()
+        self.assertIs(addresses, w.get_addresses())
+        self.assertEqual(('1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf', '1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D'),
+                         (w.get_receiving_addresses()[0], w.get_change_addresses()[0]))
+        self.assertEqual(w.get_receiving_addresses() + w.get_change_addresses(), addresses)
+        self.assertTrue(w.is_mine('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D'))
+        self.assertFalse(w.is_mine('1BitcoinEaterAddressDontSendf59kuE'))
+        # a new address invalidates the lists
+        addr = w.create_new_address(for_change=False)
+        self.assertIsNot(addresses, w.get_addresses())
+        self.assertEqual(addr, w.get_receiving_addresses()[-1])
+        self.assertIn(addr, w.get_addresses())
+        self.assertTrue(w.is_mine(addr))
+        self.assertTrue(w.is_whole_wallet(w.get_addresses()))
+        self.assertFalse(w.is_whole_wallet(w.get_change_addresses()))
+
+        # only the last gap_limit addresses of a chain can make it grow
+        self.assertEqual([False, True, True], [w.is_gap_address(a) for a in w.get_receiving_addresses()])
+        self.assertEqual(len(w.get_change_addresses()) * [True],
+                         [w.is_gap_address(a) for a in w.get_change_addresses()])
+        self.assertFalse(w.is_gap_address('1BitcoinEaterAddressDontSendf59kuE'))
+        # is_mine does not rebuild the lists after a new address
+        addr = w.create_new_address(for_change=True)
+        with mock.patch.object(w, '_get_address_list', side_effect=AssertionError):
+            self.assertTrue(w.is_mine(addr))
+
+        w = WalletIntegrityHelper.create_imported_wallet()
+        w.import_addresses(['1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf', '1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D'])
+        self.assertEqual(('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D', '1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf'),
+                         w.get_addresses())
+        w.delete_address('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D')
+        self.assertEqual(('1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf',), w.get_addresses())
+        self.assertFalse(w.is_mine('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D'))
+        self.assertFalse(w.is_gap_address('1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf'))
+
 
 class TestWalletKeystoreAddressIntegrityForTestnet(TestCaseForTestnet):
 
@@ -910,6 +954,48 @@ class TestWalletSending(TestCaseForTestnet):
 
         wallet.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual((0, funding_output_value - 2500000 - 10000, 0), wallet.get_balance())
+        self.assertEqual([], wallet.check_utxo_index())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_balance_cache(self, mock_write):
+        wallet = self.create_standard_wallet_from_seed('fold object utility erase deputy output stadium feed stereo usage modify bean')
+        funding_tx = Transaction('010000000001011f4db0ecd81f4388db316bc16efb4e9daf874cf4950d54ecb4c0fb372433d68500000000171600143d57fd9e88ef0e70cddb0d8b75ef86698cab0d44fdffffff0280969800000000001976a91472e34cebab371967b038ce41d0e8fa1fb983795e88ac86a0ae020000000017a9149188bc82bdcae077060ebb4f02201b73c806edc887024830450221008e0725d531bd7dee4d8d38a0f921d7b1213e5b16c05312a80464ecc2b649598d0220596d309cf66d5f47cb3df558dbb43c5023a7796a80f5a88b023287e45a4db6b9012102c34d61ceafa8c216f01e05707672354f8119334610f7933a3f80dd7fb6290296bd391400')
+        funding_txid = funding_tx.txid()
+        addr = funding_tx.outputs()[0].address
+        self.assertEqual((0, 0, 0), wallet.get_balance())
+        wallet.receive_tx_callback(funding_txid, funding_tx, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual((0, 10000000, 0), wallet.get_balance())
+        self.assertEqual((0, 10000000, 0), wallet.get_addr_balance(addr))
+        # height changes invalidate the cached balances
+        wallet.add_unverified_tx(funding_txid, 1325500)
+        self.assertEqual((10000000, 0, 0), wallet.get_balance())
+        self.assertEqual((10000000, 0, 0), wallet.get_addr_balance(addr))
+        wallet.remove_unverified_tx(funding_txid, 1325500)
+        self.assertEqual((0, 10000000, 0), wallet.get_balance())
+        wallet.remove_transaction(funding_txid)
+        self.assertEqual((0, 0, 0), wallet.get_balance())
+        self.assertEqual((0, 0, 0), wallet.get_addr_balance(addr))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_balance_cache_after_delete_address(self, mock_write):
+        funding_tx = Transaction('010000000001011f4db0ecd81f4388db316bc16efb4e9daf874cf4950d54ecb4c0fb372433d68500000000171600143d57fd9e88ef0e70cddb0d8b75ef86698cab0d44fdffffff0280969800000000001976a91472e34cebab371967b038ce41d0e8fa1fb983795e88ac86a0ae020000000017a9149188bc82bdcae077060ebb4f02201b73c806edc887024830450221008e0725d531bd7dee4d8d38a0f921d7b1213e5b16c05312a80464ecc2b649598d0220596d309cf66d5f47cb3df558dbb43c5023a7796a80f5a88b023287e45a4db6b9012102c34d61ceafa8c216f01e05707672354f8119334610f7933a3f80dd7fb6290296bd391400')
+        funding_txid = funding_tx.txid()
+        addr0, addr1 = [o.address for o in funding_tx.outputs()]
+        wallet = WalletIntegrityHelper.create_imported_wallet()
+        wallet.import_addresses([addr0, addr1])
+        wallet.receive_tx_callback(funding_txid, funding_tx, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual((0, 54998790, 0), wallet.get_balance())
+        self.assertEqual(54998790, wallet.get_history()[-1][3])
+        # the deleted address no longer counts, although the tx stays
+        wallet.delete_address(addr0)
+        self.assertEqual((0, 44998790, 0), wallet.get_balance())
+        history = wallet.get_history()
+        self.assertEqual([(funding_txid, 44998790, 44998790)],
+                         [(txid, delta, balance) for txid, status, delta, balance in history])
+        # and its coin can no longer be spent
+        self.assertEqual([addr1], [coin['address'] for coin in wallet.get_utxos()])
+        self.assertEqual([addr1], [coin['address'] for coin in wallet.get_spendable_coins(None, self.config)])
+        self.assertEqual([], wallet.check_utxo_index())
 
     @needs_test_with_all_ecc_implementations
     @mock.patch.object(storage.WalletStorage, '_write')
@@ -999,6 +1085,7 @@ class TestWalletSending(TestCaseForTestnet):
 
         wallet.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual((0, funding_output_value - 2500000 - 10000, 0), wallet.get_balance())
+        self.assertEqual([], wallet.check_utxo_index())
 
     @needs_test_with_all_ecc_implementations
     @mock.patch.object(storage.WalletStorage, '_write')
@@ -1677,6 +1764,234 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
             tx = Transaction(self.transactions[self.txid_list[i]])
             w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual(27633300, sum(w.get_balance()))
+        self.assertEqual([], w.check_utxo_index())
+        # the history index agrees with the history computed from addresses
+        history = w.get_history()
+        self.assertEqual(19, len(history))
+        self.assertEqual(27633300, history[-1][3])
+        self.assertEqual({(txid, delta) for txid, status, delta, balance in history},
+                         {(txid, delta) for txid, status, delta, balance
+                          in w._get_history_from_addresses(w.get_addresses())})
+        # confirming transactions moves them in the history
+        for height, i in enumerate([3, 14, 0], start=1000):
+            w.add_unverified_tx(self.txid_list[i], height)
+        history = w.get_history()
+        self.assertEqual([self.txid_list[i] for i in [3, 14, 0]], [row[0] for row in history[:3]])
+        self.assertEqual(history[1:4], w.get_history_slice(1, 4))
+        balance = 0
+        for txid, status, delta, running_balance in history:
+            balance += delta
+            self.assertEqual(balance, running_balance)
+        self.assertEqual(27633300, balance)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_time_queries(self, mock_write):
+        w = self.create_old_wallet()
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 2000
+        for txid in self.txid_list:
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(txid, tx, TX_HEIGHT_UNCONFIRMED)
+        # confirm 15 txns; block timestamps are not monotonic
+        timestamps = [100, 200, 190, 300, 400, 390, 380, 500, 600, 700, 650, 800, 900, 1000, 1100]
+        for i, timestamp in enumerate(timestamps):
+            w.add_verified_tx(self.txid_list[i], TxMinedInfo(height=1000 + i, conf=None, timestamp=timestamp,
+                                                             txpos=0, header_hash=None))
+        history = w.get_history()
+        self.assertEqual(27633300, history[-1][3])
+
+        def timestamp_of(row, now):
+            return row[1].timestamp if row[1].timestamp is not None else now
+        now = 10 ** 10
+        for from_timestamp, to_timestamp in [(None, None), (150, 395), (195, 650), (390, 391), (1000, None), (None, 0)]:
+            expected = [row[0] for row in history
+                        if (from_timestamp is None or timestamp_of(row, now) >= from_timestamp)
+                        and (to_timestamp is None or timestamp_of(row, now) < to_timestamp)]
+            r = w.get_full_history(from_timestamp=from_timestamp, to_timestamp=to_timestamp)
+            self.assertEqual(expected, [item['txid'] for item in r['transactions']])
+            self.assertEqual(expected, [item['txid'] for item in w.iter_full_history(
+                from_timestamp=from_timestamp, to_timestamp=to_timestamp)])
+        for target in [0, 100, 195, 385, 395, 1099, 1100, 5000]:
+            expected = 0
+            for txid, tx_mined_status, delta, balance in history:
+                if tx_mined_status.timestamp is None or tx_mined_status.timestamp > target:
+                    break
+                expected = balance
+            self.assertEqual(expected, w.balance_at_timestamp(None, target))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_cost_basis(self, mock_write):
+        w = self.create_old_wallet()
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 2000
+        for txid in self.txid_list:
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(txid, tx, TX_HEIGHT_UNCONFIRMED)
+        for i, txid in enumerate(self.txid_list):
+            w.add_verified_tx(txid, TxMinedInfo(height=1000 + i, conf=None, timestamp=100 * (i + 1),
+                                                txpos=0, header_hash=None))
+        rates = {}
+        def price_func(timestamp):
+            return rates.get(timestamp, Decimal(timestamp) / 7)
+        ccy = 'EUR'
+
+        # the recursive definition, without caching
+        def coin_price(txid, v):
+            if w.txi.get(txid):
+                return average_price(txid) * v / Decimal(bitcoin.COIN)
+            fiat_value = w.get_fiat_value(txid, ccy)
+            if fiat_value is not None:
+                return fiat_value
+            return w.price_at_timestamp(txid, price_func) * v / Decimal(bitcoin.COIN)
+        def average_price(txid):
+            inputs = list(w.txi.get(txid))
+            total_price = sum(coin_price(prevout_hash, v) for addr, prevout_hash, prevout_n, v in inputs)
+            return total_price / (sum(v for addr, prevout_hash, prevout_n, v in inputs) / Decimal(bitcoin.COIN))
+        def check():
+            spending = [txid for txid in w.transactions if w.txi.get(txid)]
+            self.assertTrue(spending)
+            for txid in spending:
+                self.assertEqual(average_price(txid), w.average_price(txid, price_func, ccy))
+            coins = w.get_utxos()
+            self.assertTrue(coins)
+            for coin in coins:
+                self.assertEqual(coin_price(coin['prevout_hash'], coin['value']),
+                                 w.coin_price(coin['prevout_hash'], price_func, ccy, w.txin_value(coin)))
+
+        check()
+        # user-set fiat value of a receiving transaction
+        received = [txid for txid in self.txid_list if not w.txi.get(txid)]
+        fx = mock.Mock()
+        fx.timestamp_rate = price_func
+        fx.remove_thousands_separator.side_effect = lambda text: text
+        fx.ccy_amount_str.side_effect = lambda amount, commas: '%.2f' % amount
+        w.set_fiat_value(received[0], ccy, '12345.67', fx, w.get_tx_value(received[0]))
+        check()
+        # new exchange rates
+        rates[100 * (self.txid_list.index(received[1]) + 1)] = Decimal('4321')
+        w.clear_coin_price_cache()
+        check()
+        # new block timestamp
+        w.add_verified_tx(received[2], TxMinedInfo(height=1500, conf=None, timestamp=55555,
+                                                   txpos=0, header_hash=None))
+        check()
+        # removed transaction
+        w.remove_transaction(self.txid_list[-1])
+        check()
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_undo_verifications_reorg(self, mock_write):
+        w = self.create_old_wallet()
+        w.network = mock.Mock()
+        # 100k verified txns, 10 per block; the last 6 blocks get reorged
+        num_txs, tip, fork = 100000, 20000, 19995
+        def header_hash(height, fork_id):
+            return '%032x%032x' % (height, fork_id)
+        for i in range(num_txs):
+            height = tip - i // 10
+            w.verified_tx['%064x' % i] = TxMinedInfo(height=height, conf=None, timestamp=height * 600,
+                                                     txpos=i % 10, header_hash=header_hash(height, 0))
+        reorged = set('%064x' % i for i in range(60))
+        read_header = mock.Mock(side_effect=lambda height: header_hash(height, int(height >= fork)))
+        blockchain = mock.Mock(read_header=read_header)
+
+        t0 = time.time()
+        list(w.verified_tx.items())
+        full_scan = time.time() - t0
+        with mock.patch('electrum.address_synchronizer.hash_header', lambda header: header):
+            t0 = time.time()
+            txs = w.undo_verifications(blockchain, fork - 10)
+            undo = time.time() - t0
+        self.assertEqual(reorged, txs)
+        # one header read per block above the fork point
+        self.assertEqual(tip - (fork - 10) + 1, read_header.call_count)
+        self.assertLess(undo, full_scan)
+        self.assertEqual(num_txs - 60, len(w.verified_tx))
+        self.assertEqual(tip, w.unverified_tx['%064x' % 0])
+        self.assertEqual(fork - 1, w.verified_tx['%064x' % 60].height)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_add_transactions_batch(self, mock_write):
+        txs = {txid: Transaction(self.transactions[txid]) for txid in self.txid_list}
+        order = parents_first(txs)
+        self.assertEqual(sorted(order), self.txid_list)
+        for i, txid in enumerate(order):
+            for txin in txs[txid].inputs():
+                self.assertNotIn(txin['prevout_hash'], order[i:])
+        # one tx at a time, in the order of txorder1
+        w1 = self.create_old_wallet()
+        for i in [2, 12, 7, 9, 11, 10, 16, 6, 17, 1, 13, 15, 5, 8, 4, 0, 14, 18, 3]:
+            txid = self.txid_list[i]
+            w1.receive_tx_callback(txid, txs[txid], TX_HEIGHT_UNCONFIRMED)
+        # the same, as one batch, children first
+        w2 = self.create_old_wallet()
+        added = w2.add_transactions([(txid, txs[txid], TX_HEIGHT_UNCONFIRMED) for txid in reversed(order)])
+        self.assertEqual(len(txs), len(added))
+        self.assertEqual(27633300, sum(w2.get_balance()))
+        self.assertEqual([], w2.check_utxo_index())
+        self.assertEqual({txid: set(inputs) for txid, inputs in w1.txi.items()},
+                         {txid: set(inputs) for txid, inputs in w2.txi.items()})
+        self.assertEqual(dict(w1.txo), dict(w2.txo))
+        self.assertEqual(w1.spend_graph.to_dict(), w2.spend_graph.to_dict())
+        self.assertEqual({(txid, delta) for txid, status, delta, balance in w1.get_history()},
+                         {(txid, delta) for txid, status, delta, balance in w2.get_history()})
+        # transactions already in the wallet are added again, as by receive_tx_callback
+        self.assertEqual(len(txs), len(w2.add_transactions([(txid, txs[txid], TX_HEIGHT_UNCONFIRMED)
+                                                            for txid in order])))
+        self.assertEqual(27633300, sum(w2.get_balance()))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_concurrent_readers_and_syncing_writer(self, mock_write):
+        w = self.create_old_wallet()
+        txs = [Transaction(self.transactions[txid]) for txid in self.txid_list]
+        rnd = random.Random(1)
+        writer_done = threading.Event()
+        errors = []
+
+        def write():
+            # like the network thread, the writer has an event loop
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            try:
+                order = list(range(len(txs)))
+                rnd.shuffle(order)
+                for i in order:
+                    w.receive_tx_callback(self.txid_list[i], txs[i], TX_HEIGHT_UNCONFIRMED)
+                # the transactions get confirmed, reorged, confirmed again...
+                for _ in range(30):
+                    rnd.shuffle(order)
+                    with w.lock:
+                        for height, i in enumerate(order, start=1000):
+                            w.add_unverified_tx(self.txid_list[i], rnd.choice([height, TX_HEIGHT_UNCONFIRMED]))
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                writer_done.set()
+
+        def read():
+            try:
+                while not writer_done.is_set():
+                    history = w.get_history()
+                    balance = 0
+                    for txid, status, delta, running_balance in history:
+                        balance += delta
+                        self.assertEqual(balance, running_balance)
+                    with w.read_lock:
+                        coins = w.get_utxos()
+                        self.assertEqual(sum(coin['value'] for coin in coins), sum(w.get_balance()))
+                        self.assertEqual(len(w.get_history()), len(w._history_index))
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=60)
+        self.assertFalse(any(t.is_alive() for t in threads))
+        self.assertEqual([], errors)
+        self.assertEqual(27633300, sum(w.get_balance()))
+        self.assertEqual(len(txs), len(w.get_history()))
+        self.assertEqual([], w.check_utxo_index())
 
     @mock.patch.object(storage.WalletStorage, '_write')
     def test_restoring_old_wallet_txorder2(self, mock_write):
@@ -1685,6 +2000,7 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
             tx = Transaction(self.transactions[self.txid_list[i]])
             w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual(27633300, sum(w.get_balance()))
+        self.assertEqual([], w.check_utxo_index())
 
     @mock.patch.object(storage.WalletStorage, '_write')
     def test_restoring_old_wallet_txorder3(self, mock_write):
@@ -1693,6 +2009,7 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
             tx = Transaction(self.transactions[self.txid_list[i]])
             w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual(27633300, sum(w.get_balance()))
+        self.assertEqual([], w.check_utxo_index())
 
 
 class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
@@ -1744,3 +2061,17 @@ class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
                                    {})
         w.synchronize()
         self.assertEqual(9999788, sum(w.get_balance()))
+        self.assertEqual([], w.check_utxo_index())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_address_status_is_stored_with_history(self, mock_write):
+        w = self.create_wallet()
+        addr = 'tb1qgh5c088he4d559wl0hw27hrdeg8p2z96pefn4q'
+        hist = [('268fce617aaaa4847835c2212b984d7b7741fdab65de22813288341819bc5656', 1316917)]
+        w.receive_history_callback(addr, hist, {}, history_status(hist))
+        w.save_transactions()
+        w2 = Standard_Wallet(w.storage)
+        self.assertEqual({addr: history_status(hist)}, w2.address_status)
+        # a history received without its status drops the stored one
+        w2.receive_history_callback(addr, [], {})
+        self.assertEqual({}, w2.address_status)
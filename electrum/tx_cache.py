@@ -0,0 +1,114 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2018 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# A cache of raw transactions, keyed by txid, shared by all the wallets
+# of a daemon (see Network.get_transaction). As a txid determines its
+# transaction, an entry never gets stale; only transactions that were
+# checked to match their txid are put in the cache.
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from .util import PrintError
+
+
+# default size of the in-memory cache, in characters of raw tx hex
+TX_CACHE_MEMORY_SIZE = 32 * 1024 * 1024
+
+
+class TxCache(PrintError):
+    """txid -> raw transaction.
+
+    The most recently used transactions are kept in memory. If a path
+    is given, transactions put with on_disk=True are also stored in an
+    SQLite database there, so that they survive restarts. The database
+    is not encrypted: transactions of encrypted wallets must not go there.
+    get() and put(on_disk=True) may block on the database.
+    """
+
+    def __init__(self, path: str = None, max_memory: int = TX_CACHE_MEMORY_SIZE):
+        self.max_memory = max_memory
+        self._memory = OrderedDict()  # txid -> raw tx
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        if path:
+            try:
+                self._conn = sqlite3.connect(path, check_same_thread=False)
+                # losing the last writes of a cache is fine
+                self._conn.execute('PRAGMA synchronous=OFF')
+                with self._conn:
+                    self._conn.execute('CREATE TABLE IF NOT EXISTS transactions (txid TEXT PRIMARY KEY, raw TEXT NOT NULL)')
+            except sqlite3.Error as e:
+                self.print_error('cannot open tx cache', path, repr(e))
+                self._conn = None
+
+    def has_disk_store(self) -> bool:
+        return self._conn is not None
+
+    def get_from_memory(self, txid: str) -> Optional[str]:
+        with self._lock:
+            raw = self._memory.get(txid)
+            if raw is not None:
+                self._memory.move_to_end(txid)
+            return raw
+
+    def get(self, txid: str) -> Optional[str]:
+        with self._lock:
+            raw = self._memory.get(txid)
+            if raw is not None:
+                self._memory.move_to_end(txid)
+                return raw
+            if self._conn is None:
+                return None
+            row = self._conn.execute('SELECT raw FROM transactions WHERE txid=?', (txid,)).fetchone()
+            if row is None:
+                return None
+            raw = row[0]
+            self._add_to_memory(txid, raw)
+            return raw
+
+    def put(self, txid: str, raw: str, *, on_disk: bool = True):
+        """Adds a transaction. The caller must have checked that txid
+        is the txid of raw."""
+        with self._lock:
+            if txid not in self._memory:
+                self._add_to_memory(txid, raw)
+            if on_disk and self._conn is not None:
+                with self._conn:
+                    self._conn.execute('INSERT OR IGNORE INTO transactions VALUES (?,?)', (txid, raw))
+
+    def _add_to_memory(self, txid, raw):
+        self._memory[txid] = raw
+        self._memory_size += len(raw)
+        while self._memory_size > self.max_memory and len(self._memory) > 1:
+            _, old_raw = self._memory.popitem(last=False)
+            self._memory_size -= len(old_raw)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -311,6 +311,87 @@ class DaemonThread(threading.Thread, PrintError):
         self.print_error("stopped")
 
 
+class ReadWriteLock:
+    """A lock that readers share and a writer holds alone.
+
+    reader and writer are its two sides, used as context managers. Both
+    are reentrant, and the thread holding the writer may also take the
+    reader. A thread holding only the reader must not take the writer:
+    two readers doing that would deadlock, so it raises RuntimeError.
+    Waiting writers go before new readers, so that a steady stream of
+    readers does not starve them.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}  # thread ident -> depth
+        self._writer = None  # thread ident
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self.reader = _LockSide(self._acquire_read, self._release_read)
+        self.writer = _LockSide(self._acquire_write, self._release_write)
+
+    def _acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if me not in self._readers and self._writer != me:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def _release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            depth = self._readers.get(me)
+            if depth is None:
+                raise RuntimeError('read lock not held')
+            if depth > 1:
+                self._readers[me] = depth - 1
+                return
+            del self._readers[me]
+            if not self._readers:
+                self._cond.notify_all()
+
+    def _acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_depth += 1
+                return
+            if me in self._readers:
+                raise RuntimeError('cannot take the write lock while holding the read lock')
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def _release_write(self):
+        with self._cond:
+            if self._writer != threading.get_ident():
+                raise RuntimeError('write lock not held')
+            self._write_depth -= 1
+            if not self._write_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+
+class _LockSide:
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
 verbosity = ''
 def set_verbosity(filters: Union[str, bool]):
     global verbosity
@@ -57,6 +57,7 @@ from .transaction import Transaction, TxOutput, TxOutputHwInfo
 from .plugin import run_hook
 from .address_synchronizer import (AddressSynchronizer, TX_HEIGHT_LOCAL,
                                    TX_HEIGHT_UNCONF_PARENT, TX_HEIGHT_UNCONFIRMED)
+from .bookkeeping import CostBasis
 from .paymentrequest import (PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED,
                              InvoiceStore)
 from .contacts import Contacts
@@ -190,6 +191,8 @@ class Abstract_Wallet(AddressSynchronizer):
     verbosity_filter = 'w'
 
     def __init__(self, storage: WalletStorage):
+        # ccy -> CostBasis
+        self._cost_basis = {}
         AddressSynchronizer.__init__(self, storage)
 
         # saved fields
@@ -210,11 +213,10 @@ class Abstract_Wallet(AddressSynchronizer):
         self.invoices = InvoiceStore(self.storage)
         self.contacts = Contacts(self.storage)
 
-        self._coin_price_cache = {}
-
     def load_and_cleanup(self):
         self.load_keystore()
         self.load_addresses()
+        self._invalidate_addresses()
         self.test_addresses_sanity()
         super().load_and_cleanup()
 
@@ -304,6 +306,10 @@ class Abstract_Wallet(AddressSynchronizer):
             if ccy not in self.fiat_value:
                 self.fiat_value[ccy] = {}
             self.fiat_value[ccy][txid] = text
+        cost_basis = self._cost_basis.get(ccy)
+        if cost_basis is not None:
+            with self.lock:
+                cost_basis.invalidate([txid])
         self.storage.put('fiat_value', self.fiat_value)
         return reset
 
@@ -315,6 +321,8 @@ class Abstract_Wallet(AddressSynchronizer):
             return
 
     def is_mine(self, address):
+        # a dict lookup, without rebuilding the address lists after an
+        # address was added
         try:
             self.get_address_index(address)
         except KeyError:
@@ -413,6 +421,8 @@ class Abstract_Wallet(AddressSynchronizer):
         return self.get_balance(self.frozen_addresses)
 
     def balance_at_timestamp(self, domain, target_timestamp):
+        if self.is_whole_wallet(domain):
+            return self.get_balance_at_timestamp(target_timestamp)
         h = self.get_history(domain)
         balance = 0
         for tx_hash, tx_mined_status, value, balance in h:
@@ -421,23 +431,30 @@ class Abstract_Wallet(AddressSynchronizer):
         # return last balance
         return balance
 
-    @profiler
-    def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None,
-                         fx=None, show_addresses=False, show_fees=False):
-        out = []
-        income = 0
-        expenditures = 0
-        capital_gains = Decimal(0)
-        fiat_income = Decimal(0)
-        fiat_expenditures = Decimal(0)
+    def get_history_in_window(self, domain=None, from_timestamp=None, to_timestamp=None):
+        """get_history, restricted to the transactions with
+        from_timestamp <= timestamp < to_timestamp"""
+        if self.is_whole_wallet(domain):
+            return self.get_history_between(from_timestamp, to_timestamp)
         h = self.get_history(domain)
         now = time.time()
-        for tx_hash, tx_mined_status, value, balance in h:
-            timestamp = tx_mined_status.timestamp
+        out = []
+        for item in h:
+            timestamp = item[1].timestamp
             if from_timestamp and (timestamp or now) < from_timestamp:
                 continue
             if to_timestamp and (timestamp or now) >= to_timestamp:
                 continue
+            out.append(item)
+        return out
+
+    def iter_full_history(self, domain=None, from_timestamp=None, to_timestamp=None,
+                          fx=None, show_addresses=False, show_fees=False):
+        """Yields the transactions of get_full_history one at a time.
+        Only the transactions of the time window are looked at."""
+        for tx_hash, tx_mined_status, value, balance in self.get_history_in_window(
+                domain, from_timestamp, to_timestamp):
+            timestamp = tx_mined_status.timestamp
             tx = self.transactions.get(tx_hash)
             item = {
                 'txid': tx_hash,
@@ -461,18 +478,32 @@ class Abstract_Wallet(AddressSynchronizer):
             # value may be None if wallet is not fully synchronized
             if value is None:
                 continue
+            # fiat computations
+            if fx and fx.is_enabled() and fx.get_history_config():
+                item.update(self.get_tx_item_fiat(tx_hash, value, fx, tx_fee))
+            yield item
+
+    @profiler
+    def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None,
+                         fx=None, show_addresses=False, show_fees=False):
+        out = []
+        income = 0
+        expenditures = 0
+        capital_gains = Decimal(0)
+        fiat_income = Decimal(0)
+        fiat_expenditures = Decimal(0)
+        for item in self.iter_full_history(domain, from_timestamp, to_timestamp,
+                                           fx, show_addresses, show_fees):
+            value = item['value'].value
             # fixme: use in and out values
             if value < 0:
                 expenditures += -value
             else:
                 income += value
-            # fiat computations
-            if fx and fx.is_enabled() and fx.get_history_config():
-                fiat_fields = self.get_tx_item_fiat(tx_hash, value, fx, tx_fee)
-                fiat_value = fiat_fields['fiat_value'].value
-                item.update(fiat_fields)
+            if 'fiat_value' in item:
+                fiat_value = item['fiat_value'].value
                 if value < 0:
-                    capital_gains += fiat_fields['capital_gain'].value
+                    capital_gains += item['capital_gain'].value
                     fiat_expenditures += -fiat_value
                 else:
                     fiat_income += fiat_value
@@ -521,7 +552,7 @@ class Abstract_Wallet(AddressSynchronizer):
         fiat_value = self.get_fiat_value(tx_hash, fx.ccy)
         fiat_default = fiat_value is None
         fiat_rate = self.price_at_timestamp(tx_hash, fx.timestamp_rate)
-        fiat_value = fiat_value if fiat_value is not None else self.default_fiat_value(tx_hash, fx, value)
+        fiat_value = fiat_value if fiat_value is not None else value / Decimal(COIN) * fiat_rate
         fiat_fee = tx_fee / Decimal(COIN) * fiat_rate if tx_fee is not None else None
         item['fiat_value'] = Fiat(fiat_value, fx.ccy)
         item['fiat_fee'] = Fiat(fiat_fee, fx.ccy) if fiat_fee else None
@@ -541,10 +572,11 @@ class Abstract_Wallet(AddressSynchronizer):
         return label
 
     def get_default_label(self, tx_hash):
-        if self.txi.get(tx_hash) == {}:
-            d = self.txo.get(tx_hash, {})
+        inputs = self.txi.get(tx_hash)
+        if inputs is not None and not inputs:
+            outputs = self.txo.get(tx_hash)
             labels = []
-            for addr in d.keys():
+            for addr in (outputs.addresses() if outputs else ()):
                 label = self.labels.get(addr)
                 if label:
                     labels.append(label)
@@ -609,7 +641,7 @@ class Abstract_Wallet(AddressSynchronizer):
             # is_mine outputs should not be spent yet
             # to avoid cancelling our own dependent transactions
             txid = tx.txid()
-            if any([self.is_mine(o.address) and self.spent_outpoints[txid].get(output_idx)
+            if any([self.is_mine(o.address) and self.spend_graph.get_spender(txid, output_idx)
                     for output_idx, o in enumerate(tx.outputs())]):
                 continue
             # all inputs should be is_mine
@@ -851,10 +883,9 @@ class Abstract_Wallet(AddressSynchronizer):
             txin['type'] = self.get_txin_type(address)
             # segwit needs value to sign
             if txin.get('value') is None:
-                received, spent = self.get_addr_io(address)
-                item = received.get(txin['prevout_hash']+':%d'%txin['prevout_n'])
-                if item:
-                    txin['value'] = item[1]
+                output = self.utxos.get_output((txin['prevout_hash'], txin['prevout_n']))
+                if output is not None and output[0] == address:
+                    txin['value'] = output[1]
             self.add_input_sig_info(txin, address)
 
     def can_sign(self, tx):
@@ -1199,12 +1230,9 @@ class Abstract_Wallet(AddressSynchronizer):
         return self.keystore.decrypt_message(index, message, password)
 
     def txin_value(self, txin):
-        txid = txin['prevout_hash']
-        prev_n = txin['prevout_n']
-        for address, d in self.txo.get(txid, {}).items():
-            for n, v, cb in d:
-                if n == prev_n:
-                    return v
+        output = self.utxos.get_output((txin['prevout_hash'], txin['prevout_n']))
+        if output is not None:
+            return output[1]
         # may occur if wallet is not synchronized
         return None
 
@@ -1221,41 +1249,42 @@ class Abstract_Wallet(AddressSynchronizer):
         lp = sum([coin['value'] for coin in coins]) * p / Decimal(COIN)
         return lp - ap
 
+    def _get_cost_basis(self, ccy):
+        cost_basis = self._cost_basis.get(ccy)
+        if cost_basis is None:
+            cost_basis = CostBasis(lambda txid: self.txi.get(txid, ()),
+                                   lambda txid: self.get_fiat_value(txid, ccy),
+                                   lambda txids: self.spend_graph.get_descendants(txids))
+            self._cost_basis[ccy] = cost_basis
+        return cost_basis
+
+    def _invalidate_tx_descendants(self, tx_hash):
+        for cost_basis in self._cost_basis.values():
+            cost_basis.invalidate([tx_hash])
+
+    def clear_history(self):
+        super().clear_history()
+        self._cost_basis = {}
+
     def average_price(self, txid, price_func, ccy):
         """ Average acquisition price of the inputs of a transaction """
-        input_value = 0
-        total_price = 0
-        for addr, d in self.txi.get(txid, {}).items():
-            for ser, v in d:
-                input_value += v
-                total_price += self.coin_price(ser.split(':')[0], price_func, ccy, v)
-        return total_price / (input_value/Decimal(COIN))
+        with self.read_lock, self._cache_lock:
+            return self._get_cost_basis(ccy).average_price(
+                txid, lambda txid: self.price_at_timestamp(txid, price_func))
 
     def clear_coin_price_cache(self):
-        self._coin_price_cache = {}
+        # new exchange rates are available
+        for cost_basis in self._cost_basis.values():
+            cost_basis.rates_changed()
 
     def coin_price(self, txid, price_func, ccy, txin_value):
         """
         Acquisition price of a coin.
         This assumes that either all inputs are mine, or no input is mine.
         """
-        if txin_value is None:
-            return Decimal('NaN')
-        cache_key = "{}:{}:{}".format(str(txid), str(ccy), str(txin_value))
-        result = self._coin_price_cache.get(cache_key, None)
-        if result is not None:
-            return result
-        if self.txi.get(txid, {}) != {}:
-            result = self.average_price(txid, price_func, ccy) * txin_value/Decimal(COIN)
-            self._coin_price_cache[cache_key] = result
-            return result
-        else:
-            fiat_value = self.get_fiat_value(txid, ccy)
-            if fiat_value is not None:
-                return fiat_value
-            else:
-                p = self.price_at_timestamp(txid, price_func)
-                return p * txin_value/Decimal(COIN)
+        with self.read_lock, self._cache_lock:
+            return self._get_cost_basis(ccy).coin_cost(
+                txid, txin_value, lambda txid: self.price_at_timestamp(txid, price_func))
 
     def is_billing_address(self, addr):
         # overloaded for TrustedCoin wallets
@@ -1345,7 +1374,7 @@ class Imported_Wallet(Simple_Wallet):
 
     def get_addresses(self):
         # note: overridden so that the history can be cleared
-        return sorted(self.addresses.keys())
+        return self._get_address_list('all', lambda: sorted(self.addresses.keys()))
 
     def get_receiving_addresses(self):
         return self.get_addresses()
@@ -1394,6 +1423,7 @@ class Imported_Wallet(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.history.pop(address, None)
+            self.address_status.pop(address, None)
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
@@ -1410,6 +1440,10 @@ class Imported_Wallet(Simple_Wallet):
 
         pubkey = self.get_public_key(address)
         self.addresses.pop(address)
+        self._invalidate_addresses()
+        # after the pop, so that the balance and history are recomputed
+        # without the address
+        self._invalidate_address(address)
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
@@ -1501,16 +1535,13 @@ class Deterministic_Wallet(Abstract_Wallet):
     def get_addresses(self):
         # note: overridden so that the history can be cleared.
         # addresses are ordered based on derivation
-        out = []
-        out += self.get_receiving_addresses()
-        out += self.get_change_addresses()
-        return out
+        return self._get_address_list('all', lambda: self.receiving_addresses + self.change_addresses)
 
     def get_receiving_addresses(self):
-        return self.receiving_addresses
+        return self._get_address_list('receiving', lambda: self.receiving_addresses)
 
     def get_change_addresses(self):
-        return self.change_addresses
+        return self._get_address_list('change', lambda: self.change_addresses)
 
     @profiler
     def try_detecting_internal_addresses_corruption(self):
@@ -1519,7 +1550,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             return
         addresses_all = self.get_addresses()
         # sample 1: first few
-        addresses_sample1 = addresses_all[:10]
+        addresses_sample1 = list(addresses_all[:10])
         # sample2: a few more randomly selected
         addresses_rand = addresses_all[10:]
         addresses_sample2 = random.sample(addresses_rand, min(len(addresses_rand), 10))
@@ -1548,6 +1579,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             k = self.num_unused_trailing_addresses(addresses)
             n = len(addresses) - k + value
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self._invalidate_addresses()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_addresses()
@@ -1620,6 +1652,15 @@ class Deterministic_Wallet(Abstract_Wallet):
             self.synchronize_sequence(False)
             self.synchronize_sequence(True)
 
+    def is_gap_address(self, address):
+        # synchronize_sequence looks at the last addresses of each chain
+        if not self.is_mine(address):
+            return False
+        is_change, i = self.get_address_index(address)
+        addr_list = self.get_change_addresses() if is_change else self.get_receiving_addresses()
+        limit = self.gap_limit_for_change if is_change else self.gap_limit
+        return i >= len(addr_list) - limit
+
     def is_beyond_limit(self, address):
         is_change, i = self.get_address_index(address)
         addr_list = self.get_change_addresses() if is_change else self.get_receiving_addresses()